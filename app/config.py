@@ -6,12 +6,149 @@ from dotenv import load_dotenv
 load_dotenv(verbose=True)
 
 API_TOKEN = environ.get("API_TOKEN")
+# comma separated ids of users allowed to run service commands like /uploads
+ADMIN_IDS = [int(i) for i in environ.get("ADMIN_IDS", "").split(",") if i.strip()]
+# Bot API server, e.g. a local telegram-bot-api, empty for api.telegram.org
+TELEGRAM_API_URL = environ.get("TELEGRAM_API_URL", "")
+
+# "polling" or "webhook": Telegram posts updates to WEBHOOK_URL, which is proxied to WEBHOOK_HOST:WEBHOOK_PORT
+UPDATES_MODE = environ.get("UPDATES_MODE", "polling")
+WEBHOOK_URL = environ.get("WEBHOOK_URL", "")
+WEBHOOK_HOST = environ.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(environ.get("WEBHOOK_PORT", 8080))
+# checked against the X-Telegram-Bot-Api-Secret-Token header of webhook requests
+WEBHOOK_SECRET = environ.get("WEBHOOK_SECRET", "")
+# parallel webhook connections Telegram opens, 1-100
+WEBHOOK_MAX_CONNECTIONS = int(environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+# update handlers running at once, the rest wait for a slot
+UPDATE_CONCURRENCY = int(environ.get("UPDATE_CONCURRENCY", 64))
+# webhook updates in progress after which Telegram is told to retry later
+UPDATE_MAX_PENDING = int(environ.get("UPDATE_MAX_PENDING", 1000))
+# seconds to wait for handlers in progress on shutdown
+DRAIN_TIMEOUT = float(environ.get("DRAIN_TIMEOUT", 30))
 API_ID = environ.get("API_ID")
 API_HASH = environ.get("API_HASH")
+# long-lived pyrogram clients used to send posters
+PYROGRAM_POOL_SIZE = int(environ.get("PYROGRAM_POOL_SIZE", 2))
+
+# "pyramid" (coarse-to-fine), "fast" (all scales at full resolution) or "exhaustive"
+AREA_MATCHER = environ.get("AREA_MATCHER", "pyramid")
+# how city images map to coordinates: "equirectangular" (rows linear in latitude) or "mercator"
+CITY_IMG_PROJECTION = environ.get("CITY_IMG_PROJECTION", "equirectangular")
+
+# per-worker cache of decoded city images and parsed geojson
+CITY_CACHE_MAX_MB = int(environ.get("CITY_CACHE_MAX_MB", 1024))
+# comma separated city names or "all" to load in every pool worker at startup
+CITY_CACHE_PREWARM = environ.get("CITY_CACHE_PREWARM", "")
 
 CMD_TEMPLATE = "mapoc poster create --shp_path \"{shp}\" --geojson \"{geojson}\" --colors \"{colors}\" --output_prefix \"{prefix}\""
 
 BASE_DIR = Path(__file__).resolve().parent
 FILES_PATH = BASE_DIR / "files"
-TMP_PATH = FILES_PATH / "tmp"
 OUTPUT_PATH = BASE_DIR
+DATA_PATH = FILES_PATH / "data"
+
+FILE_IDS_DB_PATH = DATA_PATH / "file_ids.sqlite3"
+JOBS_DB_PATH = DATA_PATH / "jobs.sqlite3"
+# seconds finished jobs are kept, 0 keeps them forever; at least a day, daily quotas are counted from them
+JOBS_RETENTION = int(environ.get("JOBS_RETENTION", 7 * 24 * 3600))
+# cities and color schemes, managed with `python -m app.services.catalog`
+CATALOG_DB_PATH = DATA_PATH / "catalog.sqlite3"
+# cities on one page of the city keyboard
+CITIES_PAGE_SIZE = int(environ.get("CITIES_PAGE_SIZE", 10))
+# FSM and dialog state: "sqlite" (FSM_DB_PATH), "redis" (FSM_REDIS_URL) or "memory"
+FSM_STORAGE = environ.get("FSM_STORAGE", "sqlite")
+FSM_DB_PATH = DATA_PATH / "fsm.sqlite3"
+FSM_REDIS_URL = environ.get("FSM_REDIS_URL", "redis://localhost:6379/0")
+# seconds after which an abandoned dialog is forgotten, 0 keeps it forever
+FSM_TTL = int(environ.get("FSM_TTL", 7 * 24 * 3600))
+# FSM records cached in memory by the sqlite storage
+FSM_CACHE_SIZE = int(environ.get("FSM_CACHE_SIZE", 10000))
+# area geojsons and render outputs until they are delivered, see app/utils/workspace.py
+WORKSPACE_PATH = FILES_PATH / "workspace"
+# disk budget of unreferenced workspace files, the oldest are removed above it
+WORKSPACE_MAX_MB = int(environ.get("WORKSPACE_MAX_MB", 2048))
+# seconds an unreferenced file is kept, as long as a dialog may come back to its area
+WORKSPACE_TTL = int(environ.get("WORKSPACE_TTL", FSM_TTL))
+# seconds an unreferenced file is kept even over the budget
+WORKSPACE_GRACE = int(environ.get("WORKSPACE_GRACE", 3600))
+# seconds between workspace garbage collections
+WORKSPACE_GC_INTERVAL = int(environ.get("WORKSPACE_GC_INTERVAL", 300))
+BROKER_URL = environ.get("BROKER_URL", f"sqlite://{DATA_PATH / 'broker.sqlite3'}")
+
+# renders run in parallel while free RAM (minus the reserve for the bot) covers their estimated peak
+MAX_PARALLEL_RENDERS = int(environ.get("MAX_PARALLEL_RENDERS", 4))
+MEMORY_RESERVE_MB = int(environ.get("MEMORY_RESERVE_MB", 2048))
+RENDER_MEMORY_ESTIMATE_MB = int(environ.get("RENDER_MEMORY_ESTIMATE_MB", 10240))
+# address space limit of a render relative to its estimate, 0 disables the limit
+RENDER_MEMORY_LIMIT_FACTOR = float(environ.get("RENDER_MEMORY_LIMIT_FACTOR", 2.0))
+# renders are killed after this many seconds of wall clock or CPU time, 0 disables the limit
+RENDER_TIMEOUT = float(environ.get("RENDER_TIMEOUT", 3600))
+RENDER_CPU_TIMEOUT = int(environ.get("RENDER_CPU_TIMEOUT", 3600))
+# runs of a render killed by a signal (OOM killer, shutdown), failed and timed out renders aren't retried
+RENDER_MAX_ATTEMPTS = int(environ.get("RENDER_MAX_ATTEMPTS", 2))
+# seconds between edits of the render progress message, Telegram rate limits edits
+PROGRESS_EDIT_INTERVAL = float(environ.get("PROGRESS_EDIT_INTERVAL", 10))
+
+# "local" renders in the bot process, "broker" sends jobs to worker.py processes
+RENDER_BACKEND = environ.get("RENDER_BACKEND", "local")
+BROKER_LEASE_SECONDS = float(environ.get("BROKER_LEASE_SECONDS", 60))
+BROKER_POLL_INTERVAL = float(environ.get("BROKER_POLL_INTERVAL", 2))
+BROKER_MAX_ATTEMPTS = int(environ.get("BROKER_MAX_ATTEMPTS", 3))
+# seconds after publishing a job when its result is dropped if the bot doesn't wait for it anymore
+BROKER_RESULT_TTL = float(environ.get("BROKER_RESULT_TTL", 24 * 3600))
+
+# keep a mapoc process per shapefile with region data in memory between renders
+RENDER_DAEMON = environ.get("RENDER_DAEMON", "0") == "1"
+RENDER_DAEMON_IDLE_TIMEOUT = float(environ.get("RENDER_DAEMON_IDLE_TIMEOUT", 900))
+RENDER_DAEMON_SOCKET_DIR = environ.get("RENDER_DAEMON_SOCKET_DIR", "/tmp/mapoc-render")
+
+# per-city clipped shapefiles, see app/services/extracts.py
+EXTRACTS_PATH = FILES_PATH / "shp" / "extracts"
+EXTRACT_MARGIN_DEG = float(environ.get("EXTRACT_MARGIN_DEG", 0.05))
+# seconds a city's extract is used without checking it against its source again
+EXTRACT_CHECK_INTERVAL = float(environ.get("EXTRACT_CHECK_INTERVAL", 60))
+
+RENDER_CACHE_PATH = FILES_PATH / "cache" / "render"
+RENDER_CACHE_MAX_MB = int(environ.get("RENDER_CACHE_MAX_MB", 10240))
+
+# full city renders kept per (city, color) as memory-mapped rasters, area posters are cropped from them.
+# Off by default: crops are placed assuming the city image and the full poster cover the same extent
+MASTER_RENDERS = environ.get("MASTER_RENDERS", "0") == "1"
+MASTERS_PATH = FILES_PATH / "cache" / "masters"
+# long side of a poster cropped from a master
+MASTER_CROP_DIM = int(environ.get("MASTER_CROP_DIM", 4000))
+# areas needing more upscaling than this are rendered with mapoc instead
+MASTER_MAX_UPSCALE = float(environ.get("MASTER_MAX_UPSCALE", 1.5))
+
+# queued jobs differing only by color scheme are rendered by one mapoc run, up to this many schemes
+MAX_BATCH_COLORS = int(environ.get("MAX_BATCH_COLORS", 4))
+# mapoc takes several schemes as one --colors value joined by this separator
+COLORS_SEPARATOR = environ.get("COLORS_SEPARATOR", ",")
+
+# wall time and peak RSS of renders, a cost model fitted on them predicts ETAs
+RENDER_STATS_DB_PATH = DATA_PATH / "render_stats.sqlite3"
+# predicted render time until the model has COST_MODEL_MIN_SAMPLES renders
+RENDER_DEFAULT_SECONDS = float(environ.get("RENDER_DEFAULT_SECONDS", 360))
+COST_MODEL_MIN_SAMPLES = int(environ.get("COST_MODEL_MIN_SAMPLES", 10))
+# "fifo", "sjf" (shortest predicted render first) or "aging" (sjf with waiting time credit)
+SCHEDULER_POLICY = environ.get("SCHEDULER_POLICY", "fifo")
+# seconds of predicted render time forgiven per second of waiting with the aging policy
+SCHEDULER_AGING_RATE = float(environ.get("SCHEDULER_AGING_RATE", 1.0))
+# every user gets a queue of their own in SCHEDULER_POLICY order, users share renders by their tier weights
+SCHEDULER_FAIR = environ.get("SCHEDULER_FAIR", "1") == "1"
+# priority tiers "name:weight:max unfinished jobs:max jobs per day" comma separated, 0 is no limit,
+# the first one is the default tier
+USER_TIERS = environ.get("USER_TIERS", "default:1:10:50,premium:4:40:400")
+# users of other tiers, "user_id:tier" comma separated
+USER_TIER_MEMBERS = environ.get("USER_TIER_MEMBERS", "")
+
+# Prometheus metrics endpoint, port 0 disables it
+METRICS_HOST = environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(environ.get("METRICS_PORT", 9108))
+# metrics of worker.py, 0 disables them
+WORKER_METRICS_PORT = int(environ.get("WORKER_METRICS_PORT", 0))
+
+# process pools: area matching while a user waits and bulk work like previews
+MATCH_WORKERS = int(environ.get("MATCH_WORKERS", 2))
+BULK_WORKERS = int(environ.get("BULK_WORKERS", 2))
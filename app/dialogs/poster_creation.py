@@ -1,4 +1,6 @@
 from io import BytesIO
+import json
+import math
 import time
 import logging
 
@@ -9,12 +11,19 @@ from aiogram_dialog import Dialog, DialogManager, Window
 from aiogram_dialog.widgets import text
 from aiogram_dialog.widgets import kbd
 
+from app import metrics
 from app.states import PosterCreation
-from app.config import FILES_PATH, CMD_TEMPLATE
+from app.config import CMD_TEMPLATE, CITIES_PAGE_SIZE
 from app.utils.coords import area_to_geojson
 from app.utils.queue_manager import QueueManager
-from app.utils.executor import run_blocking
+from app.utils.executor import run_interactive
+from app.utils.shm import SharedBuffer
+from app.utils.workspace import get_workspace
+from app.utils.render_cache import prepare_render
+from app.utils.file_ids import upload_once
 from app.services import db
+from app.services.extracts import get_city_geojson_path
+from app.utils.city_cache import get_city_img_path
 
 logger = logging.getLogger("dialog - poster_creation")
 
@@ -24,6 +33,42 @@ async def set_selected_city(c: types.CallbackQuery, item_id: str, select: kbd.Se
     manager.context.set_data("city", city_name)
 
 
+async def cities_getter(dialog_manager: DialogManager, **kwargs):
+    prefix = dialog_manager.context.data("city_prefix", "")
+    page = dialog_manager.context.data("city_page", 0)
+    cities, total = db.search_cities(prefix, page, CITIES_PAGE_SIZE)
+    pages = max(1, math.ceil(total / CITIES_PAGE_SIZE))
+    return {
+        "cities": cities,
+        "prefix": prefix,
+        "found": total,
+        "page": page + 1,
+        "pages": pages,
+        "has_prev": page > 0,
+        "has_next": page + 1 < pages,
+    }
+
+
+async def prev_cities_page(c: types.CallbackQuery, button: kbd.Button, manager: DialogManager):
+    manager.context.set_data("city_page", max(0, manager.context.data("city_page", 0) - 1))
+
+
+async def next_cities_page(c: types.CallbackQuery, button: kbd.Button, manager: DialogManager):
+    manager.context.set_data("city_page", manager.context.data("city_page", 0) + 1)
+
+
+async def city_search_handler(m: types.Message, dialog: Dialog, manager: DialogManager):
+    manager.context.set_data("city_prefix", (m.text or "").strip())
+    manager.context.set_data("city_page", 0)
+    await dialog.show(manager)
+
+
+async def colors_getter(dialog_manager: DialogManager, **kwargs):
+    return {
+        "colors": db.get_color_schemes(),
+    }
+
+
 async def city_name_getter(dialog_manager: DialogManager, **kwargs):
     city = dialog_manager.context.data("city")
     return {
@@ -34,21 +79,26 @@ async def city_name_getter(dialog_manager: DialogManager, **kwargs):
 async def collected_data_getter(dialog_manager: DialogManager, **kwargs):
     city = dialog_manager.context.data("city")
     area = dialog_manager.context.data("is_area_specified", False)
-    color = dialog_manager.context.data("color")
+    colors = dialog_manager.context.data("colors", [])
     return {
         "city_name": city,
         "is_area_specified": area,
-        "color": color,
+        "color": ", ".join(colors),
     }
 
 
 async def send_city_map(c: types.CallbackQuery, button: kbd.Button, manager: DialogManager):
     city_name = manager.context.data("city")
-    city_img_path = FILES_PATH / "img" / (city_name + ".png")
-    await c.message.answer_photo(
-        types.InputFile(city_img_path),
-        caption=f"Save this image, crop the area that you need and {markdown.hbold('send cropped image back')}"
-    )
+    city_img_path = get_city_img_path(city_name)
+
+    async def send_photo(file_id):
+        message = await c.message.answer_photo(
+            file_id or types.InputFile(city_img_path),
+            caption=f"Save this image, crop the area that you need and {markdown.hbold('send cropped image back')}"
+        )
+        return message.photo[-1].file_id
+
+    await upload_once(city_img_path, "photo", send_photo)
 
 
 async def area_image_handler(m: types.Message, dialog: Dialog, manager: DialogManager):
@@ -58,21 +108,30 @@ async def area_image_handler(m: types.Message, dialog: Dialog, manager: DialogMa
     if not m.photo:
         geojson_path = get_city_gjs_path(city_name)
         manager.context.set_data("geojson", geojson_path)
+        manager.context.set_data("area_rect", None)
         await m.reply("There's no photo in your message.\nSkipping.")
         await dialog.next(manager)
         return
 
     area_img = BytesIO()
-    await m.photo[-1].download(area_img, seek=True)
+    with metrics.timer("photo_download"):
+        await m.photo[-1].download(area_img, seek=True)
 
     try:
-        geojson_path, selected_image_bytes = await run_blocking(area_to_geojson, city_name, area_img)
+        # the photo goes to the pool worker through shared memory instead of being pickled,
+        # it's unlinked when the worker is done with it
+        with SharedBuffer.from_bytes(area_img.getbuffer()) as area_buf:
+            geojson_path, selected_ref, area_rect = await run_interactive(area_to_geojson, city_name, area_buf.ref)
         manager.context.set_data("is_area_specified", True)
-        await m.reply_photo(types.InputFile(selected_image_bytes), caption="Defined area")
+        manager.context.set_data("area_rect", list(area_rect))
+        with SharedBuffer.attach(selected_ref, owner=True) as selected:
+            selected_image = BytesIO(selected.buf)
+        await m.reply_photo(types.InputFile(selected_image), caption="Defined area")
     except ValueError as e:
         logger.exception(e)
         geojson_path = get_city_gjs_path(city_name)
         manager.context.set_data("is_area_specified", False)
+        manager.context.set_data("area_rect", None)
         await m.reply("Can't define area, error occured. Using full map")
 
     manager.context.set_data("geojson", geojson_path)
@@ -80,12 +139,13 @@ async def area_image_handler(m: types.Message, dialog: Dialog, manager: DialogMa
 
 
 def get_city_gjs_path(city_name):
-    gjs_path = FILES_PATH / "geojson" / (city_name + ".geojson")
-    return gjs_path
+    # str, dialog data is stored as json
+    return str(get_city_geojson_path(city_name))
 
 
 async def set_city_geojson(c: types.CallbackQuery, button: kbd.Button, manager: DialogManager):
     manager.context.set_data("is_area_specified", False)
+    manager.context.set_data("area_rect", None)
     city_select: kbd.Select = manager.dialog().find("city_select")
     city_name = city_select.get_checked(manager)
     geojson_path = get_city_gjs_path(city_name)
@@ -93,35 +153,62 @@ async def set_city_geojson(c: types.CallbackQuery, button: kbd.Button, manager:
     await manager.dialog().next(manager)
 
 
-async def set_selected_color(c: types.CallbackQuery, item_id: str, select: kbd.Select, manager: DialogManager):
-    color_scheme_name = item_id
-    manager.context.set_data("color", color_scheme_name)
+async def set_selected_color(c: types.CallbackQuery, item_id: str, select: kbd.Multiselect, manager: DialogManager):
+    manager.context.set_data("colors", select.get_checked(manager))
 
 
 async def make_poster(c: types.CallbackQuery, button: kbd.Button, manager: DialogManager):
     city = manager.context.data("city")
     gjf = manager.context.data("geojson")
     shp = db.get_shp_path(city)
-    color = manager.context.data("color")
+    colors = manager.context.data("colors")
+    area_rect = manager.context.data("area_rect", None)
     prefix = f"{c.from_user.id}_{time.time():.0f}_{''.join(city.split())}"
-    cmd = CMD_TEMPLATE.format(shp=shp, geojson=gjf, colors=color, prefix=prefix)
+
+    features, batch_key, cache_keys = await run_interactive(prepare_render, shp, gjf, colors)
 
     qm = QueueManager.get_instance()
-    pos = qm.add_task(
-        callback=c,
-        manager=manager,
-        command=cmd,
-        geojson=gjf,
-        output_filename=f"{prefix}_{color}.png",
-        delete_geojson=manager.context.data("is_area_specified", False),
-        caption=f"{city}, {color}",
-    )
-
-    await c.message.answer(
-        "Poster creation has been queued!\n"
-        f"Your position in the queue: {markdown.hbold(pos)}\n"
-        f"Estimated time: ~{markdown.hbold((pos+1) * 6)} minutes\n"
-    )
+    # checked and added without awaiting in between, so repeated clicks can't all pass the check
+    reason = qm.check_quota(c.from_user.id, len(colors))
+    if reason is not None:
+        await c.message.answer(reason)
+        return
+
+    positions = []
+    # a job per color scheme, the queue renders them in one batch
+    for color, cache_key in zip(colors, cache_keys):
+        cmd = CMD_TEMPLATE.format(shp=shp, geojson=gjf, colors=color, prefix=prefix)
+        positions.append(qm.add_task(
+            user_id=c.from_user.id,
+            command=cmd,
+            geojson=str(gjf),
+            output_filename=str(get_workspace().output_path(f"{prefix}_{color}.png")),
+            delete_geojson=manager.context.data("is_area_specified", False),
+            caption=f"{city}, {color}",
+            cache_key=cache_key,
+            batch_key=batch_key,
+            shp=str(shp),
+            colors=color,
+            prefix=prefix,
+            city=city,
+            area_rect=json.dumps(area_rect) if area_rect else None,
+            features=json.dumps(features),
+        ))
+
+    pos = max(positions)
+    if pos:
+        # renders of other users may go first or after, depending on their shares
+        queued = qm.get_positions(c.from_user.id)
+        pos = queued[-1] if queued else pos
+    eta = max(qm.get_etas(cache_keys).values())
+    if pos == 0:
+        await c.message.answer("Your posters are almost ready, sending them now!")
+    else:
+        await c.message.answer(
+            "Poster creation has been queued!\n"
+            f"Your position in the queue: {markdown.hbold(pos)}\n"
+            f"Estimated time: ~{markdown.hbold(math.ceil(eta / 60))} minutes\n"
+        )
 
     # TODO это костыль
     await manager.done()
@@ -130,11 +217,14 @@ async def make_poster(c: types.CallbackQuery, button: kbd.Button, manager: Dialo
 
 
 city_window = Window(
-    text=text.Const("Let's start.\nChoose city"),
+    text=text.Format(
+        "Let's start.\nChoose city or send the beginning of its name to search\n"
+        "{found} cities starting with \"{prefix}\", page {page}/{pages}"
+    ),
     kbd=kbd.Group(kbd.Group(
         kbd.Radio(
             checked_text=text.Format("✅ {item}"), unchecked_text=text.Format("{item}"),
-            items=db.get_cities_list(),
+            items="cities",
             item_id_getter=lambda x: x,
             id="city_select",
             on_state_changed=set_selected_city,
@@ -142,11 +232,17 @@ city_window = Window(
         keep_rows=False,
         width=2,
     ),
+        kbd.Row(
+            kbd.Button(text.Const("<"), id="cities_prev", on_click=prev_cities_page, when=lambda d, w, m: d["has_prev"]),
+            kbd.Button(text.Const(">"), id="cities_next", on_click=next_cities_page, when=lambda d, w, m: d["has_next"]),
+        ),
         kbd.Next(
             when=lambda d, w, m: m.dialog().find("city_select").get_checked(m) is not None,
         ),
     ),
+    getter=cities_getter,
     state=PosterCreation.city,
+    on_message=city_search_handler,
 )
 
 area_choice_window = Window(
@@ -167,12 +263,12 @@ area_choice_window = Window(
 )
 
 color_choice_window = Window(
-    text=text.Const("Good. Now choose color scheme:"),
+    text=text.Const("Good. Now choose color schemes:"),
     kbd=kbd.Group(
         kbd.Group(
-            kbd.Radio(
+            kbd.Multiselect(
                 checked_text=text.Format("✅ {item}"), unchecked_text=text.Format("{item}"),
-                items=db.get_color_schemes(),
+                items="colors",
                 item_id_getter=lambda x: x,
                 id="color_select",
                 on_state_changed=set_selected_color,
@@ -183,10 +279,11 @@ color_choice_window = Window(
         kbd.Row(
             kbd.Back(),
             kbd.Next(
-                when=lambda d, w, m: m.dialog().find("color_select").get_checked(m) is not None,
+                when=lambda d, w, m: bool(m.dialog().find("color_select").get_checked(m)),
             ),
         ),
     ),
+    getter=colors_getter,
     state=PosterCreation.color_scheme,
 )
 
@@ -194,7 +291,7 @@ summary_window = Window(
     text=text.Format(
         "City: <b>{city_name}</b>\n"
         "Specified area: <b>{is_area_specified}</b>\n"
-        "Color scheme: <b>{color}</b>"
+        "Color schemes: <b>{color}</b>"
     ),
     kbd=kbd.Group(
         kbd.Button(text.Const("Create"), id="poster_confirm", on_click=make_poster),
@@ -4,8 +4,10 @@ from aiogram import types
 from aiogram.dispatcher import Dispatcher
 from aiogram_dialog import DialogManager
 
+from app.config import ADMIN_IDS
 from app.states import PosterCreation
 from app.utils.queue_manager import QueueManager
+from app.utils import file_ids, tg_client_api
 
 
 logger = logging.getLogger("handlers - poster_creation")
@@ -21,10 +23,32 @@ async def in_queue_handler(message: types.Message, dialog_manager: DialogManager
 
 async def qsize_handler(message: types.Message, dialog_manager: DialogManager):
     qm = QueueManager.get_instance()
-    await message.reply(f"Queue size: {qm.q.qsize()}")
+    user_id = message.from_user.id
+    lines = [f"Queue size: {qm.q.qsize()}"]
+    positions = qm.get_positions(user_id)
+    if positions:
+        lines.append(f"Your posters in the queue: {len(positions)}, the next one is {positions[0]} in line")
+    tier = qm.quotas.tier(user_id)
+    if tier.daily:
+        lines.append(f"Posters today: {qm.quotas.used_today(user_id)} of {tier.daily}")
+    await message.reply("\n".join(lines))
+
+
+async def uploads_handler(message: types.Message, dialog_manager: DialogManager):
+    stats = file_ids.get_registry().stats()
+    upload_stats = tg_client_api.get_pool().upload_stats.stats()
+    await message.reply(
+        f"Cached uploads: {stats['hits']}, uploads: {stats['misses']}\n"
+        f"Saved: {stats['bytes_saved'] / 1024 / 1024:.1f} MB, "
+        f"uploaded: {stats['bytes_uploaded'] / 1024 / 1024:.1f} MB\n"
+        f"Upload latency p50: {upload_stats['p50']:.1f}s, p95: {upload_stats['p95']:.1f}s, "
+        f"throughput: {upload_stats['throughput'] / 1024 / 1024:.1f} MB/s, "
+        f"errors: {upload_stats['errors']}"
+    )
 
 
 def register_poster_creation(dp: Dispatcher):
     dp.register_message_handler(in_queue_handler, state=PosterCreation.confirmation)
     dp.register_message_handler(poster_create_start, text="Make poster", state="*")
     dp.register_message_handler(qsize_handler, commands=["qsize"], state="*")
+    dp.register_message_handler(uploads_handler, commands=["uploads"], user_id=ADMIN_IDS, state="*")
@@ -1,16 +1,83 @@
+import asyncio
+import functools
 import logging
+import queue
 import time
+from logging.handlers import QueueHandler, QueueListener
+
+from app import metrics
+
+# (logger, its own handlers, the queue handler replacing them) of loggers moved to listener threads
+_background = []
 
 
 def log_processing(func):
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        logger = logging.getLogger(__name__)
+    """
+    Log and time sync and async functions, durations also go to the stage metrics.
+    """
+    logger = logging.getLogger(__name__)
+
+    def start():
         logger.info(f"Processing {func.__name__}...")
-        value = func(*args, **kwargs)
-        logger.info(
-            f"Finished processing {func.__name__} in {time.time() - start}s"
-        )
-        return value
+        return time.perf_counter()
+
+    def finish(started, error):
+        elapsed = time.perf_counter() - started
+        metrics.observe_stage(func.__name__, elapsed, error)
+        logger.info(f"Finished processing {func.__name__} in {elapsed:.3f}s")
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            started = start()
+            error = True
+            try:
+                value = await func(*args, **kwargs)
+                error = False
+                return value
+            finally:
+                finish(started, error)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = start()
+        error = True
+        try:
+            value = func(*args, **kwargs)
+            error = False
+            return value
+        finally:
+            finish(started, error)
 
     return wrapper
+
+
+def log_in_background(logger: logging.Logger) -> QueueListener:
+    """
+    Move the logger's handlers to a listener thread, so writing to files and terminals
+    doesn't block the event loop. Stop the returned listener on shutdown to flush it.
+    """
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    logger.addHandler(queue_handler)
+    _background.append((logger, handlers, queue_handler))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def log_in_foreground():
+    """
+    Give loggers moved by `log_in_background` their handlers back. For forked pool workers:
+    they inherit the queue handlers, but not the listener threads draining the queues.
+    """
+    while _background:
+        logger, handlers, queue_handler = _background.pop()
+        logger.removeHandler(queue_handler)
+        for handler in handlers:
+            logger.addHandler(handler)
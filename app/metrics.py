@@ -0,0 +1,175 @@
+import bisect
+import logging
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger("metrics")
+
+# seconds, from a cache hit to a full city render
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Registry:
+    """
+    Histograms, counters and gauges in Prometheus text format.
+    In process pool workers observations are also kept as samples,
+    which are shipped back with the result and merged into the bot's registry.
+    """
+    def __init__(self):
+        self.help = {}
+        self.histograms: Dict[Tuple[str, tuple], list] = {}
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.gauges: Dict[Tuple[str, tuple], Callable[[], float]] = {}
+        self.shipping = False
+        self.samples: List[tuple] = []
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def observe(self, name: str, value: float, **labels):
+        if self.shipping:
+            self.samples.append(("histogram", name, labels, value))
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            # bucket counts, sum, count
+            self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        buckets, _, _ = hist = self.histograms[key]
+        i = bisect.bisect_left(BUCKETS, value)
+        if i < len(BUCKETS):
+            buckets[i] += 1
+        hist[1] += value
+        hist[2] += 1
+
+    def inc(self, name: str, value=1.0, **labels):
+        if self.shipping:
+            self.samples.append(("counter", name, labels, value))
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def gauge(self, name: str, func: Callable[[], float], text: str = None, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = func
+        if text:
+            self.describe(name, text)
+
+    def drain(self) -> List[tuple]:
+        samples, self.samples = self.samples, []
+        return samples
+
+    def merge(self, samples: List[tuple]):
+        for kind, name, labels, value in samples:
+            if kind == "histogram":
+                self.observe(name, value, **labels)
+            else:
+                self.inc(name, value, **labels)
+
+    def render(self) -> str:
+        lines = []
+
+        def header(name, kind):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name in sorted({n for n, _ in self.histograms}):
+            header(name, "histogram")
+            for (n, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                labels = dict(labels)
+                cumulative = 0
+                for le, c in zip(BUCKETS, buckets):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {cumulative}")
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        for name in sorted({n for n, _ in self.counters}):
+            header(name, "counter")
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_labels(dict(labels))} {value}")
+
+        for name in sorted({n for n, _ in self.gauges}):
+            header(name, "gauge")
+            for (n, labels), func in sorted(self.gauges.items(), key=lambda item: item[0]):
+                if n != name:
+                    continue
+                try:
+                    value = func()
+                except Exception as e:
+                    logger.error(f"Can't read gauge {name}: {e}")
+                    continue
+                lines.append(f"{name}{_labels(dict(labels))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.describe("mapoc_stage_seconds", "Duration of a processing stage")
+registry.describe("mapoc_stage_errors_total", "Stage calls which raised")
+
+
+def observe_stage(stage: str, seconds: float, error=False):
+    registry.observe("mapoc_stage_seconds", seconds, stage=stage)
+    if error:
+        registry.inc("mapoc_stage_errors_total", stage=stage)
+
+
+@contextmanager
+def timer(stage: str):
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, error)
+
+
+class RemoteTraceback(Exception):
+    def __init__(self, tb: str):
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def call_shipping_metrics(pool: str, submitted: float, func, *args):
+    """
+    Run func in a pool worker and return (result, exception, traceback, metric samples),
+    samples are shipped even if func raises.
+    """
+    observe_stage(f"{pool}_pool_wait", time.time() - submitted)
+    try:
+        return func(*args), None, None, registry.drain()
+    except Exception as e:
+        return None, e, traceback.format_exc(), registry.drain()
+
+
+async def serve(host: str, port: int):
+    """
+    Serve /metrics for Prometheus, return the runner to clean up on shutdown.
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import List, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger("services - broker")
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+
+
+class Broker:
+    """
+    Shared job queue between the bot (producer and result consumer) and render workers.
+    A leased job goes back to the queue when its lease isn't extended by heartbeats,
+    so jobs of dead workers are delivered again.
+    """
+    def publish(self, job_id: str, payload: dict):
+        raise NotImplementedError
+
+    def lease(self, worker_id: str, lease_seconds: float) -> Optional[dict]:
+        """
+        Take the oldest available job. Return dict with id, payload and attempts or None.
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id: str, job_ids: List[str], lease_seconds: float):
+        raise NotImplementedError
+
+    def complete(self, job_id: str, worker_id: str, result: dict):
+        raise NotImplementedError
+
+    def release(self, job_id: str, worker_id: str):
+        """
+        Put a leased job back to the queue to be retried by any worker.
+        """
+        raise NotImplementedError
+
+    def fetch_results(self, job_ids: List[str], limit=100) -> List[dict]:
+        """
+        Finished ones of the given jobs with their results.
+        """
+        raise NotImplementedError
+
+    def ack_results(self, job_ids: List[str]):
+        raise NotImplementedError
+
+    def expire_results(self, ttl: float) -> int:
+        """
+        Remove results of jobs published more than ttl seconds ago which nobody acked. Return their number.
+        """
+        raise NotImplementedError
+
+    def workers(self) -> List[dict]:
+        raise NotImplementedError
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker in a local SQLite file, shared by processes of one host.
+    """
+    def __init__(self, path: str, max_attempts=3):
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS broker_jobs ("
+            "id TEXT PRIMARY KEY, "
+            "payload TEXT NOT NULL, "
+            "state TEXT NOT NULL, "
+            "worker_id TEXT, "
+            "lease_until REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, "
+            "created REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS broker_jobs_state ON broker_jobs (state, created)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS broker_workers ("
+            "id TEXT PRIMARY KEY, "
+            "last_seen REAL NOT NULL)"
+        )
+
+    def publish(self, job_id: str, payload: dict):
+        # publishing the same job again (after bot restart) is a no-op
+        self.db.execute(
+            "INSERT OR IGNORE INTO broker_jobs (id, payload, state, created) VALUES (?, ?, ?, ?)",
+            (job_id, json.dumps(payload), PENDING, time.time()),
+        )
+
+    def lease(self, worker_id: str, lease_seconds: float) -> Optional[dict]:
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self._fail_exhausted(now)
+            row = self.db.execute(
+                "SELECT id, payload, attempts FROM broker_jobs "
+                "WHERE state = ? OR (state = ? AND lease_until < ?) "
+                "ORDER BY created LIMIT 1",
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is None:
+                self.db.execute("COMMIT")
+                return None
+            self.db.execute(
+                "UPDATE broker_jobs SET state = ?, worker_id = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (LEASED, worker_id, now + lease_seconds, row["id"]),
+            )
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+        if row["attempts"]:
+            logger.warning(f"Redelivering job {row['id']}, attempt {row['attempts'] + 1}")
+        return {"id": row["id"], "payload": json.loads(row["payload"]), "attempts": row["attempts"] + 1}
+
+    def _fail_exhausted(self, now: float):
+        # jobs which killed every worker that took them
+        self.db.execute(
+            "UPDATE broker_jobs SET state = ?, result = ? "
+            "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+            (DONE, json.dumps({"ok": False, "error": "Max attempts exceeded"}), LEASED, now, self.max_attempts),
+        )
+
+    def heartbeat(self, worker_id: str, job_ids: List[str], lease_seconds: float):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO broker_workers (id, last_seen) VALUES (?, ?)",
+            (worker_id, now),
+        )
+        self.db.executemany(
+            "UPDATE broker_jobs SET lease_until = ? WHERE id = ? AND worker_id = ? AND state = ?",
+            [(now + lease_seconds, job_id, worker_id, LEASED) for job_id in job_ids],
+        )
+
+    def complete(self, job_id: str, worker_id: str, result: dict):
+        self.db.execute(
+            "UPDATE broker_jobs SET state = ?, result = ? WHERE id = ? AND worker_id = ? AND state = ?",
+            (DONE, json.dumps(result), job_id, worker_id, LEASED),
+        )
+
+    def release(self, job_id: str, worker_id: str):
+        self.db.execute(
+            "UPDATE broker_jobs SET state = ?, worker_id = NULL, lease_until = NULL "
+            "WHERE id = ? AND worker_id = ? AND state = ?",
+            (PENDING, job_id, worker_id, LEASED),
+        )
+
+    def fetch_results(self, job_ids: List[str], limit=100) -> List[dict]:
+        rows = []
+        # looked up by primary key, in chunks below the sqlite variables limit
+        for i in range(0, len(job_ids), 500):
+            chunk = job_ids[i:i + 500]
+            rows += self.db.execute(
+                f"SELECT id, result FROM broker_jobs WHERE id IN ({', '.join('?' * len(chunk))}) AND state = ? "
+                f"LIMIT ?",
+                (*chunk, DONE, limit - len(rows)),
+            ).fetchall()
+            if len(rows) >= limit:
+                break
+        return [{"id": row["id"], "result": json.loads(row["result"])} for row in rows]
+
+    def ack_results(self, job_ids: List[str]):
+        self.db.executemany("DELETE FROM broker_jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+    def expire_results(self, ttl: float) -> int:
+        return self.db.execute(
+            "DELETE FROM broker_jobs WHERE state = ? AND created < ?",
+            (DONE, time.time() - ttl),
+        ).rowcount
+
+    def workers(self) -> List[dict]:
+        rows = self.db.execute("SELECT id, last_seen FROM broker_workers ORDER BY last_seen DESC").fetchall()
+        return [dict(row) for row in rows]
+
+
+BACKENDS = {
+    "sqlite": lambda url, **kwargs: SQLiteBroker(url.path, **kwargs),
+}
+
+
+def get_broker(url: str, **kwargs) -> Broker:
+    """
+    Create broker by url, e.g. sqlite:////var/lib/mapoc/broker.sqlite3
+    """
+    parsed = urlparse(url)
+    try:
+        backend = BACKENDS[parsed.scheme]
+    except KeyError:
+        raise ValueError(f"Unknown broker backend {parsed.scheme!r}. Expected one of {list(BACKENDS)}")
+    return backend(parsed, **kwargs)
@@ -0,0 +1,220 @@
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from app.config import CATALOG_DB_PATH, FILES_PATH
+
+logger = logging.getLogger("services - catalog")
+
+# cached query results, the cache is dropped when full
+MAX_CACHED = 4096
+# sorts after any character of a search key, so [prefix, prefix + MAX_CHAR) is a range of the index
+MAX_CHAR = "\U0010ffff"
+
+# what the bot offered before the catalog existed, added to a new catalog
+SEED_CITIES = {
+    "St. Petersburg": "shp/northwestern-fed-district-latest-free.shp",
+    "Moscow": "shp/central-fed-district-latest-free.shp",
+    "Grozniy": "shp/north-caucasus-fed-district-latest-free.shp",
+    "Tokyo": "shp/kanto-latest-free.shp",
+}
+SEED_COLOR_SCHEMES = ["black", "white", "coral", "black&red", "blood&milk"]
+
+
+def search_key(name: str) -> str:
+    return " ".join(name.casefold().split())
+
+
+def read_bbox(geojson) -> Optional[tuple]:
+    from app.services.extracts import get_geojson_bbox
+
+    try:
+        return get_geojson_bbox(geojson)
+    except (OSError, ValueError) as e:
+        logger.warning(f"No bbox from {geojson}: {e}")
+        return None
+
+
+def _relative(path) -> Optional[str]:
+    if path is None:
+        return None
+    path = Path(path)
+    try:
+        return str(path.resolve().relative_to(FILES_PATH.resolve()))
+    except ValueError:
+        return str(path)
+
+
+class Catalog:
+    """
+    SQLite catalog of cities with their data paths and bboxes, and of color schemes.
+    Cities are searched by name prefix through an index on the case folded name and paged with it.
+    Query results are cached in memory until the database changes, in this process or another one.
+    """
+    def __init__(self, path):
+        self.pid = os.getpid()
+        self._cache = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cities ("
+            "name TEXT PRIMARY KEY, "
+            "search_key TEXT NOT NULL, "
+            # paths relative to FILES_PATH, null for the default ones
+            "region_shp TEXT, "
+            "geojson TEXT, "
+            "img TEXT, "
+            "xmin REAL, ymin REAL, xmax REAL, ymax REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS cities_search_key ON cities (search_key, name)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS color_schemes ("
+            "name TEXT PRIMARY KEY, "
+            "position INTEGER NOT NULL)"
+        )
+        self.db.commit()
+        if self.db.execute("SELECT NOT EXISTS (SELECT 1 FROM cities)").fetchone()[0]:
+            self.seed()
+        self._data_version = self._get_data_version()
+
+    def seed(self):
+        for name, region_shp in SEED_CITIES.items():
+            bbox = read_bbox(FILES_PATH / "geojson" / (name + ".geojson"))
+            self.add_city(name, FILES_PATH / region_shp, bbox=bbox)
+        for name in SEED_COLOR_SCHEMES:
+            self.add_color_scheme(name)
+        logger.info("Catalog seeded with default cities and color schemes")
+
+    def _get_data_version(self) -> int:
+        # changes only when another connection commits
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _query(self, key: tuple, sql: str, params: tuple) -> list:
+        with self._lock:
+            data_version = self._get_data_version()
+            if data_version != self._data_version:
+                self._cache.clear()
+                self._data_version = data_version
+            if key not in self._cache:
+                if len(self._cache) >= MAX_CACHED:
+                    self._cache.clear()
+                self._cache[key] = [dict(row) for row in self.db.execute(sql, params)]
+            return self._cache[key]
+
+    def _write(self, sql: str, params: tuple):
+        with self._lock:
+            with self.db:
+                self.db.execute(sql, params)
+            self._cache.clear()
+
+    def search_cities(self, prefix: str = "", offset: int = 0, limit: int = None) -> Tuple[List[str], int]:
+        """
+        Names of cities starting with prefix in alphabetical order, at most limit from offset, and their total count.
+        """
+        low = search_key(prefix)
+        high = low + MAX_CHAR
+        rows = self._query(
+            ("search", low, offset, limit),
+            "SELECT name FROM cities WHERE search_key >= ? AND search_key < ? "
+            "ORDER BY search_key, name LIMIT ? OFFSET ?",
+            (low, high, -1 if limit is None else limit, offset),
+        )
+        total = self._query(
+            ("count", low),
+            "SELECT COUNT(*) AS total FROM cities WHERE search_key >= ? AND search_key < ?",
+            (low, high),
+        )[0]["total"]
+        return [row["name"] for row in rows], total
+
+    def get_city(self, name: str) -> Optional[dict]:
+        rows = self._query(("city", name), "SELECT * FROM cities WHERE name = ?", (name,))
+        return rows[0] if rows else None
+
+    def get_city_path(self, name: str, kind: str, default: Path) -> Path:
+        """
+        Stored region_shp, geojson or img path of the city, `default` if there is none.
+        """
+        city = self.get_city(name)
+        if city is None or not city[kind]:
+            return default
+        return FILES_PATH / city[kind]
+
+    def get_color_schemes(self) -> List[str]:
+        rows = self._query(("colors",), "SELECT name FROM color_schemes ORDER BY position, name", ())
+        return [row["name"] for row in rows]
+
+    def add_city(self, name: str, region_shp, geojson=None, img=None, bbox: tuple = None):
+        """
+        Add or replace a city, paths default to geojson/<name>.geojson and img/<name>.png in FILES_PATH.
+        """
+        xmin, ymin, xmax, ymax = bbox or (None, None, None, None)
+        self._write(
+            "INSERT OR REPLACE INTO cities (name, search_key, region_shp, geojson, img, xmin, ymin, xmax, ymax) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, search_key(name), _relative(region_shp), _relative(geojson), _relative(img), xmin, ymin, xmax, ymax),
+        )
+
+    def remove_city(self, name: str):
+        self._write("DELETE FROM cities WHERE name = ?", (name,))
+
+    def add_color_scheme(self, name: str, position: int = None):
+        if position is None:
+            position = self.db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM color_schemes").fetchone()[0]
+        self._write("INSERT OR REPLACE INTO color_schemes (name, position) VALUES (?, ?)", (name, position))
+
+    def remove_color_scheme(self, name: str):
+        self._write("DELETE FROM color_schemes WHERE name = ?", (name,))
+
+
+_catalog: Optional[Catalog] = None
+
+
+def get_catalog() -> Catalog:
+    global _catalog
+    # sqlite connections don't survive fork, pool workers open their own
+    if _catalog is None or _catalog.pid != os.getpid():
+        _catalog = Catalog(CATALOG_DB_PATH)
+    return _catalog
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the catalog of cities and color schemes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add_city = commands.add_parser("add-city", help="add or replace a city, its bbox is read from the geojson")
+    add_city.add_argument("name")
+    add_city.add_argument("region_shp", help="regional shapefile the city is rendered from")
+    add_city.add_argument("--geojson")
+    add_city.add_argument("--img")
+    commands.add_parser("remove-city").add_argument("name")
+    commands.add_parser("add-color").add_argument("name")
+    commands.add_parser("remove-color").add_argument("name")
+    commands.add_parser("list")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    catalog = get_catalog()
+    if args.command == "add-city":
+        geojson = args.geojson or FILES_PATH / "geojson" / (args.name + ".geojson")
+        catalog.add_city(args.name, args.region_shp, args.geojson, args.img, read_bbox(geojson))
+    elif args.command == "remove-city":
+        catalog.remove_city(args.name)
+    elif args.command == "add-color":
+        catalog.add_color_scheme(args.name)
+    elif args.command == "remove-color":
+        catalog.remove_color_scheme(args.name)
+    else:
+        cities, total = catalog.search_cities()
+        print(f"{total} cities: {', '.join(cities)}")
+        print(f"Color schemes: {', '.join(catalog.get_color_schemes())}")
+
+
+if __name__ == "__main__":
+    main()
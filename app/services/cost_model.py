@@ -0,0 +1,123 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from app.services.extracts import get_layers, get_geojson_bbox
+
+logger = logging.getLogger("services - cost_model")
+
+# samples the model is fitted on, older ones are ignored
+MAX_SAMPLES = 2000
+
+
+def render_features(shp, geojson_path) -> dict:
+    """
+    What the render cost depends on: size of the shapefile data and area of the geojson bbox.
+    """
+    shp = Path(shp)
+    shp_bytes = sum(
+        os.stat(fp).st_size
+        for layer in get_layers(shp)
+        for fp in layer.parent.glob(layer.stem + ".*")
+    )
+    xmin, ymin, xmax, ymax = get_geojson_bbox(geojson_path)
+    # square degrees shrink towards the poles
+    bbox_area = (xmax - xmin) * (ymax - ymin) * math.cos(math.radians((ymin + ymax) / 2))
+    return {"shp_bytes": shp_bytes, "bbox_area": bbox_area}
+
+
+class CostModel:
+    """
+    Log-linear model of render wall time and peak RSS fitted on recorded renders:
+    log(cost) ~ log(shp_bytes) + log(bbox_area) + n_colors + per color scheme offset.
+    Predicts the defaults until min_samples renders are recorded.
+    Renders are recorded and the model refitted in threads, predictions on the event loop
+    see either the old or the new fit as a whole.
+    """
+    def __init__(self, path, default_seconds: float, default_rss: int, min_samples=10):
+        self.default_seconds = default_seconds
+        self.default_rss = default_rss
+        self.min_samples = min_samples
+        # (color schemes with an offset, coefficients) or None
+        self.fitted = None
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS render_stats ("
+            "id INTEGER PRIMARY KEY, "
+            "created REAL NOT NULL, "
+            "shp_bytes INTEGER NOT NULL, "
+            "bbox_area REAL NOT NULL, "
+            "colors TEXT NOT NULL, "
+            "n_colors INTEGER NOT NULL, "
+            "wall REAL NOT NULL, "
+            "peak_rss INTEGER NOT NULL)"
+        )
+        self.db.commit()
+        self.fit()
+
+    @staticmethod
+    def _row(features: dict, colors: str, n_colors: int, known_colors: list) -> list:
+        row = [
+            1.0,
+            math.log(max(features["shp_bytes"], 1)),
+            math.log(max(features["bbox_area"], 1e-9)),
+            float(n_colors),
+        ]
+        return row + [1.0 if colors == c else 0.0 for c in known_colors]
+
+    def record(self, features: dict, colors: str, n_colors: int, wall: float, peak_rss: int):
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO render_stats (created, shp_bytes, bbox_area, colors, n_colors, wall, peak_rss) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), features["shp_bytes"], features["bbox_area"], colors, n_colors, wall, peak_rss),
+            )
+            self.db.commit()
+        self.fit()
+
+    def fit(self):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT shp_bytes, bbox_area, colors, n_colors, wall, peak_rss FROM render_stats "
+                "WHERE wall > 0 AND peak_rss > 0 ORDER BY id DESC LIMIT ?",
+                (MAX_SAMPLES,),
+            ).fetchall()
+        if len(rows) < self.min_samples:
+            self.fitted = None
+            return
+
+        known_colors = sorted({r[2] for r in rows})
+        x = np.array([
+            self._row({"shp_bytes": r[0], "bbox_area": r[1]}, r[2], r[3], known_colors)
+            for r in rows
+        ])
+        y = np.log(np.array([[r[4], r[5]] for r in rows], dtype=np.float64))
+        coef, *_ = np.linalg.lstsq(x, y, rcond=None)
+        # published in one assignment, predict never sees colors of one fit with coefficients of another
+        self.fitted = (known_colors, coef)
+        logger.info(f"Render cost model fitted on {len(rows)} renders")
+
+    def predict(self, features: Optional[dict], colors: str, n_colors=1) -> tuple:
+        """
+        Predicted (wall seconds, peak RSS bytes) of a render.
+        """
+        fitted = self.fitted
+        if fitted is None or features is None:
+            return self.default_seconds, self.default_rss
+        known_colors, coef = fitted
+        log_wall, log_rss = np.array(self._row(features, colors, n_colors, known_colors)) @ coef
+        return float(math.exp(log_wall)), int(math.exp(log_rss))
+
+    def close(self):
+        with self._lock:
+            self.db.close()
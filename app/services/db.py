@@ -1,29 +1,38 @@
-from typing import List
+from typing import List, Tuple
 from pathlib import Path
 
 from app.config import FILES_PATH
+from app.services.catalog import get_catalog
+from app.services.extracts import get_extract_shp
 
 
-# TODO: implement db
-db = {
-    "St. Petersburg": {
+def get_cities_list(pagination: Tuple[int, int] = None) -> List[str]:
+    """
+    All cities in alphabetical order, or one page of them if pagination is (page, page_size).
+    """
+    if pagination is None:
+        return get_catalog().search_cities()[0]
+    page, page_size = pagination
+    return get_catalog().search_cities(offset=page * page_size, limit=page_size)[0]
 
-    }
-}
 
+def search_cities(prefix: str, page: int, page_size: int) -> Tuple[List[str], int]:
+    """
+    A page of cities starting with prefix and the number of such cities.
+    """
+    return get_catalog().search_cities(prefix, offset=page * page_size, limit=page_size)
 
-def get_cities_list(pagination=None) -> List[str]:
-    return ["St. Petersburg", "Moscow", "Grozniy", "Tokyo"]
+
+def get_region_shp_path(city_name: str) -> Path:
+    city = get_catalog().get_city(city_name)
+    if city is None or not city["region_shp"]:
+        raise KeyError(city_name)
+    return FILES_PATH / city["region_shp"]
 
 
 def get_shp_path(city_name: str) -> Path:
-    d = {
-        "St. Petersburg": FILES_PATH / "shp" / "northwestern-fed-district-latest-free.shp",
-        "Grozniy": FILES_PATH / "shp" / "north-caucasus-fed-district-latest-free.shp",
-        "Moscow": FILES_PATH / "shp" / "central-fed-district-latest-free.shp",
-        "Tokyo": FILES_PATH / "shp" / "kanto-latest-free.shp",
-    }
-    return d[city_name]
+    return get_extract_shp(city_name, get_region_shp_path(city_name))
+
 
 def get_color_schemes() -> List[str]:
-    return ["black", "white", "coral", "black&red", "blood&milk"]
+    return get_catalog().get_color_schemes()
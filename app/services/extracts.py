@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from typing import Optional
+
+from app.config import FILES_PATH, EXTRACTS_PATH, EXTRACT_MARGIN_DEG, EXTRACT_CHECK_INTERVAL
+from app.services.catalog import get_catalog
+
+logger = logging.getLogger("services - extracts")
+
+MANIFEST = "manifest.json"
+
+# (city, source) -> (monotonic time of the check, shapefile to render from)
+_checked = {}
+
+
+def get_city_geojson_path(city_name: str) -> Path:
+    default = FILES_PATH / "geojson" / (city_name + ".geojson")
+    return get_catalog().get_city_path(city_name, "geojson", default)
+
+
+def get_extract_path(city_name: str) -> Path:
+    return EXTRACTS_PATH / "".join(c if c.isalnum() else "_" for c in city_name)
+
+
+def get_layers(shp: Path) -> list:
+    """
+    Geofabrik shapefiles are directories with a shapefile per layer.
+    """
+    if shp.is_dir():
+        return sorted(shp.glob("*.shp"))
+    return [shp]
+
+
+def get_source_mtime(shp: Path) -> int:
+    return max(
+        os.stat(fp).st_mtime_ns
+        for layer in get_layers(shp)
+        for fp in layer.parent.glob(layer.stem + ".*")
+    )
+
+
+def _iter_positions(coords):
+    if coords and isinstance(coords[0], (int, float)):
+        yield coords
+        return
+    for c in coords:
+        yield from _iter_positions(c)
+
+
+def get_geojson_bbox(geojson_path: Path) -> tuple:
+    with open(geojson_path) as gjf:
+        geojson = json.load(gjf)
+
+    features = geojson.get("features") or [geojson]
+    positions = [
+        p
+        for f in features
+        for p in _iter_positions((f.get("geometry") or f).get("coordinates", []))
+    ]
+    if not positions:
+        raise ValueError(f"No coordinates in {geojson_path}")
+
+    xs = [p[0] for p in positions]
+    ys = [p[1] for p in positions]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def make_manifest(city_name: str, source: Path, margin: float) -> dict:
+    geojson_path = get_city_geojson_path(city_name)
+    return {
+        "source": str(source),
+        "source_mtime": get_source_mtime(source),
+        "geojson_mtime": os.stat(geojson_path).st_mtime_ns,
+        "margin": margin,
+    }
+
+
+def read_manifest(extract: Path) -> Optional[dict]:
+    try:
+        with open(extract / MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(city_name: str, source: Path, margin=EXTRACT_MARGIN_DEG) -> bool:
+    manifest = read_manifest(get_extract_path(city_name))
+    if manifest is None:
+        return False
+    try:
+        return manifest == make_manifest(city_name, source, margin)
+    except (OSError, ValueError):
+        return False
+
+
+def build_extract(city_name: str, source: Path, margin=EXTRACT_MARGIN_DEG) -> Path:
+    """
+    Clip every layer of the regional shapefile to the city geojson bbox plus margin with ogr2ogr.
+    The extract is built next to the old one and swapped in when complete.
+    """
+    extract = get_extract_path(city_name)
+    tmp_extract = extract.with_name(extract.name + ".tmp")
+    shutil.rmtree(tmp_extract, ignore_errors=True)
+    tmp_extract.mkdir(parents=True)
+
+    manifest = make_manifest(city_name, source, margin)
+    xmin, ymin, xmax, ymax = get_geojson_bbox(get_city_geojson_path(city_name))
+    bbox = [str(v) for v in (xmin - margin, ymin - margin, xmax + margin, ymax + margin)]
+
+    for layer in get_layers(source):
+        subprocess.run(
+            [
+                "ogr2ogr", "-f", "ESRI Shapefile",
+                "-spat", *bbox,
+                "-clipsrc", *bbox,
+                str(tmp_extract / layer.name), str(layer),
+            ],
+            check=True,
+        )
+
+    with open(tmp_extract / MANIFEST, "w") as f:
+        json.dump(manifest, f)
+
+    old_extract = extract.with_name(extract.name + ".old")
+    if extract.exists():
+        extract.rename(old_extract)
+    tmp_extract.rename(extract)
+    shutil.rmtree(old_extract, ignore_errors=True)
+    return extract
+
+
+def get_extract_shp(city_name: str, source: Path) -> Path:
+    """
+    Path of the city extract if it is up to date, the regional shapefile otherwise.
+    The answer is reused for EXTRACT_CHECK_INTERVAL seconds, the check stats every source file.
+    Extracts are built with `python -m app.services.extracts [--force] [city ...]`.
+    """
+    checked = _checked.get((city_name, source))
+    if checked is not None and time.monotonic() - checked[0] < EXTRACT_CHECK_INTERVAL:
+        return checked[1]
+
+    if is_fresh(city_name, source):
+        extract = get_extract_path(city_name)
+        shp = extract if source.is_dir() else extract / source.name
+    else:
+        logger.info(f"No up to date extract for {city_name}, using {source}")
+        shp = source
+    _checked[(city_name, source)] = (time.monotonic(), shp)
+    return shp
+
+
+def get_shp_version(shp) -> str:
+    """
+    Changes when the data of the shapefile does: hash of the manifest of an extract,
+    modification time of a regional shapefile.
+    """
+    shp = Path(shp)
+    for directory in (shp, shp.parent):
+        manifest = read_manifest(directory)
+        if manifest is not None:
+            return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    return str(get_source_mtime(shp))
+
+
+def build_stale(cities: list, force=False):
+    from app.services import db
+
+    for city_name in cities:
+        source = db.get_region_shp_path(city_name)
+        if not force and is_fresh(city_name, source):
+            logger.info(f"Extract of {city_name} is up to date")
+            continue
+        logger.info(f"Building extract of {city_name} from {source}")
+        build_extract(city_name, source)
+
+
+def main():
+    from app.services import db
+
+    parser = argparse.ArgumentParser(description="Build per-city shapefile extracts")
+    parser.add_argument("cities", nargs="*", help="cities to build, all by default")
+    parser.add_argument("--force", action="store_true", help="rebuild up to date extracts too")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_stale(args.cities or db.get_cities_list(), force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import asyncio
+import concurrent.futures
+import copy
+import json
+import logging
+import os
+import sqlite3
+import time
+import typing
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+from app.config import FSM_STORAGE, FSM_DB_PATH, FSM_REDIS_URL, FSM_TTL, FSM_CACHE_SIZE
+
+logger = logging.getLogger("services - fsm_storage")
+
+# seconds between deletions of expired records
+SWEEP_INTERVAL = 60
+
+
+def _empty() -> dict:
+    return {"state": None, "data": {}, "bucket": {}, "updated": 0.0}
+
+
+def _is_empty(record: dict) -> bool:
+    return record["state"] is None and not record["data"] and not record["bucket"]
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM and dialog storage in SQLite, survives restarts and is shared by bot processes on one host.
+    Changes are kept in memory and written in one transaction every flush_interval seconds,
+    recently used records are cached. Other processes' writes are seen within flush_interval:
+    the cache is dropped when the database changes under it.
+    Writes are behind and the last flushed record wins, so a chat is meant to be handled by one
+    process at a time. Any commit of another process drops every cached record, several busy
+    writers on one file mostly read from the database.
+    Data and buckets must be JSON serializable, anything else raises when set.
+    Records not changed for ttl seconds are expired, so abandoned dialogs don't pile up.
+    """
+    def __init__(self, path, ttl: float = None, max_cached=10000, flush_interval=0.5):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        # (chat, user) -> record, the most recently used last
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._flush_task = None
+        self._last_sweep = time.time()
+        # sqlite connection is used from this thread only
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="fsm_storage")
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "chat TEXT NOT NULL, "
+            "user TEXT NOT NULL, "
+            "state TEXT, "
+            "data TEXT NOT NULL, "
+            "bucket TEXT NOT NULL, "
+            "updated REAL NOT NULL, "
+            "PRIMARY KEY (chat, user))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS fsm_updated ON fsm (updated)")
+        self.db.commit()
+        self._data_version = self._get_data_version()
+
+    async def _call(self, method, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, method, *args)
+
+    def _expired(self, record: dict) -> bool:
+        return bool(self.ttl) and record["updated"] < time.time() - self.ttl
+
+    def _read(self, key: tuple) -> dict:
+        row = self.db.execute(
+            "SELECT state, data, bucket, updated FROM fsm WHERE chat = ? AND user = ?", key,
+        ).fetchone()
+        if row is None:
+            return _empty()
+        state, data, bucket, updated = row
+        return {"state": state, "data": json.loads(data), "bucket": json.loads(bucket), "updated": updated}
+
+    async def _get(self, chat, user) -> tuple:
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(self._flush_loop())
+
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self._cache.get(key)
+        if record is None:
+            record = await self._call(self._read, key)
+            # a write may have cached the record while reading
+            record = self._cache.setdefault(key, record)
+        self._cache.move_to_end(key)
+        if self._expired(record) and not _is_empty(record):
+            self._changed(key, record, **_empty())
+        self._evict()
+        return key, record
+
+    def _changed(self, key: tuple, record: dict, **fields):
+        # encoded before anything changes, so a value JSON can't store leaves the record as it was
+        data = fields.get("data", record["data"])
+        bucket = fields.get("bucket", record["bucket"])
+        record.update(fields, encoded=(json.dumps(data), json.dumps(bucket)), updated=time.time())
+        self._cache[key] = record
+        self._dirty.add(key)
+
+    def _evict(self):
+        # unwritten records stay until the next flush
+        while len(self._cache) > self.max_cached:
+            for key in self._cache:
+                if key not in self._dirty:
+                    del self._cache[key]
+                    break
+            else:
+                return
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        pending = {key: self._cache[key] for key in self._dirty}
+        rows = [
+            (*key, record["state"], *record["encoded"], record["updated"], _is_empty(record))
+            for key, record in pending.items()
+        ]
+        self._dirty = set()
+        try:
+            await self._call(self._write, rows)
+        except Exception:
+            # the unwritten records may have been evicted or re-read meanwhile, records changed since are newer
+            for key, record in pending.items():
+                if key not in self._dirty:
+                    self._cache[key] = record
+                    self._dirty.add(key)
+            raise
+
+    def _write(self, rows: list):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO fsm (chat, user, state, data, bucket, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                [row[:-1] for row in rows if not row[-1]],
+            )
+            self.db.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", [row[:2] for row in rows if row[-1]])
+
+    def _sweep(self, before: float) -> int:
+        with self.db:
+            return self.db.execute("DELETE FROM fsm WHERE updated < ?", (before,)).rowcount
+
+    def _get_data_version(self) -> int:
+        # changes only when another connection commits
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                data_version = await self._call(self._get_data_version)
+                if data_version != self._data_version:
+                    for key in [k for k in self._cache if k not in self._dirty]:
+                        del self._cache[key]
+                self._data_version = data_version
+                self._evict()
+
+                if self.ttl and time.time() - self._last_sweep > SWEEP_INTERVAL:
+                    self._last_sweep = time.time()
+                    removed = await self._call(self._sweep, self._last_sweep - self.ttl)
+                    if removed:
+                        logger.info(f"Removed {removed} expired FSM records")
+            except Exception as e:
+                logger.exception(e)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        await self._call(self.db.close)
+        self._executor.shutdown()
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._get(chat, user)
+        return record["state"] if record["state"] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record["data"] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._get(chat, user)
+        self._changed(key, record, state=self.resolve_state(state))
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        self._changed(key, record, data=copy.deepcopy(data or {}))
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, record = await self._get(chat, user)
+        self._changed(key, record, data={**record["data"], **copy.deepcopy(data or {}), **kwargs})
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record["bucket"] or default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        self._changed(key, record, bucket=copy.deepcopy(bucket or {}))
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, record = await self._get(chat, user)
+        self._changed(key, record, bucket={**record["bucket"], **copy.deepcopy(bucket or {}), **kwargs})
+
+
+def get_storage(backend: str = FSM_STORAGE) -> BaseStorage:
+    """
+    FSM storage configured by FSM_STORAGE: "sqlite", "redis" (any server speaking the Redis protocol)
+    or "memory" (lost on restart, single process only).
+    """
+    if backend == "sqlite":
+        return SQLiteStorage(FSM_DB_PATH, ttl=FSM_TTL or None, max_cached=FSM_CACHE_SIZE)
+    if backend == "redis":
+        # needs aioredis
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+
+        url = urlparse(FSM_REDIS_URL)
+        ttl = FSM_TTL or None
+        return RedisStorage2(
+            host=url.hostname or "localhost",
+            port=url.port or 6379,
+            db=int(url.path.lstrip("/") or 0),
+            password=url.password,
+            ssl=url.scheme == "rediss",
+            state_ttl=ttl, data_ttl=ttl, bucket_ttl=ttl,
+        )
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown FSM storage {backend!r}, expected 'sqlite', 'redis' or 'memory'")
@@ -0,0 +1,181 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List
+
+logger = logging.getLogger("services - job_store")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+UNFINISHED = (QUEUED, RUNNING)
+# seconds between deletions of old finished jobs
+PRUNE_INTERVAL = 3600
+
+COLUMNS = (
+    "id", "state", "user_id", "command", "geojson", "output_filename", "caption",
+    "cache_key", "delete_geojson", "created", "updated", "started", "finished",
+    "shp", "colors", "prefix", "city", "area_rect", "batch_key", "features", "attempts",
+)
+
+
+class JobStore:
+    """
+    SQLite backed store of render jobs.
+    Changes are kept in memory and written in one transaction every flush_interval seconds,
+    so enqueueing many jobs at once doesn't cost a sync per job.
+    Rows which fail to be written are kept and written with the next flush.
+    `on_finished` is called with a job when it becomes done or failed.
+    Finished jobs are deleted `retention` seconds after they finished, None keeps them.
+    """
+    def __init__(self, path, flush_interval=0.5, on_finished=None, retention: float = None):
+        self.path = str(path)
+        self.flush_interval = flush_interval
+        self.on_finished = on_finished
+        self.retention = retention
+        self._dirty = {}
+        self._flush_task = None
+        self._last_prune = 0.0
+        # writes go through this thread, startup reads are made on the event loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="job_store")
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # WAL with NORMAL sync is durable against process crashes, fsync happens on checkpoints
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, "
+            "state TEXT NOT NULL, "
+            "user_id INTEGER NOT NULL, "
+            "command TEXT NOT NULL, "
+            "geojson TEXT NOT NULL, "
+            "output_filename TEXT NOT NULL, "
+            "caption TEXT, "
+            "cache_key TEXT, "
+            "delete_geojson INTEGER NOT NULL DEFAULT 0, "
+            "created REAL NOT NULL, "
+            "updated REAL NOT NULL, "
+            "started REAL, "
+            "finished REAL, "
+            "shp TEXT NOT NULL, "
+            "colors TEXT NOT NULL, "
+            "prefix TEXT NOT NULL, "
+            "city TEXT, "
+            # json [x0, y0, x1, y1] in fractions of the city image, null for the full city
+            "area_rect TEXT, "
+            # jobs with the same batch key differ only by color scheme
+            "batch_key TEXT, "
+            # json render features for the cost model, see app/services/cost_model.py
+            "features TEXT, "
+            # render runs killed by a signal, null for none
+            "attempts INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)")
+        self.db.commit()
+
+    def start(self):
+        self._flush_task = asyncio.get_event_loop().create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        self._executor.shutdown()
+
+    def add(self, **fields) -> dict:
+        now = time.time()
+        job = {c: None for c in COLUMNS}
+        job.update(fields)
+        job.update(id=uuid.uuid4().hex, state=QUEUED, created=now, updated=now)
+        self._dirty[job["id"]] = job
+        return job
+
+    def update(self, job: dict, **fields):
+        job.update(fields)
+        job["updated"] = time.time()
+        self._dirty[job["id"]] = job
+
+    def set_state(self, job: dict, state: str):
+        finished = state in (DONE, FAILED) and job["state"] in UNFINISHED
+        fields = {"state": state}
+        if state == RUNNING:
+            fields["started"] = time.time()
+        elif state in (DONE, FAILED):
+            fields["finished"] = time.time()
+        self.update(job, **fields)
+        if finished and self.on_finished is not None:
+            self.on_finished(job)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        rows = [tuple(job[c] for c in COLUMNS) for job in dirty.values()]
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._write, rows)
+        except Exception:
+            # jobs changed meanwhile are dirty again anyway, it's the same dict
+            for job_id, job in dirty.items():
+                self._dirty.setdefault(job_id, job)
+            raise
+
+    def _write(self, rows: list):
+        with self._lock, self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows,
+            )
+
+    def _prune(self, before: float) -> int:
+        with self._lock, self.db:
+            return self.db.execute(
+                "DELETE FROM jobs WHERE state IN (?, ?) AND finished < ?", (DONE, FAILED, before),
+            ).rowcount
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if self.retention and time.time() - self._last_prune > PRUNE_INTERVAL:
+                    self._last_prune = time.time()
+                    removed = await asyncio.get_event_loop().run_in_executor(
+                        self._executor, self._prune, self._last_prune - self.retention,
+                    )
+                    if removed:
+                        logger.info(f"Removed {removed} finished jobs")
+            except Exception as e:
+                logger.exception(e)
+
+    def get_unfinished(self) -> List[dict]:
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT * FROM jobs WHERE state IN ({', '.join('?' * len(UNFINISHED))}) ORDER BY created",
+                UNFINISHED,
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_created_since(self, since: float) -> List[tuple]:
+        """
+        (user_id, created) of jobs created since the given time, unwritten ones included.
+        """
+        with self._lock:
+            rows = self.db.execute("SELECT id, user_id, created FROM jobs WHERE created >= ?", (since,)).fetchall()
+        jobs = {row["id"]: (row["user_id"], row["created"]) for row in rows}
+        jobs.update(
+            (job["id"], (job["user_id"], job["created"])) for job in self._dirty.values() if job["created"] >= since
+        )
+        return sorted(jobs.values(), key=lambda j: j[1])
@@ -0,0 +1,113 @@
+import logging
+import time
+from collections import Counter, defaultdict, deque
+from typing import Dict, NamedTuple, Optional
+
+from app.config import USER_TIERS, USER_TIER_MEMBERS
+
+logger = logging.getLogger("services - quotas")
+
+# jobs per day are counted over a sliding window
+DAY = 24 * 3600
+
+
+class Tier(NamedTuple):
+    name: str
+    # share of render time relative to other tiers
+    weight: float
+    # jobs queued or rendering at once, 0 is no limit
+    max_unfinished: int
+    # jobs created per day, 0 is no limit
+    daily: int
+
+
+def parse_tiers(spec: str) -> Dict[str, Tier]:
+    tiers = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, weight, max_unfinished, daily = item.split(":")
+        tiers[name] = Tier(name, float(weight), int(max_unfinished), int(daily))
+    if not tiers:
+        raise ValueError("At least one user tier is required")
+    return tiers
+
+
+def parse_members(spec: str, tiers: Dict[str, Tier]) -> Dict[int, str]:
+    members = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        user_id, tier = item.split(":")
+        if tier not in tiers:
+            raise ValueError(f"Unknown tier {tier!r} of user {user_id}")
+        members[int(user_id)] = tier
+    return members
+
+
+class Quotas:
+    """
+    Per-user limits set by the user's tier: jobs queued or rendering at once and jobs created per day.
+    Unfinished jobs are counted as they are enqueued and finished, daily ones are restored from the job store.
+    """
+    def __init__(self, tiers: Dict[str, Tier], members: Dict[int, str]):
+        self.tiers = tiers
+        self.default = next(iter(tiers.values()))
+        self.members = members
+        self.unfinished = Counter()
+        # user id -> creation times of their jobs within the last day
+        self.created = defaultdict(deque)
+
+    def tier(self, user_id: int) -> Tier:
+        return self.tiers.get(self.members.get(user_id), self.default)
+
+    def weight(self, user_id: int) -> float:
+        return self.tier(user_id).weight
+
+    def restore(self, created: list):
+        """
+        Count (user_id, created) of jobs created within the last day, in order of creation.
+        """
+        for user_id, t in created:
+            self.created[user_id].append(t)
+
+    def used_today(self, user_id: int) -> int:
+        created = self.created.get(user_id)
+        if created is None:
+            return 0
+        now = time.time()
+        while created and created[0] < now - DAY:
+            created.popleft()
+        if not created:
+            del self.created[user_id]
+            return 0
+        return len(created)
+
+    def check(self, user_id: int, jobs: int) -> Optional[str]:
+        """
+        Why the user can't add this many jobs now, None if they can.
+        """
+        tier = self.tier(user_id)
+        if tier.max_unfinished and self.unfinished[user_id] + jobs > tier.max_unfinished:
+            return (
+                f"You have {self.unfinished[user_id]} posters in progress and the limit is {tier.max_unfinished}, "
+                "wait until some of them are done"
+            )
+        used = self.used_today(user_id)
+        if tier.daily and used + jobs > tier.daily:
+            left = tier.daily - used
+            return f"You can create {left if left > 0 else 'no'} more posters today, the limit is {tier.daily} a day"
+        return None
+
+    def added(self, job: dict):
+        self.created[job["user_id"]].append(job["created"])
+
+    def enqueued(self, job: dict):
+        self.unfinished[job["user_id"]] += 1
+
+    def finished(self, job: dict):
+        user_id = job["user_id"]
+        self.unfinished[user_id] -= 1
+        if self.unfinished[user_id] <= 0:
+            del self.unfinished[user_id]
+
+
+def get_quotas() -> Quotas:
+    tiers = parse_tiers(USER_TIERS)
+    return Quotas(tiers, parse_members(USER_TIER_MEMBERS, tiers))
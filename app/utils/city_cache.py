@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from app.config import FILES_PATH, CITY_CACHE_MAX_MB, CITY_CACHE_PREWARM
+from app.services.catalog import get_catalog
+from app.services.extracts import get_city_geojson_path
+from app.utils.image import to_gray, downscale
+
+logger = logging.getLogger("utils - city_cache")
+
+# downscale factor of the coarse level used by get_area_coords_pyramid
+PYRAMID_FACTOR = 4
+# parsed json takes several times more memory than its text
+GEOJSON_SIZE_FACTOR = 8
+
+
+def get_city_img_path(city_name: str):
+    return get_catalog().get_city_path(city_name, "img", FILES_PATH / "img" / (city_name + ".png"))
+
+
+class CityData:
+    """
+    Decoded city raster with its grayscale and downscaled variants and parsed GeoJSON.
+    Treat everything here as read-only: copy before drawing or mutating.
+    """
+    def __init__(self, image: np.ndarray, geojson: dict, geojson_size: int, mtimes: tuple):
+        from app.utils.coords import get_polygons_from_gj, get_bounds
+
+        self.image = image
+        self.gray = to_gray(image)
+        self.gray_small = downscale(self.gray, PYRAMID_FACTOR)
+        self.geojson = geojson
+        self.features = get_polygons_from_gj(geojson)
+        self.bounds = get_bounds(self.features)
+        self.mtimes = mtimes
+        self.nbytes = (
+            self.image.nbytes + self.gray.nbytes + self.gray_small.nbytes
+            + geojson_size * GEOJSON_SIZE_FACTOR
+            + sum(ring.nbytes for _, polygons in self.features for polygon in polygons for ring in polygon)
+        )
+
+
+def get_mtimes(city_name: str) -> tuple:
+    return (
+        os.stat(get_city_img_path(city_name)).st_mtime_ns,
+        os.stat(get_city_geojson_path(city_name)).st_mtime_ns,
+    )
+
+
+def load_city(city_name: str, mtimes: tuple) -> CityData:
+    img_path = get_city_img_path(city_name)
+    image = cv2.imread(str(img_path), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Can't read city image {img_path}")
+
+    geojson_path = get_city_geojson_path(city_name)
+    with open(geojson_path) as gjf:
+        geojson = json.load(gjf)
+
+    return CityData(image, geojson, os.path.getsize(geojson_path), mtimes)
+
+
+class CityCache:
+    """
+    Process-local LRU cache of CityData limited by memory budget.
+    Entries are reloaded when the image or GeoJSON file mtime changes.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, city_name: str) -> CityData:
+        mtimes = get_mtimes(city_name)
+        entry = self._entries.get(city_name)
+        if entry is not None and entry.mtimes == mtimes:
+            self._entries.move_to_end(city_name)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        if entry is not None:
+            self._remove(city_name)
+
+        entry = load_city(city_name, mtimes)
+        self._entries[city_name] = entry
+        self.size += entry.nbytes
+        self._evict()
+        return entry
+
+    def _remove(self, city_name: str):
+        entry = self._entries.pop(city_name)
+        self.size -= entry.nbytes
+
+    def _evict(self):
+        # the most recent entry is kept even if it alone exceeds the budget
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            city_name = next(iter(self._entries))
+            logger.info(f"Evicting {city_name} from city cache")
+            self._remove(city_name)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+city_cache = CityCache(CITY_CACHE_MAX_MB * 1024 * 1024)
+
+
+def get_prewarm_cities() -> list:
+    if CITY_CACHE_PREWARM == "all":
+        from app.services import db
+        return db.get_cities_list()
+    return [c.strip() for c in CITY_CACHE_PREWARM.split(",") if c.strip()]
+
+
+def prewarm():
+    """
+    Process pool initializer: load configured cities into this worker's cache.
+    """
+    for city_name in get_prewarm_cities():
+        try:
+            city_cache.get(city_name)
+        except Exception as e:
+            logger.error(f"Can't prewarm {city_name}: {e}")
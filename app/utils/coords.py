@@ -1,24 +1,25 @@
 import cv2
 import numpy as np
-import io
-import json
-from tempfile import NamedTemporaryFile
-from decimal import *
 from numba import njit
 
-from app.config import FILES_PATH, TMP_PATH
+from app.config import AREA_MATCHER, CITY_IMG_PROJECTION
+from app.logs import log_processing
+from app.utils.city_cache import city_cache
+from app.utils.image import to_gray, downscale
+from app.utils.shm import SharedBuffer, ShmRef
+from app.utils.workspace import get_workspace
 
 import logging
 
 logger = logging.getLogger("utils - coords")
 
 
-@njit
+@njit(cache=True)
 def filter_scale(s, c_shape, a_shape):
     return s < c_shape[0]/a_shape[0] and s < c_shape[1]/a_shape[1]
 
 
-@njit
+@njit(cache=True)
 def get_scales(c_shape, a_shape, n=50):
     arr = np.linspace(0.2, 1.0, n)
 
@@ -36,6 +37,15 @@ def get_scales(c_shape, a_shape, n=50):
     return result
 
 
+def warm_up():
+    """
+    Compile (or load from the numba cache) kernels for gray and color shapes,
+    so the first area request of a pool worker doesn't pay for it.
+    """
+    get_scales((100, 100), (10, 10), 50)
+    get_scales((100, 100, 3), (10, 10, 3), 50)
+
+
 def find_template(city, resized, method=cv2.TM_CCOEFF_NORMED):
     res = cv2.matchTemplate(city, resized, method)
     _, max_val, _, max_loc = cv2.minMaxLoc(res)
@@ -66,10 +76,81 @@ def get_area_coords_fast(city: np.ndarray, area: np.ndarray, n=50) -> tuple:
     )
     best_match = matches[matches.argmax(axis=0)[0]]
 
+    confidence = best_match[0]
     top_left = best_match[1:3]
     bottom_right = best_match[3:5]
 
-    return tuple(top_left), tuple(bottom_right)
+    return tuple(top_left), tuple(bottom_right), confidence
+
+
+def get_area_coords_pyramid(city: np.ndarray, area: np.ndarray, n=50, factor=4,
+                            refine_steps=5, min_template=8, city_small: np.ndarray = None) -> tuple:
+    """
+    Coarse-to-fine version of get_area_coords_fast.
+    Scale and position are searched on copies of both images downscaled by `factor`,
+    then only a narrow scale window around the best coarse scale is matched
+    at full resolution inside a small ROI around the coarse position.
+    `city_small` is an optional precomputed grayscale city downscaled by `factor`.
+    """
+    city_gray = to_gray(city)
+    area_gray = to_gray(area)
+    area_height, area_width = area_gray.shape[:2]
+
+    if city_small is not None:
+        factor = city_gray.shape[1] // city_small.shape[1]
+    else:
+        # don't let the coarse level shrink templates below min_template
+        factor = max(1, min(factor, min(area_height, area_width) // (min_template * 2)))
+        city_small = downscale(city_gray, factor)
+    area_small = downscale(area_gray, factor)
+
+    scales_arr = get_scales(city_gray.shape, area_gray.shape, n)
+    if scales_arr.size == 0:
+        raise ValueError("Area image is bigger than the city image")
+
+    best_val, best_scale, best_loc = -1.0, None, None
+    for scale in scales_arr:
+        w, h = int(area_small.shape[1] * scale), int(area_small.shape[0] * scale)
+        if min(w, h) < min_template or w >= city_small.shape[1] or h >= city_small.shape[0]:
+            continue
+        max_val, x, y, *_ = find_template(city_small, cv2.resize(area_small, (w, h), interpolation=cv2.INTER_AREA))
+        if max_val > best_val:
+            best_val, best_scale, best_loc = max_val, scale, (x, y)
+
+    if best_scale is None:
+        raise ValueError("Area image is too small to be matched")
+
+    # refine: narrow scale window around the coarse scale, ROI around the coarse position
+    step = (scales_arr[-1] - scales_arr[0]) / max(1, n - 1) if scales_arr.size > 1 else 0.0
+    fine_scales = np.linspace(max(best_scale - step, 0.05), best_scale + step, refine_steps)
+
+    margin = factor * 2
+    max_w = int(area_width * fine_scales[-1])
+    max_h = int(area_height * fine_scales[-1])
+    x0 = max(0, best_loc[0] * factor - margin)
+    y0 = max(0, best_loc[1] * factor - margin)
+    x1 = min(city_gray.shape[1], best_loc[0] * factor + max_w + margin)
+    y1 = min(city_gray.shape[0], best_loc[1] * factor + max_h + margin)
+    roi = city_gray[y0:y1, x0:x1]
+
+    best = None
+    for scale in fine_scales:
+        w, h = int(area_width * scale), int(area_height * scale)
+        if w > roi.shape[1] or h > roi.shape[0]:
+            continue
+        match = find_template(roi, cv2.resize(area_gray, (w, h)))
+        if best is None or match[0] > best[0]:
+            best = match
+
+    if best is None:
+        return (
+            (best_loc[0] * factor, best_loc[1] * factor),
+            (best_loc[0] * factor + max_w, best_loc[1] * factor + max_h),
+            best_val,
+        )
+
+    confidence, left, top, right, bottom = best
+    return (x0 + left, y0 + top), (x0 + right, y0 + bottom), confidence
 
 
 def get_area_coords(city: np.ndarray, area: np.ndarray, n=50) -> tuple:
@@ -97,95 +178,228 @@ def get_area_coords(city: np.ndarray, area: np.ndarray, n=50) -> tuple:
 
     bottom_right = (top_left[0] + res_shape[1], top_left[1] + res_shape[0])
 
-    return top_left, bottom_right
-
-
-def get_polygon_coords_from_gj(geojson: dict) -> list:
-    features: list = geojson.get("features")
-
-    if not features:
-        raise ValueError(f"Features not found in GeoJSON")
-
-    if len(features) > 1:
-        logger.warning(f"Found {len(features)} features. Be use first")
-
-    first_feature = features[0]
-    if not first_feature.get("type") == "Feature":
-        raise ValueError(f"Invalid feature type {first_feature.get('type')}. Expected 'Feature'")
-
-    geometry: dict = first_feature.get("geometry")
-    if not geometry.get('type') == "Polygon":
-        raise ValueError(f"Invalid geometry type {first_feature.get('type')}. Expected 'Polygon'")
-
-    coordinates: list = geometry.get("coordinates")
-    if not coordinates:
-        raise ValueError(f"Coordinates not found. Check GeoJSON")
-
-    if len(coordinates) > 1:
-        logger.warning(f"Found {len(coordinates)} polygons. Be use first")
-
-    first_coords, *_ = coordinates
-    return first_coords
-
-
-def get_area_polygon_coords(cf: list, city_w_h: tuple, area_coords: tuple) -> list:
-    # floats to Decimal
-    c = [list(map(Decimal, n)) for n in cf]
-    w, h = list(map(Decimal, city_w_h))
-    area_coords = [list(map(Decimal, n)) for n in area_coords]
-
-    (a_x, a_y), (b_x, b_y) = area_coords
-
-    n00 = c[0][0] + (c[2][0] - c[0][0]) * a_x / w
-    n01 = c[0][1] + (c[2][1] - c[0][1]) * (h - b_y) / h
-    n20 = c[0][0] + (c[2][0] - c[0][0]) * b_x / w
-    n21 = c[0][1] + (c[2][1] - c[0][1]) * (h - a_y) / h
-
-    area_polygon_coords = [
-        [n00, n01],
-        [n20, n01],
-        [n20, n21],
-        [n00, n21],
-        [n00, n01],
-    ]
-    return area_polygon_coords
-
-
-def set_polygon_coords_to_gj(geojson: dict, polygon_coords: list) -> dict:
-    geojson["features"][0]["geometry"]["coordinates"][0] = polygon_coords
-    return geojson
-
-
-def area_to_geojson(city_name: str, area_img_bytes: io.BytesIO) -> (str, bytes):
-    city_geojson_path = FILES_PATH / "geojson" / (city_name + ".geojson")
-    city_image_path = FILES_PATH / "img" / (city_name + ".png")
+    return top_left, bottom_right, lower_boundary
+
+
+MATCHERS = {
+    "pyramid": get_area_coords_pyramid,
+    "fast": get_area_coords_fast,
+    "exhaustive": get_area_coords,
+}
+
+
+def get_matcher(name: str):
+    try:
+        return MATCHERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown area matcher {name!r}. Expected one of {list(MATCHERS)}")
+
+
+def _to_rings(polygon: list) -> list:
+    return [np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon if len(ring)]
+
+
+def get_polygons_from_gj(geojson: dict) -> list:
+    """
+    Parse every Polygon and MultiPolygon feature of a GeoJSON into (properties, polygons),
+    polygons are lists of rings as (n, 2) float arrays, the exterior ring first.
+    """
+    if geojson.get("type") == "FeatureCollection":
+        features = geojson.get("features") or []
+    elif geojson.get("type") == "Feature":
+        features = [geojson]
+    else:
+        features = [{"type": "Feature", "properties": {}, "geometry": geojson}]
+
+    parsed = []
+    for feature in features:
+        geometry = feature.get("geometry") or {}
+        geometries = geometry.get("geometries") if geometry.get("type") == "GeometryCollection" else [geometry]
+        polygons = []
+        for g in geometries:
+            if g.get("type") == "Polygon":
+                polygons.append(_to_rings(g.get("coordinates") or []))
+            elif g.get("type") == "MultiPolygon":
+                polygons.extend(_to_rings(p) for p in g.get("coordinates") or [])
+            else:
+                logger.warning(f"Skipping {g.get('type')} geometry. Expected 'Polygon' or 'MultiPolygon'")
+        polygons = [p for p in polygons if p]
+        if polygons:
+            parsed.append((feature.get("properties") or {}, polygons))
+
+    if not parsed:
+        raise ValueError("Polygons not found in GeoJSON")
+    return parsed
+
+
+def get_bounds(features: list) -> tuple:
+    """
+    (xmin, ymin, xmax, ymax) of all exterior rings, the extent the city image covers.
+    """
+    exteriors = np.concatenate([polygon[0] for _, polygons in features for polygon in polygons])
+    xmin, ymin = exteriors.min(axis=0)
+    xmax, ymax = exteriors.max(axis=0)
+    return float(xmin), float(ymin), float(xmax), float(ymax)
+
+
+def lat_to_mercator(lat: np.ndarray) -> np.ndarray:
+    return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+
+def mercator_to_lat(y: np.ndarray) -> np.ndarray:
+    return np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2)
+
+
+def pixel_to_geo(points: np.ndarray, bounds: tuple, size: tuple, mercator=False) -> np.ndarray:
+    """
+    Convert (n, 2) pixel (x, y) points of an image of `size` (w, h) covering `bounds`
+    to (lon, lat). Image rows are linear in latitude, or in Web Mercator y if `mercator`.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    w, h = size
+    points = np.asarray(points, dtype=np.float64)
+    fx = points[..., 0] / w
+    # image rows go from north to south
+    fy = 1 - points[..., 1] / h
+
+    lon = xmin + (xmax - xmin) * fx
+    if mercator:
+        y0, y1 = lat_to_mercator(ymin), lat_to_mercator(ymax)
+        lat = mercator_to_lat(y0 + (y1 - y0) * fy)
+    else:
+        lat = ymin + (ymax - ymin) * fy
+    return np.stack([lon, lat], axis=-1)
+
+
+def _clip_edge(points: np.ndarray, axis: int, value: float, keep_greater: bool) -> np.ndarray:
+    # one Sutherland-Hodgman step for all vertices at once: every vertex emits
+    # the intersection of the edge coming into it if it crosses the line, then itself if it's inside
+    coord = points[:, axis]
+    inside = coord >= value if keep_greater else coord <= value
+    prev = np.roll(points, 1, axis=0)
+    crossing = inside != np.roll(inside, 1)
+
+    delta = coord - prev[:, axis]
+    t = np.divide(value - prev[:, axis], delta, out=np.zeros_like(delta), where=crossing)
+    intersections = prev + t[:, None] * (points - prev)
+    intersections[crossing, axis] = value
+
+    emitted = np.stack([intersections, points], axis=1).reshape(-1, 2)
+    return emitted[np.stack([crossing, inside], axis=1).reshape(-1)]
+
+
+def clip_ring(ring: np.ndarray, rect: tuple):
+    """
+    Clip a closed ring to rect (xmin, ymin, xmax, ymax), return None if less than a triangle is left.
+    Concave rings split by the rect stay one ring joined along the rect border.
+    """
+    xmin, ymin, xmax, ymax = rect
+    lo, hi = ring.min(axis=0), ring.max(axis=0)
+    if lo[0] >= xmin and lo[1] >= ymin and hi[0] <= xmax and hi[1] <= ymax:
+        return ring
+    if hi[0] < xmin or hi[1] < ymin or lo[0] > xmax or lo[1] > ymax:
+        return None
+
+    points = ring[:-1] if len(ring) > 1 and np.array_equal(ring[0], ring[-1]) else ring
+    for axis, value, keep_greater in ((0, xmin, True), (0, xmax, False), (1, ymin, True), (1, ymax, False)):
+        if len(points) < 3:
+            return None
+        points = _clip_edge(points, axis, value, keep_greater)
+
+    # drop repeated vertices left where the ring touched the rect border
+    if len(points):
+        points = points[np.any(points != np.roll(points, 1, axis=0), axis=1)]
+    if len(points) < 3:
+        return None
+    return np.concatenate([points, points[:1]])
+
+
+def clip_polygons(polygons: list, rect: tuple) -> list:
+    clipped = []
+    for exterior, *holes in polygons:
+        exterior = clip_ring(exterior, rect)
+        if exterior is None:
+            continue
+        holes = [h for h in (clip_ring(hole, rect) for hole in holes) if h is not None]
+        clipped.append([exterior, *holes])
+    return clipped
 
-    city_img = cv2.imread(str(city_image_path), cv2.IMREAD_COLOR)
-    area_img = cv2.imdecode(np.frombuffer(area_img_bytes.read(), dtype=np.uint8), cv2.IMREAD_COLOR)
 
-    city_height, city_width, *_ = city_img.shape
+def _rect_ring(rect: tuple) -> np.ndarray:
+    xmin, ymin, xmax, ymax = rect
+    return np.array([[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]])
 
-    # TODO: refactor fast method
-    # area_top_left, area_bottom_right = get_area_coords(city_img, area_img)
-    area_top_left, area_bottom_right = get_area_coords_fast(city_img, area_img)
 
+def clip_to_geojson(features: list, rect: tuple) -> dict:
+    """
+    GeoJSON of the city features clipped to rect (xmin, ymin, xmax, ymax).
+    If the rect misses the city geometry altogether, the rect itself is used.
+    """
+    clipped = []
+    for properties, polygons in features:
+        polygons = clip_polygons(polygons, rect)
+        if not polygons:
+            continue
+        coordinates = [[ring.tolist() for ring in polygon] for polygon in polygons]
+        geometry = (
+            {"type": "Polygon", "coordinates": coordinates[0]}
+            if len(coordinates) == 1
+            else {"type": "MultiPolygon", "coordinates": coordinates}
+        )
+        clipped.append({"type": "Feature", "properties": properties, "geometry": geometry})
+
+    if not clipped:
+        logger.warning("Area doesn't intersect city geometry, using the area rect")
+        clipped.append({
+            "type": "Feature",
+            "properties": features[0][0],
+            "geometry": {"type": "Polygon", "coordinates": [_rect_ring(rect).tolist()]},
+        })
+    return {"type": "FeatureCollection", "features": clipped}
+
+
+@log_processing
+def area_to_geojson(city_name: str, area_ref: ShmRef) -> (str, ShmRef, tuple):
+    """
+    Take the area photo in shared memory owned by the caller.
+    Return area geojson path, PNG of the city image with the area outlined in shared memory
+    owned by the caller from now on, and the area rect (x0, y0, x1, y1) in fractions of the city image.
+    """
+    city = city_cache.get(city_name)
+    with SharedBuffer.attach(area_ref) as area_buf:
+        area_img = cv2.imdecode(np.frombuffer(area_buf.buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if area_img is None:
+        raise ValueError("Can't decode area image")
+
+    city_height, city_width, *_ = city.image.shape
+
+    if AREA_MATCHER == "pyramid":
+        area_top_left, area_bottom_right, confidence = get_area_coords_pyramid(
+            city.gray, area_img, city_small=city.gray_small,
+        )
+    else:
+        matcher = get_matcher(AREA_MATCHER)
+        area_top_left, area_bottom_right, confidence = matcher(city.image, area_img)
+    logger.info(f"Area matched with {AREA_MATCHER} matcher, confidence {confidence:.3f}")
+
+    # cached image is shared between calls
+    city_img = city.image.copy()
     cv2.rectangle(city_img, area_top_left, area_bottom_right, (0, 0, 255), 2)
-    res, selected_buf = cv2.imencode('.png', city_img)
-    selected_img_bytes = io.BytesIO(selected_buf)
-
-    with open(city_geojson_path) as gjf:
-        city_geojson = json.load(gjf)
+    res, selected_png = cv2.imencode('.png', city_img)
 
-    city_polygon_coords = get_polygon_coords_from_gj(city_geojson)
-    area_polygon_coords = get_area_polygon_coords(
-        city_polygon_coords,
-        (city_width, city_height),
-        (area_top_left, area_bottom_right)
+    (xmin, ymax), (xmax, ymin) = pixel_to_geo(
+        (area_top_left, area_bottom_right), city.bounds, (city_width, city_height),
+        mercator=CITY_IMG_PROJECTION == "mercator",
     )
-    area_geojson = set_polygon_coords_to_gj(city_geojson, area_polygon_coords)
+    area_geojson = clip_to_geojson(city.features, (xmin, ymin, xmax, ymax))
 
-    with NamedTemporaryFile(mode="w", dir=TMP_PATH, delete=False) as gjf:
-        json.dump(area_geojson, gjf, default=lambda x: float(x) if isinstance(x, Decimal) else str(x))
-        area_geojson_path = gjf.name
+    # the same area chosen again is the same file
+    area_geojson_path = str(get_workspace().put_geojson(area_geojson))
 
-    return area_geojson_path, selected_img_bytes
\ No newline at end of file
+    area_rect = (
+        area_top_left[0] / city_width, area_top_left[1] / city_height,
+        area_bottom_right[0] / city_width, area_bottom_right[1] / city_height,
+    )
+    # made last: nothing unlinks a detached segment if this raises before returning it
+    selected_ref = SharedBuffer.from_bytes(selected_png).detach()
+    return area_geojson_path, selected_ref, area_rect
\ No newline at end of file
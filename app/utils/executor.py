@@ -1,9 +1,83 @@
 import asyncio
 import concurrent.futures
+import os
+import time
 
+from app import logs, metrics
+from app.config import MATCH_WORKERS, BULK_WORKERS
+from app.utils import coords, image
+from app.utils.city_cache import prewarm
 
-pp_executor = concurrent.futures.ProcessPoolExecutor(4)
+
+def init_match_worker():
+    logs.log_in_foreground()
+    metrics.registry.shipping = True
+    prewarm()
+    coords.warm_up()
+
+
+def init_bulk_worker():
+    logs.log_in_foreground()
+    metrics.registry.shipping = True
+    image.warm_up()
+
+
+class Pool:
+    """
+    Process pool with the number of calls in it for queue-depth metrics.
+    """
+    def __init__(self, name: str, workers: int, initializer):
+        self.name = name
+        self.workers = workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=initializer)
+        # calls submitted and not finished yet
+        self.pending = 0
+
+        registry = metrics.registry
+        registry.gauge("mapoc_pool_pending", lambda: self.pending, "Process pool calls queued or running", pool=name)
+        registry.gauge(
+            "mapoc_pool_queued", lambda: max(0, self.pending - self.workers),
+            "Process pool calls waiting for a free worker", pool=name,
+        )
+        registry.gauge(
+            "mapoc_pool_utilization", lambda: min(self.pending, self.workers) / self.workers,
+            "Share of busy process pool workers", pool=name,
+        )
+
+    async def run(self, func, *args):
+        self.pending += 1
+        try:
+            result, error, tb, samples = await asyncio.get_event_loop().run_in_executor(
+                self.executor, metrics.call_shipping_metrics, self.name, time.time(), func, *args,
+            )
+        finally:
+            self.pending -= 1
+        metrics.registry.merge(samples)
+        if error is not None:
+            raise error from metrics.RemoteTraceback(tb)
+        return result
+
+    async def start(self):
+        """
+        Spawn all workers now instead of on the first request, so they run their initializer
+        (city cache prewarm, numba kernels) at startup.
+        """
+        await asyncio.gather(*(self.run(os.getpid) for _ in range(self.workers)))
+
+
+# latency sensitive calls made while a user waits for the reply: area matching, render keys
+match_pool = Pool("match", MATCH_WORKERS, init_match_worker)
+# throughput work: previews, master crops
+bulk_pool = Pool("bulk", BULK_WORKERS, init_bulk_worker)
+
+
+async def run_interactive(func, *args):
+    return await match_pool.run(func, *args)
 
 
 async def run_blocking(func, *args):
-    return await asyncio.get_event_loop().run_in_executor(pp_executor, func, *args)
+    return await bulk_pool.run(func, *args)
+
+
+async def start_workers():
+    await asyncio.gather(match_pool.start(), bulk_pool.start())
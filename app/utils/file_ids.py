@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from app.config import FILE_IDS_DB_PATH
+
+logger = logging.getLogger("utils - file_ids")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# seconds between deletions of rows whose files are gone
+PRUNE_INTERVAL = 3600
+
+
+def file_hash(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FileIdRegistry:
+    """
+    Persistent mapping of local files (city maps, posters) to Telegram file_ids.
+    file_ids of the same bot are valid both for Bot API (aiogram) and MTProto (Pyrogram).
+    A file_id is reused while the file content hash stays the same,
+    the hash itself is recomputed only when file size or mtime changes.
+    Rows of removed files, like posters of the workspace, are deleted every PRUNE_INTERVAL seconds.
+    Methods hash files, call them in an executor.
+    """
+    def __init__(self, path):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_uploaded = 0
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            "path TEXT NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "sha256 TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, "
+            "file_id TEXT NOT NULL, "
+            "PRIMARY KEY (path, kind))"
+        )
+        self.db.commit()
+
+    def get(self, path, kind: str) -> Optional[str]:
+        with self._lock:
+            return self._get(str(path), kind)
+
+    def _get(self, path: str, kind: str) -> Optional[str]:
+        st = os.stat(path)
+        row = self.db.execute(
+            "SELECT * FROM file_ids WHERE path = ? AND kind = ?", (path, kind)
+        ).fetchone()
+
+        if row is not None and (row["size"], row["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+            if file_hash(path) == row["sha256"]:
+                self.db.execute(
+                    "UPDATE file_ids SET size = ?, mtime_ns = ? WHERE path = ? AND kind = ?",
+                    (st.st_size, st.st_mtime_ns, path, kind),
+                )
+                self.db.commit()
+            else:
+                row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_saved += st.st_size
+        return row["file_id"]
+
+    def set(self, path, kind: str, file_id: str):
+        path = str(path)
+        st = os.stat(path)
+        sha256 = file_hash(path)
+        with self._lock:
+            self.bytes_uploaded += st.st_size
+            self.db.execute(
+                "INSERT OR REPLACE INTO file_ids (path, kind, sha256, size, mtime_ns, file_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path, kind, sha256, st.st_size, st.st_mtime_ns, file_id),
+            )
+            self.db.commit()
+        if time.monotonic() - self._last_prune > PRUNE_INTERVAL:
+            self.prune()
+
+    def prune(self) -> int:
+        """
+        Delete rows of files which don't exist anymore.
+        """
+        self._last_prune = time.monotonic()
+        with self._lock:
+            paths = [row["path"] for row in self.db.execute("SELECT DISTINCT path FROM file_ids")]
+        gone = [(path,) for path in paths if not os.path.exists(path)]
+        with self._lock:
+            self.db.executemany("DELETE FROM file_ids WHERE path = ?", gone)
+            self.db.commit()
+        if gone:
+            logger.info(f"Forgot file_ids of {len(gone)} removed files")
+        return len(gone)
+
+    def forget(self, path, kind: str):
+        with self._lock:
+            self.db.execute("DELETE FROM file_ids WHERE path = ? AND kind = ?", (str(path), kind))
+            self.db.commit()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "bytes_uploaded": self.bytes_uploaded,
+        }
+
+
+_registry: Optional[FileIdRegistry] = None
+
+
+def get_registry() -> FileIdRegistry:
+    global _registry
+    if _registry is None:
+        _registry = FileIdRegistry(FILE_IDS_DB_PATH)
+    return _registry
+
+
+async def upload_once(path, kind: str, send) -> str:
+    """
+    Send a local file reusing its known file_id.
+    `send` is a coroutine function taking a file_id or None (upload `path`)
+    and returning file_id of the sent file.
+    """
+    loop = asyncio.get_event_loop()
+    registry = get_registry()
+    file_id = await loop.run_in_executor(None, registry.get, path, kind)
+    if file_id is not None:
+        try:
+            return await send(file_id)
+        except Exception as e:
+            logger.warning(f"Cached file_id of {path} was rejected: {e}")
+            await loop.run_in_executor(None, registry.forget, path, kind)
+
+    file_id = await send(None)
+    await loop.run_in_executor(None, registry.set, path, kind, file_id)
+    return file_id
@@ -1,17 +1,209 @@
+import os
+import struct
+import zlib
+
 import cv2
+import numpy as np
+from numba import njit
+
+from app.logs import log_processing
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# samples per pixel by PNG color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# decompressed bytes taken from zlib at once, flat posters compress a thousandfold
+DECOMPRESS_CHUNK = 1 << 20
+PREVIEW_QUALITY = 85
+
+
+def to_gray(img: np.ndarray) -> np.ndarray:
+    if img.ndim == 2:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def downscale(img: np.ndarray, factor: int) -> np.ndarray:
+    h, w = img.shape[:2]
+    return cv2.resize(img, (max(1, w // factor), max(1, h // factor)), interpolation=cv2.INTER_AREA)
+
+
+def iter_png_chunks(f):
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        data = f.read(length)
+        f.read(4)  # crc
+        yield chunk_type, data
+
+
+@njit(cache=True)
+def unfilter_row(filter_type, row, prev, bpp):
+    n = row.shape[0]
+    if filter_type == 1:
+        for i in range(bpp, n):
+            row[i] = (row[i] + row[i - bpp]) & 0xFF
+    elif filter_type == 2:
+        for i in range(n):
+            row[i] = (row[i] + prev[i]) & 0xFF
+    elif filter_type == 3:
+        for i in range(n):
+            left = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xFF
+    elif filter_type == 4:
+        for i in range(n):
+            a = np.int32(row[i - bpp]) if i >= bpp else 0
+            b = np.int32(prev[i])
+            c = np.int32(prev[i - bpp]) if i >= bpp else 0
+            p = a + b - c
+            pa = abs(p - a)
+            pb = abs(p - b)
+            pc = abs(p - c)
+            if pa <= pb and pa <= pc:
+                predictor = a
+            elif pb <= pc:
+                predictor = b
+            else:
+                predictor = c
+            row[i] = (row[i] + predictor) & 0xFF
+
+
+def warm_up():
+    unfilter_row(4, np.zeros(8, dtype=np.uint8), np.zeros(8, dtype=np.uint8), 4)
+
+
+class BoxReducer:
+    """
+    Averages factor x factor pixel boxes of rows fed one at a time,
+    keeping only one output row of sums in memory.
+    """
+    def __init__(self, width: int, height: int, factor: int):
+        self.factor = factor
+        self.starts = np.arange(0, width, factor)
+        self.block_widths = np.diff(np.append(self.starts, width))
+        self.acc = None
+        self.rows_in_acc = 0
+        self.out = np.empty(((height + factor - 1) // factor, len(self.starts), 3), dtype=np.uint8)
+        self.out_row = 0
+
+    def add_row(self, pixels: np.ndarray):
+        sums = np.add.reduceat(pixels, self.starts, axis=0)
+        self.acc = sums if self.acc is None else self.acc + sums
+        self.rows_in_acc += 1
+        if self.rows_in_acc == self.factor:
+            self._emit()
 
+    def _emit(self):
+        counts = (self.block_widths * self.rows_in_acc)[:, None]
+        self.out[self.out_row] = np.clip(self.acc / counts + 0.5, 0, 255).astype(np.uint8)
+        self.out_row += 1
+        self.acc = None
+        self.rows_in_acc = 0
 
+    def result(self) -> np.ndarray:
+        if self.rows_in_acc:
+            self._emit()
+        return self.out[:self.out_row]
+
+
+def to_bgr_row(samples: np.ndarray, channels: int, palette: np.ndarray = None) -> np.ndarray:
+    """
+    One row of 8-bit samples as float BGR pixels, transparency composited over white.
+    """
+    if palette is not None:
+        return palette[samples][:, ::-1].astype(np.float64)
+
+    pixels = samples.reshape(-1, channels).astype(np.float64)
+    if channels in (2, 4):
+        alpha = pixels[:, -1:] / 255
+        pixels = pixels[:, :-1] * alpha + 255 * (1 - alpha)
+    if pixels.shape[1] == 1:
+        return np.repeat(pixels, 3, axis=1)
+    return pixels[:, ::-1]
+
+
+def decode_png_reduced(filename, max_dim: int) -> np.ndarray:
+    """
+    Decode a PNG scanline by scanline into a BGR image reduced by a whole factor
+    to at least max_dim pixels per side, peak memory is a few source rows however large it is.
+    """
+    with open(filename, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError(f"{filename} isn't a PNG")
+
+        chunks = iter_png_chunks(f)
+        chunk_type, ihdr = next(chunks)
+        if chunk_type != b"IHDR":
+            raise ValueError(f"{filename} has no IHDR")
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", ihdr)
+        if interlace or bit_depth < 8 or color_type not in PNG_CHANNELS:
+            raise ValueError(f"Unsupported PNG: bit depth {bit_depth}, color type {color_type}, interlace {interlace}")
+
+        factor = max(1, max(width, height) // max_dim)
+        channels = PNG_CHANNELS[color_type]
+        sample_bytes = bit_depth // 8
+        bpp = channels * sample_bytes
+        stride = width * bpp
+        palette = None
+
+        reducer = BoxReducer(width, height, factor)
+        decompressor = zlib.decompressobj()
+        buf = bytearray()
+        prev = np.zeros(stride, dtype=np.uint8)
+        rows = 0
+
+        for chunk_type, data in chunks:
+            if chunk_type == b"PLTE":
+                palette = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+            elif chunk_type == b"IDAT":
+                pending = data
+                while pending and rows < height:
+                    buf += decompressor.decompress(pending, DECOMPRESS_CHUNK)
+                    pending = decompressor.unconsumed_tail
+
+                    pos = 0
+                    while len(buf) - pos > stride and rows < height:
+                        row = np.frombuffer(buf, dtype=np.uint8, count=stride, offset=pos + 1).copy()
+                        unfilter_row(buf[pos], row, prev, bpp)
+                        # 16-bit samples are big endian, the high byte is enough for a preview
+                        samples = row[::2] if sample_bytes == 2 else row
+                        reducer.add_row(to_bgr_row(samples, channels, palette if color_type == 3 else None))
+                        prev = row
+                        pos += stride + 1
+                        rows += 1
+                    del buf[:pos]
+            elif chunk_type == b"IEND":
+                break
+
+    if rows < height:
+        raise ValueError(f"{filename} is truncated: {rows} of {height} rows")
+    return reducer.result()
+
+
+def get_preview_filename(filename) -> str:
+    head, tail = os.path.split(str(filename))
+    return os.path.join(head, f"prev_{os.path.splitext(tail)[0]}.jpg")
+
+
+@log_processing
 def make_preview(filename, max_dim=1080):
-    output_name = f"prev_{filename}"
-    img = cv2.imread(filename, cv2.IMREAD_COLOR)
+    """
+    Write a JPEG preview at most max_dim pixels per side without decoding the poster at full resolution.
+    """
+    output_name = get_preview_filename(filename)
+    try:
+        img = decode_png_reduced(filename, max_dim)
+    except ValueError:
+        # not a PNG the streaming decoder supports
+        img = cv2.imread(str(filename), cv2.IMREAD_COLOR)
+        if img is None:
+            raise
+
     h, w = img.shape[:2]
-    scale = max_dim / max(h, w)
-    img = cv2.resize(img, (int(w * scale), int(h * scale)), cv2.INTER_AREA)
-    # img /= 255.0
-    cv2.imwrite(
-        output_name,
-        img,
-        # [cv2.IMWRITE_PNG_COMPRESSION, 5]
-    )
+    scale = min(1.0, max_dim / max(h, w))
+    if scale < 1:
+        img = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    cv2.imwrite(output_name, img, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY])
 
     return output_name
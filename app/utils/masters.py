@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from app.logs import log_processing
+from app.config import MASTERS_PATH, MASTER_CROP_DIM, MASTER_MAX_UPSCALE
+from app.utils.city_cache import get_city_img_path
+
+logger = logging.getLogger("utils - masters")
+
+
+def _slug(s: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in s)
+
+
+def get_master_path(city_name: str, color: str) -> Path:
+    return MASTERS_PATH / f"{_slug(city_name)}__{_slug(color)}.npy"
+
+
+def get_city_img_mtime(city_name: str) -> int:
+    return os.stat(get_city_img_path(city_name)).st_mtime_ns
+
+
+def open_master(city_name: str, color: str) -> Optional[np.ndarray]:
+    """
+    Memory-mapped master raster or None if there is no up to date master.
+    Only the pages of the rows and columns actually read are loaded.
+    """
+    path = get_master_path(city_name, color)
+    try:
+        with open(path.with_suffix(".json")) as f:
+            meta = json.load(f)
+        if meta["city_img_mtime"] != get_city_img_mtime(city_name):
+            return None
+        return np.load(path, mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def get_crop_box(shape: tuple, area_rect: tuple) -> tuple:
+    """
+    Area rect is (x0, y0, x1, y1) in fractions of the city image,
+    the city image and the master cover the same extent.
+    """
+    h, w = shape[:2]
+    x0, y0, x1, y1 = area_rect
+    return int(x0 * w), int(y0 * h), int(round(x1 * w)), int(round(y1 * h))
+
+
+def can_crop(city_name: str, color: str, area_rect: tuple) -> bool:
+    master = open_master(city_name, color)
+    if master is None:
+        return False
+    x0, y0, x1, y1 = get_crop_box(master.shape, area_rect)
+    return max(x1 - x0, y1 - y0) * MASTER_MAX_UPSCALE >= MASTER_CROP_DIM
+
+
+@log_processing
+def crop(city_name: str, color: str, area_rect: tuple, output_filename: str) -> bool:
+    master = open_master(city_name, color)
+    if master is None:
+        return False
+
+    x0, y0, x1, y1 = get_crop_box(master.shape, area_rect)
+    area = np.ascontiguousarray(master[y0:y1, x0:x1])
+    scale = MASTER_CROP_DIM / max(area.shape[:2])
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    area = cv2.resize(area, (round(area.shape[1] * scale), round(area.shape[0] * scale)), interpolation=interpolation)
+    return cv2.imwrite(output_filename, area)
+
+
+@log_processing
+def ingest(city_name: str, color: str, poster_path: str):
+    """
+    Store a full city render as the master of (city, color).
+    The new master is written next to the old one and swapped in when complete.
+    """
+    img = cv2.imread(str(poster_path), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Can't read poster {poster_path}")
+
+    MASTERS_PATH.mkdir(parents=True, exist_ok=True)
+    path = get_master_path(city_name, color)
+    tmp_path = path.with_name(path.stem + ".tmp.npy")
+    master = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=img.dtype, shape=img.shape)
+    master[:] = img
+    master.flush()
+    del master
+
+    os.replace(tmp_path, path)
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump({"city_img_mtime": get_city_img_mtime(city_name)}, f)
+    logger.info(f"Stored master render of {city_name}, {color}: {img.shape[1]}x{img.shape[0]}")
@@ -1,81 +1,618 @@
 import asyncio
+import json
 import logging
+import os
+import time
+from typing import Optional
 
+from aiogram import Bot
+
+from app.config import (
+    RENDER_CACHE_PATH, RENDER_CACHE_MAX_MB, MAX_PARALLEL_RENDERS, MEMORY_RESERVE_MB,
+    RENDER_MEMORY_ESTIMATE_MB, RENDER_MEMORY_LIMIT_FACTOR, JOBS_DB_PATH, JOBS_RETENTION, FILES_PATH,
+    RENDER_BACKEND, BROKER_URL, BROKER_MAX_ATTEMPTS, BROKER_POLL_INTERVAL, BROKER_RESULT_TTL, MASTER_RENDERS,
+    MAX_BATCH_COLORS, COLORS_SEPARATOR, RENDER_STATS_DB_PATH, RENDER_DEFAULT_SECONDS, COST_MODEL_MIN_SAMPLES,
+    SCHEDULER_POLICY, SCHEDULER_AGING_RATE, SCHEDULER_FAIR, RENDER_TIMEOUT, RENDER_CPU_TIMEOUT, RENDER_MAX_ATTEMPTS,
+    PROGRESS_EDIT_INTERVAL, WORKSPACE_GC_INTERVAL,
+)
+from app import metrics
+from app.services.broker import get_broker
+from app.services.cost_model import CostModel
+from app.services.job_store import JobStore, QUEUED, RUNNING, DONE, FAILED, UNFINISHED
+from app.services.quotas import get_quotas, DAY
 from app.utils.tg_client_api import send_file
 from app.utils.executor import run_blocking
-from app.utils.image import make_preview
+from app.utils.image import make_preview, get_preview_filename
+from app.utils.render_cache import RenderCache
+from app.utils.render_queue import RenderQueue
+from app.utils.resources import MemoryAdmission, Reservation, track_peak_rss
+from app.utils.workspace import get_workspace
+from app.utils import render, masters
+from app.utils.render import RenderResult
 
 logger = logging.getLogger("utils - queue_manager")
 
 
+def make_payload(job: dict) -> dict:
+    """
+    Broker payload with everything a worker on another host needs:
+    geojson content and shp path relative to FILES_PATH.
+    """
+    with open(job["geojson"]) as gjf:
+        geojson = gjf.read()
+
+    shp = job["shp"]
+    if os.path.abspath(shp).startswith(str(FILES_PATH) + os.sep):
+        shp = os.path.relpath(shp, FILES_PATH)
+
+    return {
+        "shp": shp,
+        "geojson": geojson,
+        "colors": job["colors"],
+        "prefix": job["prefix"],
+        "output_filename": job["output_filename"],
+        "user_id": job["user_id"],
+        "caption": job["caption"],
+    }
+
+
+def failure_text(result: Optional[RenderResult]) -> str:
+    if result is not None and result.timeout:
+        return "Sorry, poster creation took too long and was stopped"
+    return "Sorry, poster creation failed"
+
+
+def mapoc_output(lead: dict, task: dict) -> str:
+    # mapoc names outputs of a batch after the lead's prefix
+    return os.path.join(os.path.dirname(lead["output_filename"]), f"{lead['prefix']}_{task['colors']}.png")
+
+
+def remove_outputs(job: dict):
+    for fp in (job["output_filename"], get_preview_filename(job["output_filename"])):
+        if os.path.exists(fp):
+            os.remove(fp)
+
+
 class QueueManager:
     __instance = None
 
-    def __init__(self, max_parallel_tasks=1):
+    def __init__(self, bot: Bot, max_parallel_tasks=MAX_PARALLEL_RENDERS):
+        self.bot = bot
         self.max_parallel_tasks = max_parallel_tasks
-        self.q = asyncio.Queue()
+        self.cost_model = CostModel(
+            RENDER_STATS_DB_PATH, RENDER_DEFAULT_SECONDS, RENDER_MEMORY_ESTIMATE_MB * 1024 * 1024,
+            min_samples=COST_MODEL_MIN_SAMPLES,
+        )
+        self.quotas = get_quotas()
+        self.q = RenderQueue(
+            SCHEDULER_POLICY, cost=self.queued_seconds, aging_rate=SCHEDULER_AGING_RATE,
+            fair=SCHEDULER_FAIR, weight=self.quotas.weight,
+        )
+        # lead cache key -> (started, predicted seconds, cache keys) of renders in progress
+        self.running = {}
+        # job taken from the queue and waiting for memory to start
+        self.admitting = None
+        # job id -> (message id, text) of the message with the job's status, edited as the render goes
+        self.status_messages = {}
+        self.register_gauges()
+        # area geojsons and outputs are referenced by their jobs until the jobs are finished
+        self.workspace = get_workspace()
+        self.store = JobStore(
+            JOBS_DB_PATH, on_finished=self.job_finished, retention=max(JOBS_RETENTION, DAY) if JOBS_RETENTION else None,
+        )
+        self.quotas.restore(self.store.get_created_since(time.time() - DAY))
+        self.render_cache = RenderCache(RENDER_CACHE_PATH, RENDER_CACHE_MAX_MB * 1024 * 1024)
+        # cache key -> jobs waiting for the render which is queued or running
+        self.in_flight = {}
+        self.admission = MemoryAdmission(max_parallel_tasks, MEMORY_RESERVE_MB * 1024 * 1024)
 
         self.loop = asyncio.get_event_loop()
-        self.loop.create_task(self.worker())
+        self.store.start()
+        self.loop.create_task(self.scheduler())
+        self.loop.create_task(self.workspace.run_gc(WORKSPACE_GC_INTERVAL))
+
+        # render workers in other processes or hosts, see worker.py
+        self.broker = None
+        # broker job id -> future of its result
+        self.results = {}
+        if RENDER_BACKEND == "broker":
+            self.broker = get_broker(BROKER_URL, max_attempts=BROKER_MAX_ATTEMPTS)
+            self.loop.create_task(self.consume_results())
+
+        QueueManager.__instance = self
+
+    def register_gauges(self):
+        registry = metrics.registry
+        registry.gauge("mapoc_queue_depth", self.q.qsize, "Renders waiting in the queue")
+        registry.gauge("mapoc_renders_running", lambda: len(self.running), "Renders in progress")
+        registry.gauge(
+            "mapoc_render_utilization", lambda: len(self.running) / self.max_parallel_tasks,
+            "Share of render slots in use",
+        )
+        registry.gauge(
+            "mapoc_jobs_in_flight", lambda: sum(len(jobs) for jobs in self.in_flight.values()),
+            "Jobs waiting for a render, cropping or delivery",
+        )
 
     @classmethod
     def get_instance(cls):
         if not cls.__instance:
-            cls.__instance = QueueManager()
+            cls.__instance = QueueManager(Bot.get_current())
         return cls.__instance
 
     def add_task(self, **kwargs) -> int:
         """
-        Add a task to the queue and return it's position.
+        Add a task to the queue and return the queue size, see get_positions for the user's place in it.
+        0 means the poster is already rendered or cropped from a master render and is being sent.
+        Identical tasks are attached to the render which is already queued or running.
+        Quotas are checked by the caller with check_quota.
+        """
+        job = self.store.add(**kwargs)
+        self.quotas.added(job)
+        return self.enqueue(job)
+
+    def check_quota(self, user_id: int, jobs: int) -> Optional[str]:
+        return self.quotas.check(user_id, jobs)
+
+    def get_positions(self, user_id: int) -> list:
+        """
+        1-based positions of the user's queued renders in the order they will be started.
         """
-        self.q.put_nowait(kwargs)
+        return self.q.positions(user_id)
+
+    def enqueue(self, job: dict) -> int:
+        key = job["cache_key"]
+        self.workspace.acquire(job["geojson"], job["output_filename"])
+        self.quotas.enqueued(job)
+
+        entry = self.render_cache.get(key)
+        if entry is not None:
+            self.loop.create_task(self.deliver(key, entry, [job]))
+            return 0
+
+        if key in self.in_flight:
+            self.in_flight[key].append(job)
+            return max(self.q.qsize(), 1)
+
+        self.in_flight[key] = [job]
+        if self.can_crop(job):
+            self.loop.create_task(self.crop_worker(job))
+            return 0
+
+        self.q.put_nowait(job)
         return self.q.qsize()
 
-    async def worker(self):
+    def job_finished(self, job: dict):
+        self.workspace.release(job["geojson"], job["output_filename"])
+        self.quotas.finished(job)
+
+    @staticmethod
+    def can_crop(job: dict) -> bool:
+        if not MASTER_RENDERS or not job.get("area_rect") or not job.get("city"):
+            return False
+        return masters.can_crop(job["city"], job["colors"], json.loads(job["area_rect"]))
+
+    async def restore(self):
+        """
+        Re-enqueue jobs left unfinished by the previous run and remove their partial outputs,
+        then sweep workspace files none of them uses.
+        """
+        jobs = self.store.get_unfinished()
+        for job in jobs:
+            if job["state"] == RUNNING:
+                remove_outputs(job)
+                self.store.set_state(job, QUEUED)
+            self.enqueue(job)
+        if jobs:
+            logger.info(f"Restored {len(jobs)} unfinished jobs")
+        await self.loop.run_in_executor(None, self.workspace.sweep)
+
+    async def close(self):
+        await self.store.close()
+        self.cost_model.close()
+        self.render_cache.close()
+
+    async def set_status(self, job: dict, text: str):
+        message_id, current = self.status_messages.get(job["id"], (None, None))
+        if text == current:
+            return
+        try:
+            if message_id is None:
+                message = await self.bot.send_message(job["user_id"], text, disable_notification=True)
+                message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(text, job["user_id"], message_id)
+            self.status_messages[job["id"]] = (message_id, text)
+        except Exception as e:
+            logger.error(f"Can't update status of job {job['id']}: {e}")
+
+    async def end_status(self, job: dict, text: str = None):
+        """
+        Set the final status text if given and stop tracking the job's status message.
+        """
+        if text is not None:
+            await self.set_status(job, text)
+        self.status_messages.pop(job["id"], None)
+
+    @staticmethod
+    def estimate_memory(task: dict) -> int:
+        return RENDER_MEMORY_ESTIMATE_MB * 1024 * 1024
+
+    def get_features(self, job: dict) -> Optional[dict]:
+        return json.loads(job["features"]) if job.get("features") else None
+
+    def predict_seconds(self, job: dict, n_colors=1) -> float:
+        return self.cost_model.predict(self.get_features(job), job["colors"], n_colors)[0]
+
+    def queued_seconds(self, job: dict) -> float:
+        # predicted once when the job is queued, the queue order and ETAs are computed from it often
+        if "predicted_seconds" not in job:
+            job["predicted_seconds"] = self.predict_seconds(job)
+        return job["predicted_seconds"]
+
+    def get_etas(self, keys: list) -> dict:
+        """
+        Seconds until each of the posters is rendered, counting renders in progress and queued ahead of it.
+        """
+        etas = dict.fromkeys(keys, 0.0)
+        left = set(keys)
+        now = time.monotonic()
+        wait = 0.0
+        for started, predicted, running_keys in self.running.values():
+            remaining = max(0.0, predicted - (now - started))
+            for key in left & running_keys:
+                etas[key] = remaining
+            left -= running_keys
+            wait += remaining
+
+        queued = self.q.ordered()
+        if self.admitting is not None:
+            queued.insert(0, self.admitting)
+        for job in queued:
+            if not left:
+                break
+            cost = self.queued_seconds(job)
+            if job["cache_key"] in left:
+                etas[job["cache_key"]] = wait / self.max_parallel_tasks + cost
+                left.discard(job["cache_key"])
+            wait += cost
+        # the rest are rendered already or being cropped from a master
+        return etas
+
+    def take_batch(self, task: dict) -> list:
+        """
+        Take queued jobs which differ from the task only by color scheme,
+        they are rendered by the same mapoc run from one data load.
+        """
+        if not task.get("batch_key") or MAX_BATCH_COLORS < 2:
+            return []
+
+        colors = {task["colors"]}
+
+        def compatible(other: dict) -> bool:
+            if other.get("batch_key") != task["batch_key"] or other["colors"] in colors:
+                return False
+            colors.add(other["colors"])
+            return True
+
+        return self.q.pop_matching(compatible, limit=MAX_BATCH_COLORS - 1, batch_key=task["batch_key"])
+
+    async def scheduler(self):
+        """
+        Start queued renders in order while there is enough free memory for them.
+        """
         while True:
             task = await self.q.get()
-            cmd = task["command"]
-            gjf = task["geojson"]
-            callback = task["callback"]
-            manager = task["manager"]
-            await callback.message.reply(
-                "Your poster is processing now",
-                disable_notification=True,
+            if self.broker is not None:
+                # render workers do their own admission
+                self.loop.create_task(self.worker([task], None))
+                continue
+            self.admitting = task
+            try:
+                with metrics.timer("admission_wait"):
+                    reservation = await self.admission.acquire(self.estimate_memory(task))
+            finally:
+                self.admitting = None
+            # jobs queued while waiting for memory can join the batch too
+            batch = [task, *self.take_batch(task)]
+            for t in batch:
+                metrics.observe_stage("queue_wait", time.time() - t["created"])
+            if len(batch) > 1:
+                logger.info(f"Rendering {len(batch)} color schemes of job {task['id']} in one batch")
+            self.loop.create_task(self.worker(batch, reservation))
+
+    async def worker(self, batch: list, reservation: Optional[Reservation]):
+        retried = []
+        try:
+            if reservation is None:
+                await self.process_remote(batch[0])
+            else:
+                retried = await self.process(batch, reservation)
+        except Exception as e:
+            logger.exception(e)
+            for task in batch:
+                for job in self.in_flight.get(task["cache_key"], []):
+                    # some subscribers may have got their poster already
+                    if job["state"] in UNFINISHED:
+                        self.store.set_state(job, FAILED)
+                        await self.end_status(job, failure_text(None))
+        finally:
+            for task in batch:
+                # subscribers of a retried render wait for it in the queue again
+                if task not in retried:
+                    self.in_flight.pop(task["cache_key"], None)
+                self.q.task_done()
+            if reservation is not None:
+                self.admission.release(reservation)
+
+    async def crop_worker(self, task: dict):
+        """
+        Make an area poster by cropping the master render of its city and color, no mapoc run.
+        Falls back to the render queue if the master is gone.
+        """
+        key = task["cache_key"]
+        try:
+            for job in self.in_flight[key]:
+                self.store.set_state(job, RUNNING)
+            ok = await run_blocking(
+                masters.crop, task["city"], task["colors"], json.loads(task["area_rect"]), task["output_filename"],
+            )
+            if not ok:
+                logger.info(f"No master for {task['caption']}, rendering job {task['id']}")
+                for job in self.in_flight[key]:
+                    self.store.set_state(job, QUEUED)
+                self.q.put_nowait(task)
+                return
+            await self.finish(task, None)
+        except Exception as e:
+            logger.exception(e)
+            for job in self.in_flight.pop(key, []):
+                if job["state"] in UNFINISHED:
+                    self.store.set_state(job, FAILED)
+                    await self.end_status(job, failure_text(None))
+
+    async def process(self, batch: list, reservation: Reservation) -> list:
+        """
+        Render all color schemes of the batch with one mapoc run
+        and deliver each poster to its own subscribers.
+        Return the tasks put back to the queue to be rendered again.
+        """
+        lead = batch[0]
+        for task in batch:
+            for job in self.in_flight[task["cache_key"]]:
+                self.store.set_state(job, RUNNING)
+                await self.set_status(job, "Your poster is processing now")
+
+        memory_limit = int(reservation.estimate * RENDER_MEMORY_LIMIT_FACTOR)
+
+        def on_start(pid):
+            reservation.pid = pid
+
+        last_edit = {"time": time.monotonic()}
+
+        def on_progress(fraction: float, line: str):
+            now = time.monotonic()
+            if now - last_edit["time"] < PROGRESS_EDIT_INTERVAL:
+                return
+            last_edit["time"] = now
+            text = f"Your poster is processing now: {fraction:.0%}"
+            for task in batch:
+                for job in self.in_flight.get(task["cache_key"], []):
+                    self.loop.create_task(self.set_status(job, text))
+
+        started = time.monotonic()
+        self.running[lead["cache_key"]] = (
+            started, self.predict_seconds(lead, len(batch)), {task["cache_key"] for task in batch},
+        )
+        tracker = self.loop.create_task(track_peak_rss(reservation))
+        try:
+            with metrics.timer("render"):
+                result = await self.run_render(batch, memory_limit, on_start, on_progress)
+        finally:
+            tracker.cancel()
+            self.running.pop(lead["cache_key"], None)
+
+        if not result.ok:
+            logger.error(f"Render of job {lead['id']} {result.describe()}, output:\n{result.output}")
+            if result.retryable and (lead["attempts"] or 0) + 1 < RENDER_MAX_ATTEMPTS:
+                return self.retry(batch)
+            # a killed or failed mapoc run may leave a partial poster, it's never sent or cached
+            await self.fail(batch, result)
+            return []
+
+        features = self.get_features(lead)
+        if features is not None and reservation.peak_rss:
+            await self.loop.run_in_executor(
+                None, self.cost_model.record,
+                features, lead["colors"], len(batch), time.monotonic() - started, reservation.peak_rss,
             )
 
-            ret_code = await self.run(cmd)
-            self.q.task_done()
+        for task in batch[1:]:
+            output_filename = mapoc_output(lead, task)
+            if os.path.exists(output_filename):
+                os.replace(output_filename, task["output_filename"])
+
+        await asyncio.gather(*(self.finish(task, result) for task in batch))
+        return []
+
+    async def fail(self, batch: list, result: RenderResult):
+        """
+        Remove what the render left and fail every job of the batch.
+        """
+        lead = batch[0]
+        for task in batch:
+            remove_outputs(task)
+            if os.path.exists(mapoc_output(lead, task)):
+                os.remove(mapoc_output(lead, task))
+            for job in self.in_flight.pop(task["cache_key"], []):
+                self.store.set_state(job, FAILED)
+                await self.end_status(job, failure_text(result))
+
+    def retry(self, batch: list) -> list:
+        for task in batch:
+            remove_outputs(task)
+            self.store.update(task, attempts=(task["attempts"] or 0) + 1)
+            for job in self.in_flight[task["cache_key"]]:
+                self.store.set_state(job, QUEUED)
+            self.q.put_nowait(task)
+        logger.info(f"Job {batch[0]['id']} is queued again")
+        return batch
+
+    @staticmethod
+    async def run_render(batch: list, memory_limit: int, on_start, on_progress) -> RenderResult:
+        lead = batch[0]
+        limits = dict(
+            memory_limit=memory_limit, on_start=on_start, on_progress=on_progress,
+            timeout=RENDER_TIMEOUT or None, cpu_timeout=RENDER_CPU_TIMEOUT or None,
+        )
+        colors = COLORS_SEPARATOR.join(task["colors"] for task in batch)
+        # mapoc writes its outputs to the working directory
+        cwd = os.path.dirname(os.path.abspath(lead["output_filename"]))
+        return await render.render(lead["shp"], lead["geojson"], colors, lead["prefix"], cwd=cwd, **limits)
+
+    async def finish(self, task: dict, result: Optional[RenderResult]):
+        """
+        Deliver the task's poster of a successful render, `result` is None for posters cropped from a master.
+        """
+        key = task["cache_key"]
+        if not os.path.exists(task["output_filename"]):
+            how = result.describe() if result is not None else "crop failed"
+            logger.error(f"No output, render {how}: {task['command']}")
+            for job in self.in_flight.pop(key):
+                self.store.set_state(job, FAILED)
+                await self.end_status(job, failure_text(result))
+            return
+
+        # the preview is sent ahead of the poster
+        preview = await self.make_preview(task["output_filename"])
+        first = self.in_flight[key][0]
+        file_ids = None
+        try:
+            file_ids = await send_file(first["user_id"], task["output_filename"], preview, first["caption"])
+            self.store.set_state(first, DONE)
+        except Exception as e:
+            logger.error(e)
+            self.store.set_state(first, FAILED)
+        await self.end_status(first)
 
-            preview_filename = await run_blocking(make_preview, task["output_filename"])
+        if preview is None:
+            # not cached without a preview, the rest of the subscribers get the poster alone
+            entry = {"output": task["output_filename"], "preview": None, "file_id": None, "preview_file_id": None}
+        else:
+            entry = self.render_cache.put(key, task["output_filename"], preview)
+        if file_ids is not None:
+            self.render_cache.set_file_ids(key, *file_ids)
+            entry["file_id"], entry["preview_file_id"] = file_ids
 
-            # TODO: fix bug: sometimes default geojson is deleted!
-            # if task["delete_geojson"]:
-            #     os.remove(gjf)
+        # jobs attached during the upload are in in_flight too
+        await self.deliver(key, entry, self.in_flight.pop(key)[1:])
 
+        if self.needs_master(task, entry):
             try:
-                await asyncio.create_task(send_file(
-                    callback.from_user.id,
-                    task["output_filename"],
-                    preview_filename,
-                    task["caption"]
-                ))
+                await run_blocking(masters.ingest, task["city"], task["colors"], entry["output"])
             except Exception as e:
-                logger.error(e)
+                logger.error(f"Can't store master render of {task['caption']}: {e}")
 
-            # await manager.done()
-            # from aiogram_dialog.data import DialogContext
-            # DialogContext(manager.proxy, "", None).last_message_id = None
+    @staticmethod
+    async def make_preview(output_filename: str) -> Optional[str]:
+        """
+        Preview of the poster, None if it can't be made: the poster is sent without one.
+        """
+        try:
+            return await run_blocking(make_preview, output_filename)
+        except Exception as e:
+            logger.error(f"Can't make preview of {output_filename}: {e}")
+            return None
 
     @staticmethod
-    async def run(cmd: str):
-        proc = await asyncio.create_subprocess_shell(
-            cmd=cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE)
+    def needs_master(task: dict, entry: dict) -> bool:
+        if not MASTER_RENDERS or not task.get("city") or task.get("area_rect") or not entry["output"]:
+            return False
+        return masters.open_master(task["city"], task["colors"]) is None
+
+    async def process_remote(self, task: dict):
+        """
+        Publish the render to the broker and wait for a worker's result.
+        The worker sends the poster to the task's user, other subscribers get it by file_ids.
+        """
+        key = task["cache_key"]
+        for job in self.in_flight[key]:
+            self.store.set_state(job, RUNNING)
+            await self.set_status(job, "Your poster is processing now")
+
+        payload = await self.loop.run_in_executor(None, make_payload, task)
+        result = self.loop.create_future()
+        self.results[task["id"]] = result
+        await self.loop.run_in_executor(None, self.broker.publish, task["id"], payload)
+        self.running[key] = (time.monotonic(), self.predict_seconds(task), {key})
+        try:
+            with metrics.timer("remote_render"):
+                result = await result
+        finally:
+            self.running.pop(key, None)
+
+        jobs = self.in_flight.pop(key)
+        if not result["ok"]:
+            logger.error(f"Remote render of job {task['id']} failed: {result.get('error')}")
+            for job in jobs:
+                self.store.set_state(job, FAILED)
+                await self.end_status(job, failure_text(None))
+            return
+
+        entry = self.render_cache.put_file_ids(key, result["file_id"], result["preview_file_id"])
+        self.store.set_state(task, DONE)
+        await self.end_status(task)
+        await self.deliver(key, entry, [job for job in jobs if job is not task])
+
+    async def consume_results(self):
+        expired = time.monotonic()
+        while True:
+            try:
+                if self.results:
+                    results = await self.loop.run_in_executor(None, self.broker.fetch_results, list(self.results))
+                    for r in results:
+                        self.results.pop(r["id"]).set_result(r["result"])
+                    if results:
+                        await self.loop.run_in_executor(None, self.broker.ack_results, [r["id"] for r in results])
+                # results of jobs nobody waits for stay until the job is restored or the ttl passes
+                if time.monotonic() - expired > 60:
+                    expired = time.monotonic()
+                    removed = await self.loop.run_in_executor(None, self.broker.expire_results, BROKER_RESULT_TTL)
+                    if removed:
+                        logger.warning(f"Dropped {removed} broker results nobody waited for")
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(BROKER_POLL_INTERVAL)
+
+    async def deliver(self, key: str, entry: dict, jobs: list):
+        """
+        Send a cached poster to every job's user.
+        Files are uploaded once, other users get them concurrently by Telegram file_ids.
+        """
+        jobs = list(jobs)
+        while jobs and not entry["file_id"]:
+            await self.deliver_one(key, entry, jobs.pop(0))
+
+        await asyncio.gather(*(self.deliver_one(key, entry, job) for job in jobs))
+
+    async def deliver_one(self, key: str, entry: dict, job: dict):
+        try:
+            file_ids = await send_file(
+                job["user_id"],
+                entry["file_id"] or entry["output"],
+                entry["preview_file_id"] or entry["preview"],
+                job["caption"],
+            )
+        except Exception as e:
+            logger.error(e)
+            self.store.set_state(job, FAILED)
+            await self.end_status(job, failure_text(None))
+            return
 
-        stdout, stderr = await proc.communicate()
+        self.store.set_state(job, DONE)
+        await self.end_status(job)
 
-        if stderr:
-            logger.error(f'[stderr]\n{stderr.decode()}')
+        if not entry["file_id"]:
+            self.render_cache.set_file_ids(key, *file_ids)
+            entry["file_id"], entry["preview_file_id"] = file_ids
 
-        return proc.returncode
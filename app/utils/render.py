@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import re
+import signal
+from collections import deque
+from typing import NamedTuple, Optional
+
+from app.config import CMD_TEMPLATE, RENDER_DAEMON
+from app.utils.render_daemon import DaemonUnavailable, get_daemons
+from app.utils.resources import limit_child_resources
+
+logger = logging.getLogger("utils - render")
+
+# lines of render output kept for failure reports
+OUTPUT_TAIL_LINES = 20
+# longer lines are cut, output isn't buffered beyond this and one read chunk
+MAX_LINE_BYTES = 4096
+READ_CHUNK = 64 * 1024
+# seconds to wait for the output pipes to close after the process group is killed
+PIPE_CLOSE_TIMEOUT = 5
+# to tell a command killed by a signal from the shell exit code
+SIGNALS = {s.value for s in signal.Signals}
+# "45%", "45.5%" or "12/40", progress bars rewrite their line with \r
+PROGRESS_RE = re.compile(r"(\d{1,3}(?:\.\d+)?)%|\b(\d+)\s*/\s*(\d+)\b")
+
+
+class RenderResult(NamedTuple):
+    returncode: Optional[int]
+    # "wall" or "cpu" if the render was stopped for running too long
+    timeout: Optional[str] = None
+    # last lines of stdout and stderr
+    output: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and self.timeout is None
+
+    @property
+    def retryable(self) -> bool:
+        # killed by a signal we didn't send (OOM killer, shutdown) may pass next time,
+        # mapoc errors and timeouts would repeat
+        return self.timeout is None and self.returncode is not None and self.returncode < 0
+
+    def describe(self) -> str:
+        if self.timeout == "wall":
+            return "timed out"
+        if self.timeout == "cpu":
+            return "exceeded CPU time limit"
+        if self.returncode is not None and self.returncode < 0:
+            return f"killed by signal {-self.returncode}"
+        return f"exited with code {self.returncode}"
+
+
+def parse_progress(line: str) -> Optional[float]:
+    """
+    Fraction of the render done according to an output line, None if the line has no progress.
+    """
+    match = PROGRESS_RE.search(line)
+    if match is None:
+        return None
+    if match.group(1) is not None:
+        percent = float(match.group(1))
+        return percent / 100 if percent <= 100 else None
+    done, total = int(match.group(2)), int(match.group(3))
+    return done / total if 0 < total and done <= total else None
+
+
+async def read_lines(stream: asyncio.StreamReader, on_line):
+    """
+    Call on_line with every line of the stream split on \\n and \\r, holding at most one chunk and one line.
+    """
+    pending = b""
+    while True:
+        chunk = await stream.read(READ_CHUNK)
+        if not chunk:
+            break
+        *lines, pending = re.split(rb"[\r\n]", pending + chunk)
+        if len(pending) > MAX_LINE_BYTES:
+            lines.append(pending)
+            pending = b""
+        for line in lines:
+            if line.strip():
+                on_line(line[:MAX_LINE_BYTES].decode(errors="replace").strip())
+    if pending.strip():
+        on_line(pending[:MAX_LINE_BYTES].decode(errors="replace").strip())
+
+
+def kill_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def run(cmd: str, memory_limit: int = None, on_start=None, on_progress=None,
+              timeout: float = None, cpu_timeout: int = None, cwd: str = None) -> RenderResult:
+    """
+    Run render command in its own process group in `cwd`, streaming its output.
+    `on_start` is called with the pid of the started process,
+    `on_progress` with the done fraction and the output line it was parsed from.
+    After `timeout` seconds the whole group is killed, `cpu_timeout` is enforced with RLIMIT_CPU.
+    """
+    proc = await asyncio.create_subprocess_shell(
+        cmd=cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+        cwd=cwd,
+        preexec_fn=lambda: limit_child_resources(memory_limit, cpu_timeout),
+    )
+    if on_start is not None:
+        on_start(proc.pid)
+
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+
+    def on_line(line: str):
+        tail.append(line)
+        logger.debug(f"[{proc.pid}] {line}")
+        if on_progress is not None:
+            progress = parse_progress(line)
+            if progress is not None:
+                on_progress(progress, line)
+
+    readers = asyncio.ensure_future(asyncio.gather(read_lines(proc.stdout, on_line), read_lines(proc.stderr, on_line)))
+    timed_out = None
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = "wall"
+        logger.error(f"Render {proc.pid} timed out after {timeout}s, killing it")
+    finally:
+        # the whole group on timeout or cancellation, processes left behind by the render otherwise
+        kill_group(proc.pid)
+
+    await proc.wait()
+    try:
+        await asyncio.wait_for(readers, PIPE_CLOSE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Output of render {proc.pid} is still open after it was killed")
+
+    returncode = proc.returncode
+    if returncode > 128 and returncode - 128 in SIGNALS:
+        # the shell reports its command killed by a signal as 128 + signal number
+        returncode = 128 - returncode
+    if returncode == -signal.SIGXCPU:
+        timed_out = "cpu"
+    return RenderResult(returncode, timed_out, "\n".join(tail))
+
+
+async def render(shp, geojson, colors: str, prefix: str, memory_limit: int = None, on_start=None,
+                 on_progress=None, timeout: float = None, cpu_timeout: int = None, cwd: str = None) -> RenderResult:
+    """
+    Render a poster into `cwd` with a resident render daemon if enabled, falling back to a mapoc subprocess.
+    Daemon renders report no progress and only have the wall clock timeout.
+    """
+    if RENDER_DAEMON:
+        try:
+            return await get_daemons().render(shp, geojson, colors, prefix, memory_limit, on_start, timeout, cwd)
+        except DaemonUnavailable as e:
+            logger.error(f"Render daemon unavailable, falling back to subprocess: {e}")
+
+    cmd = CMD_TEMPLATE.format(shp=shp, geojson=geojson, colors=colors, prefix=prefix)
+    return await run(
+        cmd, memory_limit=memory_limit, on_start=on_start, on_progress=on_progress,
+        timeout=timeout, cpu_timeout=cpu_timeout, cwd=cwd,
+    )
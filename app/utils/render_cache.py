@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+from app.services.cost_model import render_features
+from app.services.extracts import get_shp_version
+
+logger = logging.getLogger("utils - render_cache")
+
+# coordinates are rounded so the same area isn't rendered twice because of float noise
+COORDS_PRECISION = 7
+# seconds cache hits are collected before their last_used times are written in one commit
+USED_FLUSH_INTERVAL = 10
+
+
+def _round_coords(coords):
+    if isinstance(coords, (int, float)):
+        return round(float(coords), COORDS_PRECISION)
+    return [_round_coords(c) for c in coords]
+
+
+def normalize_geometry(geojson: dict) -> list:
+    """
+    Geometries of all features with rounded coordinates, ignoring properties and ids.
+    """
+    if geojson.get("type") == "FeatureCollection":
+        geometries = [f.get("geometry") or {} for f in geojson.get("features", [])]
+    elif geojson.get("type") == "Feature":
+        geometries = [geojson.get("geometry") or {}]
+    else:
+        geometries = [geojson]
+
+    return [
+        {"type": g.get("type"), "coordinates": _round_coords(g.get("coordinates", []))}
+        for g in geometries
+    ]
+
+
+def _hash(*parts) -> str:
+    payload = json.dumps(list(parts), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def render_keys(shp, geojson_path, colors: list) -> tuple:
+    """
+    Key of the geometry and keys of its posters in each color scheme, the geometry is read once.
+    Posters with the same geometry key differ only by color scheme and can be rendered in one batch.
+    Keys change with the shapefile data, so a rebuilt extract isn't served from old renders.
+    """
+    with open(geojson_path) as gjf:
+        geometry = normalize_geometry(json.load(gjf))
+
+    shp = (str(shp), get_shp_version(shp))
+    return _hash(shp, geometry), [_hash(shp, geometry, color) for color in colors]
+
+
+def prepare_render(shp, geojson_path, colors: list) -> tuple:
+    """
+    Render features, batch key and cache keys of a poster request, made in one pool call.
+    """
+    return (render_features(shp, geojson_path), *render_keys(shp, geojson_path, colors))
+
+
+class RenderCache:
+    """
+    Rendered posters and their previews addressed by render_key.
+    Files are evicted least recently used first when the cache exceeds max_bytes,
+    Telegram file_ids outlive the files and are enough to send the poster again.
+    Last use times of cache hits are written in batches, with evictions or on close at the latest.
+    """
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        # key -> last use time not written yet
+        self._used = {}
+        self._last_flush = time.time()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.db = sqlite3.connect(str(path / "index.sqlite3"))
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS renders ("
+            "key TEXT PRIMARY KEY, "
+            "output TEXT, "
+            "preview TEXT, "
+            "size INTEGER NOT NULL DEFAULT 0, "
+            "file_id TEXT, "
+            "preview_file_id TEXT, "
+            "created REAL NOT NULL, "
+            "last_used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS renders_last_used ON renders (last_used)")
+        self.db.commit()
+
+    def get(self, key: str) -> Optional[dict]:
+        row = self.db.execute("SELECT * FROM renders WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        entry = dict(row)
+        has_files = entry["output"] and os.path.exists(entry["output"]) \
+            and entry["preview"] and os.path.exists(entry["preview"])
+        has_file_ids = entry["file_id"] and entry["preview_file_id"]
+        if not has_files and not has_file_ids:
+            self._used.pop(key, None)
+            self.db.execute("DELETE FROM renders WHERE key = ?", (key,))
+            self.db.commit()
+            return None
+
+        entry["last_used"] = self._used[key] = time.time()
+        if entry["last_used"] - self._last_flush > USED_FLUSH_INTERVAL:
+            self.flush()
+        return entry
+
+    def flush(self):
+        """
+        Write the pending last use times.
+        """
+        self._last_flush = time.time()
+        if not self._used:
+            return
+        used, self._used = self._used, {}
+        self.db.executemany("UPDATE renders SET last_used = ? WHERE key = ?", [(t, key) for key, t in used.items()])
+        self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def put(self, key: str, output_filename: str, preview_filename: str) -> dict:
+        """
+        Move rendered files into the cache and return the new entry.
+        """
+        output = self.path / f"{key}{Path(output_filename).suffix}"
+        preview = self.path / f"{key}_preview{Path(preview_filename).suffix}"
+        shutil.move(output_filename, output)
+        shutil.move(preview_filename, preview)
+
+        now = time.time()
+        self._used.pop(key, None)
+        size = output.stat().st_size + preview.stat().st_size
+        self.db.execute(
+            "INSERT OR REPLACE INTO renders (key, output, preview, size, created, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, str(output), str(preview), size, now, now),
+        )
+        self.db.commit()
+        self.evict(keep=key)
+        return self.get(key)
+
+    def put_file_ids(self, key: str, file_id: str, preview_file_id: str) -> dict:
+        """
+        Add a poster rendered elsewhere and known only by Telegram file_ids.
+        """
+        now = time.time()
+        self._used.pop(key, None)
+        self.db.execute(
+            "INSERT OR REPLACE INTO renders (key, file_id, preview_file_id, created, last_used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, file_id, preview_file_id, now, now),
+        )
+        self.db.commit()
+        return self.get(key)
+
+    def set_file_ids(self, key: str, file_id: str, preview_file_id: str):
+        self.db.execute(
+            "UPDATE renders SET file_id = ?, preview_file_id = ? WHERE key = ?",
+            (file_id, preview_file_id, key),
+        )
+        self.db.commit()
+
+    def evict(self, keep: str = None):
+        total, = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM renders").fetchone()
+        if total <= self.max_bytes:
+            return
+
+        # least recently used by the pending times too
+        self.flush()
+        rows = self.db.execute(
+            "SELECT key, output, preview, size FROM renders WHERE size > 0 AND key IS NOT ? ORDER BY last_used",
+            (keep,),
+        ).fetchall()
+        for row in rows:
+            if total <= self.max_bytes:
+                break
+            for fp in (row["output"], row["preview"]):
+                if fp and os.path.exists(fp):
+                    os.remove(fp)
+            self.db.execute(
+                "UPDATE renders SET output = NULL, preview = NULL, size = 0 WHERE key = ?",
+                (row["key"],),
+            )
+            total -= row["size"]
+            logger.info(f"Evicted render {row['key']} from cache")
+        self.db.commit()
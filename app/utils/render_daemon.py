@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from importlib import metadata
+from pathlib import Path
+from typing import Optional
+
+from app.config import BASE_DIR, RENDER_DAEMON_SOCKET_DIR, RENDER_DAEMON_IDLE_TIMEOUT
+from app.utils.resources import limit_child_resources
+
+logger = logging.getLogger("utils - render_daemon")
+
+START_TIMEOUT = 60
+
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+# --- server side: python -m app.utils.render_daemon --socket PATH ---
+
+def cache_geopandas_reads(shp: str):
+    """
+    Keep the GeoDataFrame of the daemon's shapefile in memory for the lifetime of the daemon,
+    other files (area geojsons) are read as usual.
+    Must run before mapoc is imported so its modules see the patched reader.
+    """
+    try:
+        import geopandas
+    except ImportError:
+        logger.warning("geopandas isn't installed, region data won't be kept in memory")
+        return
+
+    read_file = geopandas.read_file
+    shp = os.path.abspath(shp)
+    cache = {}
+
+    @functools.wraps(read_file)
+    def cached_read_file(filename, *args, **kwargs):
+        try:
+            if os.path.abspath(filename) != shp:
+                return read_file(filename, *args, **kwargs)
+            key = (os.stat(filename).st_mtime_ns, args, repr(sorted(kwargs.items())))
+        except (OSError, TypeError):
+            return read_file(filename, *args, **kwargs)
+        if key not in cache:
+            # a changed shapefile replaces the old read
+            cache.clear()
+            cache[key] = read_file(filename, *args, **kwargs)
+        # new columns of the copy don't reach the cached frame, the geometries are shared
+        return cache[key].copy(deep=False)
+
+    geopandas.read_file = cached_read_file
+
+
+def load_mapoc():
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        scripts = entry_points.select(group="console_scripts")
+    else:
+        scripts = entry_points.get("console_scripts", [])
+    for entry_point in scripts:
+        if entry_point.name == "mapoc":
+            return entry_point.load()
+    raise RuntimeError("mapoc console script isn't installed")
+
+
+def call_mapoc(mapoc, args: list):
+    if hasattr(mapoc, "main"):
+        # click command
+        mapoc.main(args=args, prog_name="mapoc", standalone_mode=False)
+        return
+
+    argv = sys.argv
+    sys.argv = ["mapoc", *args]
+    try:
+        mapoc()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise RuntimeError(f"mapoc exited with code {e.code}")
+    finally:
+        sys.argv = argv
+
+
+class RenderServer:
+    def __init__(self, socket_path: str, idle_timeout: float):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.last_request = time.monotonic()
+        self.busy = False
+        # renders share global state (cwd, matplotlib), so they run one at a time
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.lock = asyncio.Lock()
+        self.mapoc = load_mapoc()
+
+    def render(self, request: dict):
+        args = [
+            "poster", "create",
+            "--shp_path", request["shp"],
+            "--geojson", request["geojson"],
+            "--colors", request["colors"],
+            "--output_prefix", request["prefix"],
+        ]
+        cwd = os.getcwd()
+        os.chdir(request["cwd"])
+        try:
+            call_mapoc(self.mapoc, args)
+        finally:
+            os.chdir(cwd)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(await reader.readline())
+            async with self.lock:
+                self.busy = True
+                try:
+                    await asyncio.get_event_loop().run_in_executor(self.executor, self.render, request)
+                    response = {"ok": True}
+                except Exception as e:
+                    logger.exception(e)
+                    response = {"ok": False, "error": str(e)}
+                finally:
+                    self.busy = False
+                    self.last_request = time.monotonic()
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        logger.info(f"Render daemon listening on {self.socket_path}")
+        try:
+            # exit when idle so the resident region data is freed
+            while self.busy or time.monotonic() - self.last_request < self.idle_timeout:
+                await asyncio.sleep(min(10.0, self.idle_timeout))
+            logger.info("Render daemon is idle, exiting")
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mapoc render daemon keeping region data in memory")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("--shp", required=True, help="shapefile with region data the daemon renders from")
+    parser.add_argument("--idle-timeout", type=float, default=RENDER_DAEMON_IDLE_TIMEOUT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    cache_geopandas_reads(args.shp)
+    asyncio.run(RenderServer(args.socket, args.idle_timeout).serve())
+
+
+# --- client side ---
+
+class RenderDaemons:
+    """
+    Starts a daemon per shapefile on demand and sends render requests to it.
+    Daemons exit on their own after RENDER_DAEMON_IDLE_TIMEOUT without requests.
+    """
+    def __init__(self):
+        self.socket_dir = Path(RENDER_DAEMON_SOCKET_DIR)
+        self.processes = {}
+        self._starting = {}
+
+    def get_socket_path(self, shp) -> str:
+        name = hashlib.sha1(str(shp).encode()).hexdigest()[:16]
+        return str(self.socket_dir / f"{name}.sock")
+
+    async def start(self, shp, memory_limit: int = None) -> asyncio.subprocess.Process:
+        self.socket_dir.mkdir(parents=True, exist_ok=True)
+        socket_path = self.get_socket_path(shp)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "app.utils.render_daemon",
+            "--socket", socket_path,
+            "--shp", str(shp),
+            "--idle-timeout", str(RENDER_DAEMON_IDLE_TIMEOUT),
+            # repository root, so the app package is importable
+            cwd=str(BASE_DIR.parent),
+            # own process group, so a hung daemon is killed with everything it started
+            start_new_session=True,
+            preexec_fn=lambda: limit_child_resources(memory_limit),
+        )
+        deadline = time.monotonic() + START_TIMEOUT
+        while not os.path.exists(socket_path):
+            if proc.returncode is not None or time.monotonic() > deadline:
+                raise DaemonUnavailable(f"Render daemon for {shp} didn't start")
+            await asyncio.sleep(0.2)
+        self.processes[str(shp)] = proc
+        return proc
+
+    async def connect(self, shp, memory_limit: int = None):
+        socket_path = self.get_socket_path(shp)
+        try:
+            return await asyncio.open_unix_connection(socket_path)
+        except OSError:
+            pass
+
+        # one start per shapefile even if several jobs come at once
+        key = str(shp)
+        if key not in self._starting:
+            self._starting[key] = asyncio.ensure_future(self.start(shp, memory_limit))
+        try:
+            await self._starting[key]
+        finally:
+            self._starting.pop(key, None)
+        return await asyncio.open_unix_connection(socket_path)
+
+    def kill(self, shp):
+        proc = self.processes.pop(str(shp), None)
+        if proc is None:
+            logger.error(f"Render daemon for {shp} wasn't started by this process, can't kill it")
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        # the next render starts a new daemon
+        socket_path = self.get_socket_path(shp)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+    async def render(self, shp, geojson, colors: str, prefix: str,
+                     memory_limit: int = None, on_start=None, timeout: float = None, cwd: str = None):
+        """
+        Render through the daemon and return RenderResult like a subprocess would.
+        A daemon which doesn't answer within `timeout` seconds is killed.
+        Raise DaemonUnavailable if the daemon can't be reached.
+        """
+        from app.utils.render import RenderResult
+
+        try:
+            reader, writer = await self.connect(shp, memory_limit)
+        except OSError as e:
+            raise DaemonUnavailable(str(e))
+
+        proc = self.processes.get(str(shp))
+        if on_start is not None and proc is not None:
+            on_start(proc.pid)
+
+        request = {
+            "shp": str(shp), "geojson": str(geojson), "colors": colors, "prefix": prefix, "cwd": cwd or os.getcwd(),
+        }
+        try:
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            line = await asyncio.wait_for(reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Render daemon for {shp} timed out after {timeout}s, killing it")
+            self.kill(shp)
+            return RenderResult(None, "wall")
+        finally:
+            writer.close()
+
+        if not line:
+            raise DaemonUnavailable(f"Render daemon for {shp} closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            logger.error(f"Daemon render failed: {response.get('error')}")
+            return RenderResult(1, output=response.get("error") or "")
+        return RenderResult(0)
+
+
+daemons: Optional[RenderDaemons] = None
+
+
+def get_daemons() -> RenderDaemons:
+    global daemons
+    if daemons is None:
+        daemons = RenderDaemons()
+    return daemons
+
+
+if __name__ == "__main__":
+    main()
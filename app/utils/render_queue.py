@@ -0,0 +1,255 @@
+import asyncio
+import heapq
+import itertools
+from collections import Counter, defaultdict
+from typing import Callable, List
+
+POLICIES = ("fifo", "sjf", "aging")
+
+
+class _UserQueue:
+    __slots__ = ("heap", "count", "finish", "weight", "token")
+
+    def __init__(self, weight: float):
+        # [priority, seq, job] entries, removed ones stay until they reach the top
+        self.heap = []
+        self.count = 0
+        # virtual time at which the user's last taken job is done
+        self.finish = 0.0
+        self.weight = weight
+        # seq of the user's valid entry in the active heap, None if the user has no jobs
+        self.token = None
+
+
+class RenderQueue(asyncio.Queue):
+    """
+    Queue of render jobs ordered by the scheduling policy:
+    "fifo" - in order of creation,
+    "sjf" - shortest predicted render first,
+    "aging" - shortest first, but every second of waiting counts as aging_rate seconds less of render,
+    so long renders aren't starved.
+
+    With `fair` every user has a queue of their own ordered by the policy, and users are served
+    by start-time fair queuing: a user's next job starts at a virtual time which grows by
+    the predicted cost of each taken job divided by the user's weight. Users with jobs waiting get
+    render time in proportion to their weights however many jobs each of them queued.
+    Putting and taking a job is O(log n), the start order of all queued jobs is computed once
+    per change of the queue.
+    Queued jobs matching a predicate can also be taken out, so compatible jobs are rendered together.
+    """
+    def __init__(self, policy="fifo", cost: Callable[[dict], float] = None, aging_rate=1.0,
+                 fair=False, weight: Callable[[int], float] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy {policy}, expected one of {', '.join(POLICIES)}")
+        self.policy = policy
+        self.cost = cost or (lambda job: 0.0)
+        self.aging_rate = aging_rate
+        self.fair = fair
+        self.weight = weight or (lambda user_id: 1.0)
+        self._counter = itertools.count()
+        super().__init__()
+
+    def priority(self, item: dict) -> float:
+        # cost - aging_rate * (now - created) orders jobs the same at any moment as this
+        if self.policy == "sjf":
+            return self.cost(item)
+        if self.policy == "aging":
+            return self.cost(item) + self.aging_rate * (item.get("created") or 0)
+        return item.get("created") or 0
+
+    def _user_key(self, item: dict):
+        return item.get("user_id") if self.fair else None
+
+    def _init(self, maxsize):
+        self._users = {}
+        # (virtual start, seq, user key) of users with jobs
+        self._active = []
+        # (virtual finish, seq, user key) of users whose jobs are all taken, forgotten once the virtual time passes it
+        self._idle = []
+        self._vtime = 0.0
+        self._size = 0
+        # seqs of entries taken out of the middle of user heaps
+        self._removed = set()
+        # batch key -> {seq: (user key, entry)}
+        self._batches = defaultdict(dict)
+        # user id -> queued jobs, in both modes
+        self._per_user = Counter()
+        # bumped on every change, the start order is cached for a version
+        self._version = 0
+        self._order = (None, [])
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return not self._size
+
+    def _activate(self, key, user: _UserQueue):
+        user.token = next(self._counter)
+        heapq.heappush(self._active, (max(self._vtime, user.finish), user.token, key))
+
+    def _put(self, item):
+        key = self._user_key(item)
+        user = self._users.get(key)
+        if user is None:
+            user = self._users[key] = _UserQueue(self.weight(key) if self.fair else 1.0)
+        entry = [self.priority(item), next(self._counter), item]
+        self._version += 1
+        heapq.heappush(user.heap, entry)
+        user.count += 1
+        self._size += 1
+        self._per_user[item.get("user_id")] += 1
+        if item.get("batch_key"):
+            self._batches[item["batch_key"]][entry[1]] = (key, entry)
+        if user.token is None:
+            self._activate(key, user)
+
+    def _charge(self, key, user: _UserQueue, start: float, item: dict):
+        user.finish = start + self.cost(item) / user.weight
+        if not user.count:
+            user.token = None
+            # only entries taken out of the middle can be left
+            self._removed.difference_update(entry[1] for entry in user.heap)
+            user.heap.clear()
+            heapq.heappush(self._idle, (user.finish, next(self._counter), key))
+
+    def _forget_idle(self):
+        while self._idle and self._idle[0][0] <= self._vtime:
+            finish, _, key = heapq.heappop(self._idle)
+            user = self._users.get(key)
+            # a user starting now would start at the virtual time anyway
+            if user is not None and not user.count and user.finish <= self._vtime:
+                del self._users[key]
+
+    def _pop_head(self, user: _UserQueue) -> list:
+        while True:
+            entry = heapq.heappop(user.heap)
+            if entry[1] in self._removed:
+                self._removed.discard(entry[1])
+                continue
+            return entry
+
+    def _take(self, entry: list):
+        self._version += 1
+        self._size -= 1
+        user_id = entry[2].get("user_id")
+        self._per_user[user_id] -= 1
+        if not self._per_user[user_id]:
+            del self._per_user[user_id]
+        batch_key = entry[2].get("batch_key")
+        if batch_key:
+            batch = self._batches[batch_key]
+            batch.pop(entry[1], None)
+            if not batch:
+                del self._batches[batch_key]
+
+    def _get(self):
+        while True:
+            start, token, key = heapq.heappop(self._active)
+            user = self._users.get(key)
+            if user is not None and token == user.token:
+                break
+        self._vtime = max(self._vtime, start)
+        entry = self._pop_head(user)
+        user.count -= 1
+        self._take(entry)
+        self._charge(key, user, start, entry[2])
+        if user.count:
+            self._activate(key, user)
+        self._forget_idle()
+        return entry[2]
+
+    def ordered(self) -> List[dict]:
+        """
+        Queued jobs in the order they will be started.
+        """
+        return list(self._ordered())
+
+    def _ordered(self) -> List[dict]:
+        version, order = self._order
+        if version != self._version:
+            order = list(self._simulate())
+            self._order = (self._version, order)
+        return order
+
+    def positions(self, user_id) -> List[int]:
+        """
+        1-based positions of the user's queued jobs in the order they will be started.
+        """
+        left = self.user_size(user_id)
+        positions = []
+        if not left:
+            return positions
+        for i, job in enumerate(self._ordered(), 1):
+            if job.get("user_id") == user_id:
+                positions.append(i)
+                if len(positions) == left:
+                    break
+        return positions
+
+    def user_size(self, user_id) -> int:
+        return self._per_user.get(user_id, 0)
+
+    def _simulate(self):
+        """
+        Yield jobs in the order `_get` would take them, without changing the queue.
+        Ties of virtual start are broken by seqs like in `_get`: a user taking their turn again
+        gets a seq above all the current ones.
+        """
+        heaps = {
+            key: sorted(entry for entry in user.heap if entry[1] not in self._removed)
+            for key, user in self._users.items() if user.count
+        }
+        positions = dict.fromkeys(heaps, 0)
+        active = [
+            entry for entry in self._active
+            if entry[2] in self._users and self._users[entry[2]].token == entry[1]
+        ]
+        heapq.heapify(active)
+        counter = itertools.count(max((entry[1] for entry in active), default=0) + 1)
+        vtime = self._vtime
+        while active:
+            start, _, key = heapq.heappop(active)
+            vtime = max(vtime, start)
+            user = self._users[key]
+            job = heaps[key][positions[key]][2]
+            positions[key] += 1
+            yield job
+            finish = start + self.cost(job) / user.weight
+            if positions[key] < len(heaps[key]):
+                heapq.heappush(active, (max(vtime, finish), next(counter), key))
+
+    def pop_matching(self, predicate: Callable[[dict], bool], limit: int = None, batch_key: str = None) -> List[dict]:
+        """
+        Take out queued jobs matching the predicate in priority order.
+        With `batch_key` only jobs with that batch key are looked at, which doesn't scan the queue.
+        Their users are charged for them as if the jobs were taken in turn.
+        """
+        if batch_key is not None:
+            candidates = sorted(self._batches.get(batch_key, {}).values(), key=lambda c: c[1][:2])
+        else:
+            candidates = sorted(
+                ((key, entry) for key, user in self._users.items() for entry in user.heap
+                 if entry[1] not in self._removed),
+                key=lambda c: c[1][:2],
+            )
+
+        matched = []
+        for key, entry in candidates:
+            if limit is not None and len(matched) >= limit:
+                break
+            if not predicate(entry[2]):
+                continue
+            matched.append(entry[2])
+            self._removed.add(entry[1])
+            user = self._users[key]
+            user.count -= 1
+            self._take(entry)
+            self._charge(key, user, max(self._vtime, user.finish), entry[2])
+            if user.count:
+                # the user's turn moves back by the taken job
+                self._activate(key, user)
+        if matched:
+            # free slots of a bounded queue like get_nowait does
+            self._wakeup_next(self._putters)
+        return matched
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import os
+import resource
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("utils - resources")
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# cgroup v1 reports this (or close to it) when there is no limit
+CGROUP_UNLIMITED = 1 << 60
+# CPU seconds between SIGXCPU and SIGKILL
+CPU_KILL_GRACE = 10
+
+
+def _read_int(path) -> Optional[int]:
+    try:
+        value = Path(path).read_text().strip()
+    except OSError:
+        return None
+    if value == "max":
+        return None
+    return int(value)
+
+
+def get_meminfo_available() -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("MemAvailable not found in /proc/meminfo")
+
+
+def get_cgroup_available() -> Optional[int]:
+    # cgroup v2
+    limit = _read_int("/sys/fs/cgroup/memory.max")
+    usage = _read_int("/sys/fs/cgroup/memory.current")
+    if limit is None or usage is None:
+        # cgroup v1
+        limit = _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+        usage = _read_int("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+    if limit is None or usage is None or limit >= CGROUP_UNLIMITED:
+        return None
+    return max(0, limit - usage)
+
+
+def get_available_memory() -> int:
+    available = get_meminfo_available()
+    cgroup_available = get_cgroup_available()
+    if cgroup_available is not None:
+        available = min(available, cgroup_available)
+    return available
+
+
+def get_children(pid: int) -> list:
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(c) for c in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def get_tree_rss(pid: int) -> int:
+    """
+    Resident memory of the process and all its descendants.
+    """
+    total = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            continue
+        stack.extend(get_children(p))
+    return total
+
+
+def limit_child_resources(memory_limit: Optional[int], cpu_limit: Optional[int] = None):
+    """
+    preexec_fn for render subprocesses: they are killed first on OOM, can't grow past memory_limit
+    and get SIGXCPU after cpu_limit seconds of CPU time.
+    """
+    try:
+        with open("/proc/self/oom_score_adj", "w") as f:
+            f.write("1000")
+    except OSError:
+        pass
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    if cpu_limit:
+        # SIGKILL at the hard limit if SIGXCPU is ignored
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + CPU_KILL_GRACE))
+
+
+class Reservation:
+    def __init__(self, estimate: int):
+        self.estimate = estimate
+        self.pid = None
+        self.peak_rss = 0
+
+    def pending_growth(self) -> int:
+        """
+        Memory the job may still take before reaching its estimated peak.
+        """
+        if self.pid is None:
+            return self.estimate
+        return max(0, self.estimate - get_tree_rss(self.pid))
+
+
+async def track_peak_rss(reservation: Reservation, interval=1.0):
+    """
+    Sample the memory of the reservation's process tree until cancelled, keeping the peak.
+    """
+    while True:
+        if reservation.pid is not None:
+            reservation.peak_rss = max(reservation.peak_rss, get_tree_rss(reservation.pid))
+        await asyncio.sleep(interval)
+
+
+class MemoryAdmission:
+    """
+    Admits a job when available memory minus the reserve and the pending growth
+    of already running jobs covers the job's estimated peak.
+    One job is always admitted when nothing is running.
+    """
+    def __init__(self, max_parallel: int, reserve: int, poll_interval=5.0):
+        self.max_parallel = max_parallel
+        self.reserve = reserve
+        self.poll_interval = poll_interval
+        self.running = []
+        self._changed = asyncio.Event()
+
+    def free_memory(self) -> int:
+        pending = sum(r.pending_growth() for r in self.running)
+        return get_available_memory() - self.reserve - pending
+
+    def can_admit(self, estimate: int) -> bool:
+        if not self.running:
+            return True
+        if len(self.running) >= self.max_parallel:
+            return False
+        return self.free_memory() >= estimate
+
+    async def acquire(self, estimate: int) -> Reservation:
+        while not self.can_admit(estimate):
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+        reservation = Reservation(estimate)
+        self.running.append(reservation)
+        return reservation
+
+    def release(self, reservation: Reservation):
+        self.running.remove(reservation)
+        self._changed.set()
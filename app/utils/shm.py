@@ -0,0 +1,123 @@
+import logging
+import os
+import secrets
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import NamedTuple
+
+logger = logging.getLogger("utils - shm")
+
+NAME_PREFIX = "mapoc_"
+SHM_DIR = Path("/dev/shm")
+
+
+class ShmRef(NamedTuple):
+    """
+    Picklable handle of a SharedBuffer, this is what crosses the process boundary.
+    """
+    name: str
+    size: int
+
+
+def _open(name: str) -> SharedMemory:
+    """
+    Open an existing segment without registering it with the resource tracker, which unlinks
+    registered segments when the process exits. Unregistering after the fact isn't safe:
+    forked pool workers share the tracker of the bot, which keeps one registration per name,
+    so a worker would drop the registration of the process which created the segment.
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, track=False)
+    # before 3.13 attaching always registers
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedBuffer:
+    """
+    Bytes in a named shared memory segment.
+    Exactly one side owns a segment and unlinks it on close: the creator until it calls detach(),
+    then whoever attaches with owner=True. Only the owner has the segment registered with
+    the resource tracker, so it's unlinked if the owner dies. Use as a context manager, and drop
+    every view of `buf` (numpy arrays made with np.frombuffer too) before it exits.
+    """
+    def __init__(self, shm: SharedMemory, size: int, owner: bool):
+        self.shm = shm
+        self.size = size
+        self.owner = owner
+        self.buf = shm.buf[:size]
+
+    @classmethod
+    def create(cls, size: int) -> "SharedBuffer":
+        name = f"{NAME_PREFIX}{os.getpid()}_{secrets.token_hex(6)}"
+        # zero sized segments aren't allowed
+        return cls(SharedMemory(name, create=True, size=max(size, 1)), size, owner=True)
+
+    @classmethod
+    def from_bytes(cls, data) -> "SharedBuffer":
+        data = memoryview(data).cast("B")
+        buffer = cls.create(data.nbytes)
+        buffer.buf[:] = data
+        return buffer
+
+    @classmethod
+    def attach(cls, ref: ShmRef, owner=False) -> "SharedBuffer":
+        shm = _open(ref.name)
+        if owner:
+            resource_tracker.register(shm._name, "shared_memory")
+        return cls(shm, ref.size, owner)
+
+    @property
+    def ref(self) -> ShmRef:
+        return ShmRef(self.shm.name, self.size)
+
+    def detach(self) -> ShmRef:
+        """
+        Hand the segment over to another process, which must attach it with owner=True.
+        """
+        ref = self.ref
+        if self.owner:
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+            self.owner = False
+        self.close()
+        return ref
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.buf.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def sweep():
+    """
+    Unlink segments left by processes which are gone, e.g. killed pool workers.
+    """
+    if not SHM_DIR.is_dir():
+        return
+    for path in SHM_DIR.glob(NAME_PREFIX + "*"):
+        try:
+            pid = int(path.name[len(NAME_PREFIX):].split("_")[0])
+            os.kill(pid, 0)
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            logger.info(f"Removing stale shared memory segment {path.name}")
+            path.unlink(missing_ok=True)
+        except PermissionError:
+            continue
@@ -1,45 +1,203 @@
+import asyncio
+import inspect
+import logging
 import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
 from pyrogram import Client
 
-from app.config import API_TOKEN, API_ID, API_HASH
+from app.config import API_TOKEN, API_ID, API_HASH, PYROGRAM_POOL_SIZE
+from app.logs import log_processing
+from app.utils.file_ids import upload_once
+
+logger = logging.getLogger("utils - tg_client_api")
 
 
 class PyrogramBot:
-    def __init__(self):
+    """
+    Long-lived Pyrogram client. Connected once and restarted if the connection is lost.
+    """
+    def __init__(self, session_name="pyro_bot_session"):
         self._bot = Client(
-            "pyro_bot_session",
+            session_name,
             bot_token=API_TOKEN,
             no_updates=True,
             api_id=API_ID,
             api_hash=API_HASH,
         )
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            if not self._bot.is_connected:
+                await self._bot.start()
+
+    async def stop(self):
+        async with self._lock:
+            if self._bot.is_connected:
+                await self._bot.stop()
+
+    async def restart(self):
+        async with self._lock:
+            try:
+                if self._bot.is_connected:
+                    await self._bot.stop()
+            except Exception as e:
+                logger.warning(f"Error while stopping pyrogram client: {e}")
+            await self._bot.start()
+
+    async def _call(self, method, **kwargs):
+        try:
+            await self.start()
+        except (ConnectionError, OSError) as e:
+            # nothing is sent yet, connecting again is safe
+            logger.warning(f"Pyrogram connection error, reconnecting: {e}")
+            await self.restart()
+        try:
+            return await method(**kwargs)
+        except (ConnectionError, OSError) as e:
+            # Telegram may have accepted the message already, sending it again could duplicate it
+            logger.warning(f"Pyrogram connection error while sending, reconnecting for the next send: {e}")
+            try:
+                await self.restart()
+            except Exception as restart_error:
+                logger.warning(f"Can't reconnect pyrogram client: {restart_error}")
+            raise
 
     async def send_document(self, chat_id, file, caption=None):
-        async with self._bot:
-            await self._bot.send_document(chat_id=chat_id, document=file, caption=caption)
+        message = await self._call(self._bot.send_document, chat_id=chat_id, document=file, caption=caption)
+        return message.document.file_id
 
     async def send_photo(self, chat_id, file, caption=None):
-        async with self._bot:
-            await self._bot.send_photo(chat_id=chat_id, photo=file, caption=caption)
+        message = await self._call(self._bot.send_photo, chat_id=chat_id, photo=file, caption=caption)
+        return message.photo.file_id
 
-    async def __aenter__(self):
-        return self
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        pass
+class UploadStats:
+    def __init__(self, window=1000):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.latencies = deque(maxlen=window)
 
+    def add(self, seconds: float, size: int):
+        self.count += 1
+        self.bytes += size
+        self.busy_time += seconds
+        self.latencies.append(seconds)
 
-async def send_file(chat_id, fp, preview_fp, cap):
-    async with PyrogramBot() as pyro_bot:
-        await pyro_bot.send_photo(
-            chat_id=chat_id,
-            file=preview_fp,
-            caption=f"{cap} (preview)",
-        )
-        await pyro_bot.send_document(
-            chat_id=chat_id,
-            file=fp,
-            caption=cap,
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            "uploads": self.count,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "throughput": self.bytes / self.busy_time if self.busy_time else 0.0,
+        }
+
+
+class PyrogramPool:
+    """
+    A few long-lived clients shared by all deliveries.
+    Every client serves one send at a time so uploads run on separate connections.
+    """
+    def __init__(self, size: int):
+        self.clients = [PyrogramBot(f"pyro_bot_session_{i}") for i in range(size)]
+        self.upload_stats = UploadStats()
+        self._idle = asyncio.Queue()
+        for client in self.clients:
+            self._idle.put_nowait(client)
+
+    async def start(self):
+        await asyncio.gather(*(client.start() for client in self.clients))
+
+    async def stop(self):
+        await asyncio.gather(*(client.stop() for client in self.clients), return_exceptions=True)
+
+    @asynccontextmanager
+    async def acquire(self):
+        client = await self._idle.get()
+        try:
+            yield client
+        finally:
+            self._idle.put_nowait(client)
+
+    async def _send(self, method_name: str, chat_id, file, caption):
+        # file_ids are not uploaded and don't count
+        size = os.path.getsize(file) if os.path.exists(str(file)) else 0
+        async with self.acquire() as client:
+            start = time.perf_counter()
+            try:
+                file_id = await getattr(client, method_name)(chat_id=chat_id, file=file, caption=caption)
+            except Exception:
+                self.upload_stats.errors += 1
+                raise
+            if size:
+                self.upload_stats.add(time.perf_counter() - start, size)
+        return file_id
+
+    async def send_document(self, chat_id, file, caption=None):
+        return await self._send("send_document", chat_id, file, caption)
+
+    async def send_photo(self, chat_id, file, caption=None):
+        return await self._send("send_photo", chat_id, file, caption)
+
+
+pool = None
+
+
+def get_pool() -> PyrogramPool:
+    global pool
+    if pool is None:
+        pool = PyrogramPool(PYROGRAM_POOL_SIZE)
+    return pool
+
+
+async def start_pool():
+    await get_pool().start()
+
+
+async def stop_pool():
+    if pool is not None:
+        await pool.stop()
+
+
+async def send_path_or_file_id(send, kind: str, chat_id, file, caption) -> str:
+    if not os.path.exists(str(file)):
+        return await send(chat_id, file, caption)
+
+    async def send_once(file_id):
+        return await send(chat_id, file_id or str(file), caption)
+
+    return await upload_once(file, kind, send_once)
+
+
+@log_processing
+async def send_file(chat_id, fp, preview_fp, cap) -> tuple:
+    """
+    Send poster preview and then poster itself, so the preview comes first in the chat.
+    Both files may be paths or Telegram file_ids, the preview may also be an awaitable of its path.
+    No preview is sent if it is None. Files uploaded before with the same content are sent by file_id.
+    Return file_ids of the sent document and preview, the render cache keeps them for the next sends.
+    """
+    pyro_pool = get_pool()
+    if inspect.isawaitable(preview_fp):
+        preview_fp = await preview_fp
+    preview_file_id = None
+    if preview_fp is not None:
+        preview_file_id = await send_path_or_file_id(
+            pyro_pool.send_photo, "photo", chat_id, preview_fp, f"{cap} (preview)",
         )
-    os.remove(fp)
-    os.remove(preview_fp)
+    file_id = await send_path_or_file_id(pyro_pool.send_document, "document", chat_id, fp, cap)
+    return file_id, preview_file_id
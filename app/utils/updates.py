@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urlparse
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+from app import metrics
+from app.config import (
+    UPDATES_MODE, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS,
+    UPDATE_MAX_PENDING, DRAIN_TIMEOUT,
+)
+
+logger = logging.getLogger("utils - updates")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class LimitedDispatcher(Dispatcher):
+    """
+    Dispatcher running at most `concurrency` update handlers at a time, others wait for a slot.
+    Counts updates in progress on both polling and webhook paths, so shutdown can wait for them.
+    """
+    def __init__(self, bot: Bot, concurrency=64, **kwargs):
+        super().__init__(bot, **kwargs)
+        self.concurrency = concurrency
+        self.update_slots = asyncio.Semaphore(concurrency)
+        self.in_progress = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        metrics.registry.gauge("mapoc_updates_in_progress", lambda: self.in_progress, "Updates received and not handled yet")
+
+    async def process_updates(self, updates, fast: bool = True):
+        self.in_progress += len(updates)
+        self._idle.clear()
+        try:
+            return await super().process_updates(updates, fast)
+        finally:
+            self.in_progress -= len(updates)
+            if not self.in_progress:
+                self._idle.set()
+
+    async def process_update(self, update: types.Update):
+        waiting = time.perf_counter()
+        async with self.update_slots:
+            metrics.observe_stage("update_wait", time.perf_counter() - waiting)
+            with metrics.timer("update"):
+                return await super().process_update(update)
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Wait until updates in progress are handled, return False if some are left after timeout.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.error(f"{self.in_progress} updates still in progress after {timeout}s")
+            return False
+
+
+class WebhookServer:
+    """
+    Receives updates posted by Telegram and acknowledges each one right away, handling it in a task.
+    With max_pending updates in progress or while shutting down new ones get 503, Telegram retries them later.
+    """
+    def __init__(self, dp: LimitedDispatcher, url: str, secret: str = "", max_pending=1000):
+        self.dp = dp
+        self.url = url
+        self.path = urlparse(url).path or "/"
+        self.secret = secret
+        self.max_pending = max_pending
+        self.closing = False
+        self.runner = None
+        # handlers of acknowledged updates
+        self.tasks = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=403)
+        if self.closing or len(self.tasks) >= self.max_pending:
+            return web.Response(status=503)
+
+        update = types.Update(**await request.json())
+        task = asyncio.ensure_future(self.process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def process(self, update: types.Update):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        try:
+            await self.dp.process_updates([update])
+        except Exception as e:
+            logger.exception(e)
+
+    async def start(self, host: str, port: int, max_connections: int):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        await self.dp.bot.set_webhook(self.url, max_connections=max_connections, secret_token=self.secret or None)
+        logger.info(f"Receiving updates on http://{host}:{port}{self.path}")
+
+    async def stop(self, drain_timeout: float):
+        self.closing = True
+        if self.tasks:
+            _, pending = await asyncio.wait(self.tasks, timeout=drain_timeout)
+            if pending:
+                logger.error(f"{len(pending)} updates still in progress after {drain_timeout}s")
+        await self.runner.cleanup()
+
+
+async def run_webhook(dp: LimitedDispatcher, stop: asyncio.Event):
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL is required for webhook mode")
+    server = WebhookServer(dp, WEBHOOK_URL, WEBHOOK_SECRET, UPDATE_MAX_PENDING)
+    await server.start(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_MAX_CONNECTIONS)
+    try:
+        await stop.wait()
+    finally:
+        # the webhook stays set, Telegram keeps updates until the next start
+        await server.stop(DRAIN_TIMEOUT)
+
+
+async def run_polling(dp: LimitedDispatcher, stop: asyncio.Event):
+    # getUpdates doesn't work while a webhook is set
+    await dp.bot.delete_webhook()
+    polling = asyncio.ensure_future(dp.start_polling())
+    stopping = asyncio.ensure_future(stop.wait())
+    try:
+        await asyncio.wait([polling, stopping], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        dp.stop_polling()
+        # updates of an interrupted getUpdates aren't confirmed and come again next time
+        polling.cancel()
+        stopping.cancel()
+        await dp.drain(DRAIN_TIMEOUT)
+    if polling.done() and not polling.cancelled() and polling.exception() is not None:
+        raise polling.exception()
+
+
+async def run(dp: LimitedDispatcher, stop: asyncio.Event):
+    """
+    Receive and handle updates until `stop` is set, then wait for handlers in progress.
+    """
+    if UPDATES_MODE == "webhook":
+        await run_webhook(dp, stop)
+    elif UPDATES_MODE == "polling":
+        await run_polling(dp, stop)
+    else:
+        raise ValueError(f"Unknown updates mode {UPDATES_MODE!r}, expected 'polling' or 'webhook'")
@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from app.config import WORKSPACE_PATH, WORKSPACE_MAX_MB, WORKSPACE_TTL, WORKSPACE_GRACE
+
+logger = logging.getLogger("utils - workspace")
+
+
+class Workspace:
+    """
+    Directory owning temporary files: area geojsons, render outputs and their previews.
+    Geojsons are named after the hash of their content, writing one which exists already only touches it.
+    Files are referenced by unfinished jobs. Unreferenced ones are removed by `collect`
+    after ttl seconds, or oldest first while the workspace is over max_bytes.
+    References aren't persisted: they are taken again when unfinished jobs are restored,
+    and `sweep` removes what a crashed run left behind.
+    """
+    def __init__(self, path: Path, max_bytes: int, ttl: float, grace: float):
+        self.path = Path(os.path.abspath(str(path)))
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # unreferenced files younger than this are kept over the budget, dialogs may still use them
+        self.grace = grace
+        self.geojson_path = self.path / "geojson"
+        self.renders_path = self.path / "renders"
+        self.tmp_path = self.path / "tmp"
+        self.refs = Counter()
+        for p in (self.geojson_path, self.renders_path, self.tmp_path):
+            p.mkdir(parents=True, exist_ok=True)
+
+    def owns(self, path) -> bool:
+        return os.path.abspath(str(path)).startswith(str(self.path) + os.sep)
+
+    def put(self, data: bytes, suffix: str) -> Path:
+        """
+        Store data under its content hash and return the path, an existing copy isn't written again.
+        """
+        path = self.geojson_path / (hashlib.sha256(data).hexdigest() + suffix)
+        try:
+            # the file is as recent as its last use
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        tmp = self.tmp_path / f"{path.name}.{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        # a crash leaves only the temporary file, the sweep removes it
+        os.replace(tmp, path)
+        return path
+
+    def put_geojson(self, geojson) -> Path:
+        if not isinstance(geojson, str):
+            geojson = json.dumps(geojson, separators=(",", ":"))
+        return self.put(geojson.encode(), ".geojson")
+
+    def output_path(self, filename: str) -> Path:
+        return self.renders_path / filename
+
+    def acquire(self, *paths):
+        for path in paths:
+            if path and self.owns(path):
+                self.refs[os.path.abspath(str(path))] += 1
+
+    def release(self, *paths):
+        for path in paths:
+            if path and self.owns(path):
+                key = os.path.abspath(str(path))
+                self.refs[key] -= 1
+                if self.refs[key] <= 0:
+                    del self.refs[key]
+
+    def files(self) -> list:
+        """
+        (path, size, mtime) of stored files, temporary ones excluded.
+        """
+        files = []
+        for directory in (self.geojson_path, self.renders_path):
+            for entry in os.scandir(directory):
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files.append((entry.path, stat.st_size, stat.st_mtime))
+                except FileNotFoundError:
+                    pass
+        return files
+
+    def collect(self, referenced: set, now: float = None) -> tuple:
+        """
+        Remove expired unreferenced files, then the oldest unreferenced ones while over the budget.
+        `referenced` is a snapshot of the references, this runs in a thread.
+        Return the number of removed files and freed bytes.
+        """
+        now = now or time.time()
+        files = sorted(self.files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        removed = freed = 0
+        for path, size, mtime in files:
+            if path in referenced:
+                continue
+            age = now - mtime
+            if not (self.ttl and age > self.ttl) and not (total > self.max_bytes and age > self.grace):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+            freed += size
+        if total > self.max_bytes:
+            logger.warning(f"Workspace uses {total / 2 ** 20:.0f} MB, over its budget of {self.max_bytes / 2 ** 20:.0f} MB")
+        return removed, freed
+
+    def sweep(self):
+        """
+        Startup cleanup, after unfinished jobs took their references: remove partial writes
+        and render outputs no job is waiting for.
+        """
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.tmp_path.mkdir(parents=True, exist_ok=True)
+        removed = 0
+        for entry in os.scandir(self.renders_path):
+            if entry.path not in self.refs:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+                removed += 1
+        removed += self.collect(set(self.refs))[0]
+        if removed:
+            logger.info(f"Removed {removed} files left in the workspace")
+
+    async def run_gc(self, interval: float):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed, freed = await loop.run_in_executor(None, self.collect, set(self.refs))
+                if removed:
+                    logger.info(f"Removed {removed} files, {freed / 2 ** 20:.1f} MB from the workspace")
+            except Exception as e:
+                logger.exception(e)
+
+
+def sweep_workers(path: Path):
+    """
+    Remove workspaces of render worker processes which are gone, they are named after worker pids.
+    """
+    if not path.is_dir():
+        return
+    for entry in os.scandir(path):
+        try:
+            os.kill(int(entry.name), 0)
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            logger.info(f"Removing workspace of stopped worker {entry.name}")
+            shutil.rmtree(entry.path, ignore_errors=True)
+        except PermissionError:
+            continue
+
+
+_workspace: Optional[Workspace] = None
+
+
+def get_workspace() -> Workspace:
+    global _workspace
+    if _workspace is None:
+        _workspace = Workspace(WORKSPACE_PATH, WORKSPACE_MAX_MB * 1024 * 1024, WORKSPACE_TTL, WORKSPACE_GRACE)
+    return _workspace
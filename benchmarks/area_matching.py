@@ -0,0 +1,176 @@
+#!venv/bin/python
+import argparse
+import concurrent.futures
+import multiprocessing
+import resource
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.services import db
+from app.utils.city_cache import city_cache, get_city_img_path
+from app.utils.coords import MATCHERS, get_area_coords_pyramid
+
+# Telegram scales photos down to this long side
+TELEGRAM_MAX_DIM = 1280
+
+
+def degrade(img: np.ndarray, quality: int) -> np.ndarray:
+    """
+    JPEG re-compression like Telegram applies to photos.
+    """
+    _, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+
+def make_cases(city: np.ndarray, count: int, sizes: list, zooms: list, qualities: list, seed: int) -> list:
+    """
+    Synthetic area photos: the user gets the city map as a Telegram photo, crops an area of it,
+    maybe zoomed by the screenshot, and sends it back as a photo again.
+    Return (area image, true rect in city pixels, quality) tuples.
+    """
+    rng = np.random.default_rng(seed)
+    h, w = city.shape[:2]
+    sent_scale = min(1.0, TELEGRAM_MAX_DIM / max(h, w))
+    sent = degrade(cv2.resize(city, (round(w * sent_scale), round(h * sent_scale)), interpolation=cv2.INTER_AREA), 87)
+
+    cases = []
+    for i in range(count):
+        # every combination once per len(qualities) * len(sizes) * len(zooms) cases
+        quality = qualities[i % len(qualities)]
+        size = sizes[i // len(qualities) % len(sizes)]
+        zoom = zooms[i // (len(qualities) * len(sizes)) % len(zooms)]
+        aspect = rng.uniform(0.6, 1.6)
+        cw = max(16, int(sent.shape[1] * size))
+        ch = max(16, min(sent.shape[0] - 1, int(cw * aspect)))
+        x = int(rng.integers(0, sent.shape[1] - cw))
+        y = int(rng.integers(0, sent.shape[0] - ch))
+        area = sent[y:y + ch, x:x + cw]
+
+        zoomed = cv2.resize(area, (round(cw * zoom), round(ch * zoom)), interpolation=cv2.INTER_CUBIC)
+        down = min(1.0, TELEGRAM_MAX_DIM / max(zoomed.shape[:2]))
+        if down < 1:
+            zoomed = cv2.resize(zoomed, (round(zoomed.shape[1] * down), round(zoomed.shape[0] * down)),
+                                interpolation=cv2.INTER_AREA)
+
+        rect = (x / sent_scale, y / sent_scale, (x + cw) / sent_scale, (y + ch) / sent_scale)
+        cases.append((degrade(zoomed, quality), rect, quality))
+    return cases
+
+
+def iou(a: tuple, b: tuple) -> float:
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def get_peak_rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def run_config(city_name: str, matcher_name: str, n: int, case_args: tuple) -> dict:
+    """
+    Run one matcher over all cases in a fresh process, so its peak memory is measured alone.
+    """
+    city = city_cache.get(city_name)
+    cases = make_cases(city.image, *case_args)
+    matcher = MATCHERS[matcher_name]
+
+    def match(area):
+        if matcher is get_area_coords_pyramid:
+            return matcher(city.gray, area, n=n, city_small=city.gray_small)
+        return matcher(city.image, area, n=n)
+
+    # numba compilation isn't part of the latency
+    try:
+        match(cases[0][0])
+    except ValueError:
+        pass
+
+    reset_peak_rss()
+    base_rss = get_peak_rss_mb()
+    latencies, ious, qualities, failures = [], [], [], 0
+    for area, rect, quality in cases:
+        start = time.perf_counter()
+        try:
+            top_left, bottom_right, _ = match(area)
+        except ValueError:
+            failures += 1
+            ious.append(0.0)
+        else:
+            ious.append(iou(rect, (*top_left, *bottom_right)))
+        latencies.append(time.perf_counter() - start)
+        qualities.append(quality)
+
+    return {
+        "latencies": latencies, "ious": ious, "qualities": qualities, "failures": failures,
+        "peak_mb": get_peak_rss_mb() - base_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency, peak memory and accuracy of area matchers")
+    parser.add_argument("cities", nargs="*")
+    parser.add_argument("--matchers", default=",".join(MATCHERS))
+    parser.add_argument("--n", default="10,25,50", help="comma separated numbers of scales")
+    parser.add_argument("--cases", type=int, default=27)
+    parser.add_argument("--sizes", default="0.15,0.3,0.5", help="crop widths as fractions of the city photo")
+    parser.add_argument("--zooms", default="1,1.5,2", help="crop zoom factors before sending")
+    parser.add_argument("--qualities", default="95,80,60", help="JPEG qualities of the sent crop")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    floats = lambda s: [float(v) for v in s.split(",")]
+    case_args = (args.cases, floats(args.sizes), floats(args.zooms), [int(q) for q in args.qualities.split(",")], args.seed)
+    qualities = sorted({int(q) for q in args.qualities.split(",")}, reverse=True)
+    cities = [c for c in args.cities or db.get_cities_list() if get_city_img_path(c).exists()]
+
+    quality_header = " ".join(f"{f'IoU q{q}':>8}" for q in qualities)
+    print(
+        f"{'city':<16} {'matcher':<11} {'n':>3} {'p50, ms':>9} {'p90, ms':>9} {'p99, ms':>9} "
+        f"{'peak, MB':>9} {'IoU':>6} {'IoU>.5':>7} {'fail':>5} {quality_header}"
+    )
+    ctx = multiprocessing.get_context("spawn")
+    for city_name in cities:
+        for matcher_name in args.matchers.split(","):
+            for n in (int(v) for v in args.n.split(",")):
+                with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as executor:
+                    r = executor.submit(run_config, city_name, matcher_name, n, case_args).result()
+
+                ms = np.array(r["latencies"]) * 1000
+                ious = np.array(r["ious"])
+                by_quality = " ".join(
+                    f"{ious[np.array(r['qualities']) == q].mean():>8.3f}" if q in r["qualities"] else f"{'-':>8}"
+                    for q in qualities
+                )
+                print(
+                    f"{city_name:<16} {matcher_name:<11} {n:>3} "
+                    f"{np.percentile(ms, 50):>9.0f} {np.percentile(ms, 90):>9.0f} {np.percentile(ms, 99):>9.0f} "
+                    f"{r['peak_mb']:>9.0f} {ious.mean():>6.3f} {(ious > 0.5).mean():>7.0%} {r['failures']:>5} "
+                    f"{by_quality}",
+                    flush=True,
+                )
+
+
+if __name__ == "__main__":
+    main()
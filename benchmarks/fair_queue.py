@@ -0,0 +1,125 @@
+#!venv/bin/python
+import argparse
+import heapq
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.utils.render_queue import RenderQueue
+
+SPAMMER = 0
+
+
+def make_job(i: int, user_id: int, created: float, cost: float, batches: int) -> dict:
+    return {
+        "id": i, "user_id": user_id, "created": created, "cost": cost,
+        "batch_key": f"b{i % batches}", "colors": str(i % 5),
+    }
+
+
+def bench_ops(size: int, fair: bool, users: int, seed: int) -> dict:
+    """
+    Microseconds per put, get, pop_matching by batch key and per positions query at the given queue size.
+    """
+    rng = random.Random(seed)
+    q = RenderQueue("sjf", cost=lambda job: job["cost"], fair=fair)
+    jobs = [make_job(i, rng.randrange(users), i, rng.uniform(60, 600), size // 3) for i in range(size)]
+
+    start = time.perf_counter()
+    for job in jobs:
+        q.put_nowait(job)
+    put = (time.perf_counter() - start) / size
+
+    start = time.perf_counter()
+    for i in range(100):
+        q.pop_matching(lambda job: True, limit=3, batch_key=f"b{i}")
+    matching = (time.perf_counter() - start) / 100
+
+    start = time.perf_counter()
+    for user_id in range(10):
+        q.positions(user_id)
+    positions = (time.perf_counter() - start) / 10
+
+    start = time.perf_counter()
+    taken = 0
+    while not q.empty():
+        q.get_nowait()
+        taken += 1
+    get = (time.perf_counter() - start) / taken
+    return {"put": put * 1e6, "get": get * 1e6, "matching": matching * 1e6, "positions": positions * 1e3}
+
+
+def simulate(fair: bool, slots: int, spam: int, users: int, jobs_per_user: int, interval: float, seed: int) -> dict:
+    """
+    Renders on `slots` slots: the spammer queues `spam` jobs at once, other users arrive every
+    `interval` seconds on average with a few jobs each. Return waiting times by kind of user.
+    """
+    rng = random.Random(seed)
+    q = RenderQueue("fifo", cost=lambda job: job["cost"], fair=fair)
+    arrivals = [make_job(i, SPAMMER, 0.0, rng.uniform(120, 600), 1) for i in range(spam)]
+    t = 0.0
+    for user_id in range(1, users + 1):
+        t += rng.expovariate(1 / interval)
+        for _ in range(jobs_per_user):
+            arrivals.append(make_job(len(arrivals), user_id, t, rng.uniform(120, 600), 1))
+    arrivals.sort(key=lambda job: job["created"])
+    for job in arrivals:
+        job["batch_key"] = None
+
+    # (time a slot frees, slot)
+    free = [(0.0, slot) for slot in range(slots)]
+    waits = {"spammer": [], "others": []}
+    i = 0
+    while i < len(arrivals) or not q.empty():
+        now, slot = heapq.heappop(free)
+        while i < len(arrivals) and (arrivals[i]["created"] <= now or q.empty()):
+            now = max(now, arrivals[i]["created"])
+            q.put_nowait(arrivals[i])
+            i += 1
+        job = q.get_nowait()
+        waits["spammer" if job["user_id"] == SPAMMER else "others"].append(now - job["created"])
+        heapq.heappush(free, (now + job["cost"], slot))
+    return {kind: np.array(w) / 60 for kind, w in waits.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of render queue operations and waiting times with fair queuing")
+    parser.add_argument("--sizes", default="1000,10000,50000", help="comma separated queue sizes")
+    parser.add_argument("--users", type=int, default=1000, help="users owning the queued jobs")
+    parser.add_argument("--slots", type=int, default=4, help="renders running in parallel")
+    parser.add_argument("--spam", type=int, default=200, help="jobs the spammer queues at once")
+    parser.add_argument("--arrivals", type=int, default=100, help="other users arriving after the spammer")
+    parser.add_argument("--jobs-per-user", type=int, default=3)
+    parser.add_argument("--interval", type=float, default=360, help="mean seconds between arrivals")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'mode':<5} {'size':>7} {'put, us':>8} {'get, us':>8} {'batch, us':>10} {'positions, ms':>14}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        for fair in (False, True):
+            r = bench_ops(size, fair, args.users, args.seed)
+            print(
+                f"{'fair' if fair else 'sjf':<5} {size:>7} {r['put']:>8.1f} {r['get']:>8.1f} "
+                f"{r['matching']:>10.1f} {r['positions']:>14.1f}",
+                flush=True,
+            )
+
+    print()
+    print(f"{'mode':<5} {'user':<8} {'jobs':>5} {'mean wait, min':>15} {'p90 wait, min':>14} {'max wait, min':>14}")
+    for fair in (False, True):
+        r = simulate(fair, args.slots, args.spam, args.arrivals, args.jobs_per_user, args.interval, args.seed)
+        for kind, waits in r.items():
+            print(
+                f"{'fair' if fair else 'fifo':<5} {kind:<8} {len(waits):>5} {waits.mean():>15.1f} "
+                f"{np.percentile(waits, 90):>14.1f} {waits.max():>14.1f}",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!venv/bin/python
+import argparse
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.config import CMD_TEMPLATE
+from app.services import db
+from app.services.extracts import get_city_geojson_path, get_extract_shp
+
+
+def run_render(shp: Path, geojson: Path, colors: str, workdir: str) -> tuple:
+    """
+    Run one render and return its wall time in seconds and peak RSS in MB.
+    """
+    cmd = CMD_TEMPLATE.format(shp=shp, geojson=geojson, colors=colors, prefix="bench")
+    start = time.perf_counter()
+    proc = subprocess.Popen(shlex.split(cmd), cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # rusage of this child only, ru_maxrss is in KB on linux
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"Render failed: {cmd}")
+    return elapsed, usage.ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare render time and peak RSS of regional and per-city shapefiles")
+    parser.add_argument("cities", nargs="*")
+    parser.add_argument("--colors", default="black")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'city':<20} {'source':<8} {'time, s':>10} {'peak RSS, MB':>14}")
+    for city_name in args.cities or db.get_cities_list():
+        region = db.get_region_shp_path(city_name)
+        extract = get_extract_shp(city_name, region)
+        if extract == region:
+            print(f"{city_name:<20} no up to date extract, run python -m app.services.extracts first")
+            continue
+
+        geojson = get_city_geojson_path(city_name)
+        for source, shp in (("region", region), ("extract", extract)):
+            for _ in range(args.repeat):
+                with tempfile.TemporaryDirectory() as workdir:
+                    elapsed, peak_rss = run_render(shp, geojson, args.colors, workdir)
+                print(f"{city_name:<20} {source:<8} {elapsed:>10.1f} {peak_rss:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
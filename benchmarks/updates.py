@@ -0,0 +1,218 @@
+#!venv/bin/python
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from aiohttp import ClientSession, web
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+TOKEN = "123456:" + "A" * 35
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_update(i: int) -> dict:
+    # every update comes from its own chat, so the bot's reply tells which update it answers
+    user = {"id": i, "is_bot": False, "first_name": f"user{i}"}
+    return {
+        "update_id": i,
+        "message": {
+            "message_id": i,
+            "date": int(time.time()),
+            "chat": {"id": i, "type": "private"},
+            "from": user,
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+class FakeBotAPI:
+    """
+    Bot API stand-in: serves queued updates to getUpdates and records when the bot answers each chat.
+    `delay` seconds are added to every sendMessage like a round trip to Telegram.
+    """
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.updates = asyncio.Queue()
+        self.sent = {}
+        self.replied = {}
+        self.all_replied = asyncio.Event()
+        self.expected = 0
+        self.ready = asyncio.Event()
+
+    def reset(self, expected: int):
+        self.sent.clear()
+        self.replied.clear()
+        self.all_replied.clear()
+        self.expected = expected
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            self.ready.set()
+            result = await self.get_updates(float(params.get("timeout") or 0), int(params.get("limit") or 100))
+        elif method == "setWebhook":
+            self.ready.set()
+            result = True
+        elif method == "sendMessage":
+            await asyncio.sleep(self.delay)
+            chat_id = int(params["chat_id"])
+            self.replied.setdefault(chat_id, time.perf_counter())
+            if len(self.replied) >= self.expected:
+                self.all_replied.set()
+            result = {
+                "message_id": 1, "date": int(time.time()), "text": params.get("text", ""),
+                "chat": {"id": chat_id, "type": "private"},
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, timeout: float, limit: int) -> list:
+        try:
+            updates = [await asyncio.wait_for(self.updates.get(), timeout or 0.01)]
+        except asyncio.TimeoutError:
+            return []
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+
+async def post_updates(url: str, api: FakeBotAPI, count: int, concurrency: int):
+    queue = asyncio.Queue()
+    for i in range(1, count + 1):
+        queue.put_nowait(i)
+
+    async def sender(session):
+        while not queue.empty():
+            i = queue.get_nowait()
+            while True:
+                api.sent[i] = time.perf_counter()
+                async with session.post(url, json=make_update(i)) as response:
+                    if response.status == 200:
+                        break
+                # 503: the bot is full, retry like Telegram does
+                await asyncio.sleep(0.05)
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+
+
+async def run_mode(mode: str, args) -> dict:
+    api = FakeBotAPI(args.api_delay / 1000)
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    api_port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", api_port).start()
+
+    webhook_port = free_port()
+    env = {
+        **os.environ,
+        "API_TOKEN": TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}",
+        "UPDATES_MODE": mode,
+        "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}/webhook",
+        "WEBHOOK_PORT": str(webhook_port),
+        "UPDATE_CONCURRENCY": str(args.concurrency),
+    }
+    bot = subprocess.Popen([sys.executable, __file__, "--serve"], env=env, cwd=str(ROOT))
+    try:
+        await asyncio.wait_for(api.ready.wait(), 30)
+        api.reset(args.updates)
+        start = time.perf_counter()
+        if mode == "webhook":
+            await post_updates(env["WEBHOOK_URL"], api, args.updates, args.senders)
+        else:
+            for i in range(1, args.updates + 1):
+                api.sent[i] = time.perf_counter()
+                api.updates.put_nowait(make_update(i))
+        await asyncio.wait_for(api.all_replied.wait(), args.timeout)
+        elapsed = max(api.replied.values()) - start
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        drain_start = time.perf_counter()
+        await asyncio.get_event_loop().run_in_executor(None, bot.wait)
+        drain = time.perf_counter() - drain_start
+        await runner.cleanup()
+
+    latencies = np.array([api.replied[i] - api.sent[i] for i in api.replied]) * 1000
+    return {"rate": len(api.replied) / elapsed, "latencies": latencies, "shutdown": drain, "exit": bot.returncode}
+
+
+def serve():
+    """
+    Bot under test: the real dispatcher and common handlers, configured from the environment.
+    """
+    from aiogram import Bot, types
+    from aiogram.bot.api import TelegramAPIServer
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+    from app.config import API_TOKEN, TELEGRAM_API_URL, UPDATE_CONCURRENCY
+    from app.handlers.common import register_common
+    from app.utils import updates
+
+    async def main():
+        bot = Bot(API_TOKEN, parse_mode=types.ParseMode.HTML, server=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+        dp = updates.LimitedDispatcher(bot, storage=MemoryStorage(), concurrency=UPDATE_CONCURRENCY)
+        register_common(dp)
+        stop = asyncio.Event()
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        try:
+            await updates.run(dp, stop)
+        finally:
+            await (await bot.get_session()).close()
+
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Updates/sec and handler latency of polling and webhook modes")
+    parser.add_argument("--modes", default="polling,webhook")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64, help="UPDATE_CONCURRENCY of the bot")
+    parser.add_argument("--senders", type=int, default=40, help="parallel webhook connections, like max_connections")
+    parser.add_argument("--api-delay", type=float, default=50, help="ms added to every Bot API call the bot makes")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+        return
+
+    print(f"{'mode':<8} {'updates/s':>10} {'p50, ms':>9} {'p90, ms':>9} {'p99, ms':>9} {'shutdown, s':>12} {'exit':>5}")
+    for mode in args.modes.split(","):
+        r = asyncio.run(run_mode(mode, args))
+        ms = r["latencies"]
+        print(
+            f"{mode:<8} {r['rate']:>10.0f} {np.percentile(ms, 50):>9.1f} {np.percentile(ms, 90):>9.1f} "
+            f"{np.percentile(ms, 99):>9.1f} {r['shutdown']:>12.2f} {r['exit']:>5}",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
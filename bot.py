@@ -1,16 +1,22 @@
 #!venv/bin/python
 import asyncio
 import logging
+import signal
 
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TelegramAPIServer
 from aiogram_dialog import DialogRegistry
 
-from app.config import API_TOKEN
+from app.config import API_TOKEN, TELEGRAM_API_URL, UPDATE_CONCURRENCY
 from app.handlers.common import register_common
 from app.handlers.poster_creation import register_poster_creation
 from app import dialogs
 from app.utils.queue_manager import QueueManager
+from app.utils.executor import start_workers
+from app.services.fsm_storage import get_storage
+from app.utils import tg_client_api, shm, updates
+from app.config import METRICS_HOST, METRICS_PORT
+from app import logs, metrics
 
 
 def register_handlers(dp: Dispatcher):
@@ -36,23 +42,47 @@ async def main():
     ch.setFormatter(formatter)
     logger.addHandler(ch)
     logger.addHandler(fh)
+    listeners = [logs.log_in_background(logger), logs.log_in_background(logging.getLogger())]
 
     logger.info("Starting mapoc-bot")
 
-    storage = MemoryStorage()
-    bot = Bot(token=API_TOKEN, parse_mode=types.ParseMode.HTML)
-    dp = Dispatcher(bot, storage=storage)
+    storage = get_storage()
+    server = TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else None
+    bot = Bot(token=API_TOKEN, parse_mode=types.ParseMode.HTML, **({"server": server} if server else {}))
+    dp = updates.LimitedDispatcher(bot, storage=storage, concurrency=UPDATE_CONCURRENCY)
     registry = DialogRegistry(dp)
 
     register_handlers(dp)
     register_dialogs(registry)
 
-    q_manager = QueueManager()
+    await tg_client_api.start_pool()
+    q_manager = QueueManager(bot)
+    await q_manager.restore()
+
+    shm.sweep()
+    # warm both process pools in the background, polling starts right away
+    asyncio.create_task(start_workers())
+
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_event_loop().add_signal_handler(sig, stop.set)
 
     try:
-        await dp.start_polling()
+        await updates.run(dp, stop)
     finally:
+        await q_manager.close()
+        await tg_client_api.stop_pool()
         await bot.close()
+        await storage.close()
+        await storage.wait_closed()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        for listener in listeners:
+            listener.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+import pytest
+
+from app.services import broker as broker_module
+from app.services.broker import SQLiteBroker, get_broker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(broker_module.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def broker(tmp_path, clock):
+    return SQLiteBroker(str(tmp_path / "broker.sqlite3"), max_attempts=2)
+
+
+def test_lease_oldest_first(broker, clock):
+    broker.publish("a", {"n": 1})
+    clock[0] += 1
+    broker.publish("b", {"n": 2})
+    # published again after a bot restart
+    broker.publish("a", {"n": 3})
+
+    job = broker.lease("w1", 60)
+    assert job == {"id": "a", "payload": {"n": 1}, "attempts": 1}
+    assert broker.lease("w2", 60)["id"] == "b"
+    assert broker.lease("w2", 60) is None
+
+
+def test_expired_lease_is_redelivered(broker, clock):
+    broker.publish("a", {})
+    broker.lease("w1", 60)
+
+    clock[0] += 30
+    broker.heartbeat("w1", ["a"], 60)
+    clock[0] += 45
+    # extended by the heartbeat
+    assert broker.lease("w2", 60) is None
+
+    clock[0] += 30
+    job = broker.lease("w2", 60)
+    assert job["id"] == "a" and job["attempts"] == 2
+    # the first worker lost the job, its result is ignored
+    broker.complete("a", "w1", {"ok": True})
+    assert broker.fetch_results(["a"]) == []
+    broker.complete("a", "w2", {"ok": True, "file_id": "f"})
+    assert broker.fetch_results(["a"]) == [{"id": "a", "result": {"ok": True, "file_id": "f"}}]
+
+
+def test_jobs_killing_every_worker_fail(broker, clock):
+    broker.publish("a", {})
+    for _ in range(2):
+        assert broker.lease("w", 60)["id"] == "a"
+        clock[0] += 61
+
+    assert broker.lease("w", 60) is None
+    result, = broker.fetch_results(["a"])
+    assert result["result"]["ok"] is False
+
+
+def test_release(broker):
+    broker.publish("a", {})
+    broker.lease("w1", 60)
+    # only the owner releases
+    broker.release("a", "w2")
+    assert broker.lease("w2", 60) is None
+    broker.release("a", "w1")
+    assert broker.lease("w2", 60)["attempts"] == 2
+
+
+def test_results_of_awaited_jobs(broker, clock):
+    for i in range(150):
+        broker.publish(f"orphan{i}", {})
+        broker.lease("w", 60)
+        broker.complete(f"orphan{i}", "w", {"ok": True})
+    clock[0] += 1
+    broker.publish("a", {})
+    broker.lease("w", 60)
+    broker.complete("a", "w", {"ok": True})
+
+    assert [r["id"] for r in broker.fetch_results(["a", "missing"])] == ["a"]
+    assert len(broker.fetch_results([f"orphan{i}" for i in range(150)])) == 100
+
+    broker.ack_results(["a"])
+    assert broker.fetch_results(["a"]) == []
+
+    # orphans published more than an hour ago
+    clock[0] += 3600
+    assert broker.expire_results(3600) == 150
+    assert broker.fetch_results([f"orphan{i}" for i in range(150)]) == []
+
+
+def test_get_broker(tmp_path):
+    assert isinstance(get_broker(f"sqlite://{tmp_path / 'b.sqlite3'}"), SQLiteBroker)
+    with pytest.raises(ValueError):
+        get_broker("amqp://localhost")
@@ -0,0 +1,105 @@
+import numpy as np
+
+from app.utils.coords import clip_polygons, clip_ring, clip_to_geojson, get_polygons_from_gj
+
+RECT = (1.0, 1.0, 3.0, 3.0)
+
+
+def ring(*points) -> np.ndarray:
+    return np.array([*points, points[0]], dtype=np.float64)
+
+
+def square(x0, y0, x1, y1) -> np.ndarray:
+    return ring((x0, y0), (x1, y0), (x1, y1), (x0, y1))
+
+
+def area(r: np.ndarray) -> float:
+    x, y = r[:-1, 0], r[:-1, 1]
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def assert_inside(r: np.ndarray, rect: tuple):
+    xmin, ymin, xmax, ymax = rect
+    assert np.array_equal(r[0], r[-1])
+    assert (r[:, 0] >= xmin).all() and (r[:, 0] <= xmax).all()
+    assert (r[:, 1] >= ymin).all() and (r[:, 1] <= ymax).all()
+
+
+def test_inside_ring_is_kept():
+    r = square(1.5, 1.5, 2.5, 2.5)
+    assert clip_ring(r, RECT) is r
+
+
+def test_outside_ring_is_dropped():
+    assert clip_ring(square(4, 4, 5, 5), RECT) is None
+    # bboxes overlap, the ring doesn't
+    assert clip_ring(ring((0, 2), (2, 0), (0, 0)), (1.5, 1.5, 3, 3)) is None
+    # touching the rect only along its border
+    assert clip_ring(square(3, 1, 4, 2), RECT) is None
+
+
+def test_crossing_ring():
+    clipped = clip_ring(square(0, 0, 2, 2), RECT)
+    assert_inside(clipped, RECT)
+    assert area(clipped) == 1.0
+
+    # unclosed input
+    clipped = clip_ring(square(0, 0, 2, 2)[:-1], RECT)
+    assert area(clipped) == 1.0
+
+
+def test_concave_ring_stays_one_ring():
+    # U opening upwards, the rect cuts off its bottom
+    u = ring((0, 0), (4, 0), (4, 4), (3, 4), (3, 1), (1, 1), (1, 4), (0, 4))
+    rect = (0.0, 2.0, 4.0, 5.0)
+    clipped = clip_ring(u, rect)
+    assert_inside(clipped, rect)
+    assert area(clipped) == 4.0
+
+
+def test_holes():
+    polygon = [square(0, 0, 4, 4), square(1.5, 1.5, 2.5, 2.5), square(3.5, 3.5, 3.8, 3.8)]
+    (exterior, *holes), = clip_polygons([polygon], RECT)
+    assert area(exterior) == 4.0
+    # the hole inside the rect is kept, the one outside is dropped
+    assert len(holes) == 1
+    assert holes[0] is polygon[1]
+
+    crossing = [square(0, 0, 4, 4), square(2, 2, 3.5, 3.5)]
+    (exterior, hole), = clip_polygons([crossing], RECT)
+    assert_inside(hole, RECT)
+    assert area(hole) == 1.0
+
+    # exterior outside, holes go with it
+    assert clip_polygons([[square(5, 5, 9, 9), square(6, 6, 7, 7)]], RECT) == []
+
+
+def test_multipolygon():
+    geojson = {
+        "type": "Feature",
+        "properties": {"name": "city"},
+        "geometry": {
+            "type": "MultiPolygon",
+            "coordinates": [
+                [square(0, 0, 2, 2).tolist()],
+                [square(2.5, 2.5, 4, 4).tolist()],
+                [square(5, 5, 6, 6).tolist()],
+            ],
+        },
+    }
+    features = get_polygons_from_gj(geojson)
+    clipped = clip_to_geojson(features, RECT)
+    feature, = clipped["features"]
+    assert feature["properties"] == {"name": "city"}
+    assert feature["geometry"]["type"] == "MultiPolygon"
+    parts = [np.array(p[0]) for p in feature["geometry"]["coordinates"]]
+    assert sorted(area(p) for p in parts) == [0.25, 1.0]
+
+    feature, = clip_to_geojson(features, (0.0, 0.0, 1.0, 1.0))["features"]
+    assert feature["geometry"]["type"] == "Polygon"
+
+
+def test_rect_missing_geometry():
+    features = get_polygons_from_gj({"type": "Polygon", "coordinates": [square(5, 5, 6, 6).tolist()]})
+    feature, = clip_to_geojson(features, RECT)["features"]
+    assert area(np.array(feature["geometry"]["coordinates"][0])) == 4.0
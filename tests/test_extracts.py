@@ -0,0 +1,43 @@
+import json
+import os
+
+from app.services import extracts
+
+
+def test_extract_check_is_cached(tmp_path, monkeypatch):
+    checks = []
+
+    def is_fresh(city_name, source):
+        checks.append(city_name)
+        return True
+
+    monkeypatch.setattr(extracts, "_checked", {})
+    monkeypatch.setattr(extracts, "is_fresh", is_fresh)
+    monkeypatch.setattr(extracts, "EXTRACTS_PATH", tmp_path / "extracts")
+    source = tmp_path / "region.shp"
+
+    shp = extracts.get_extract_shp("Moscow", source)
+    assert shp == tmp_path / "extracts" / "Moscow" / "region.shp"
+    assert extracts.get_extract_shp("Moscow", source) == shp
+    assert checks == ["Moscow"]
+
+    monkeypatch.setattr(extracts, "EXTRACT_CHECK_INTERVAL", 0)
+    extracts.get_extract_shp("Moscow", source)
+    assert checks == ["Moscow", "Moscow"]
+
+
+def test_shp_version(tmp_path):
+    source = tmp_path / "region.shp"
+    source.write_bytes(b"shapes")
+    version = extracts.get_shp_version(source)
+    os.utime(source, ns=(0, 0))
+    assert extracts.get_shp_version(source) != version
+
+    extract = tmp_path / "extract"
+    extract.mkdir()
+    (extract / "region.shp").write_bytes(b"clipped")
+    (extract / extracts.MANIFEST).write_text(json.dumps({"source_mtime": 1}))
+    version = extracts.get_shp_version(extract / "region.shp")
+    assert extracts.get_shp_version(extract) == version
+    (extract / extracts.MANIFEST).write_text(json.dumps({"source_mtime": 2}))
+    assert extracts.get_shp_version(extract / "region.shp") != version
@@ -0,0 +1,39 @@
+import asyncio
+
+from app.utils import file_ids
+from app.utils.file_ids import FileIdRegistry
+
+
+def test_repeated_upload_is_sent_by_file_id(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_ids, "_registry", FileIdRegistry(tmp_path / "file_ids.sqlite3"))
+    poster = tmp_path / "poster.png"
+    poster.write_bytes(b"poster")
+    sent = []
+
+    async def send(file_id):
+        sent.append(file_id)
+        return file_id or "uploaded"
+
+    async def run():
+        for _ in range(2):
+            await file_ids.upload_once(poster, "document", send)
+
+    asyncio.run(run())
+    assert sent == [None, "uploaded"]
+
+    # the same path with other content is uploaded again
+    poster.write_bytes(b"another poster")
+    asyncio.run(file_ids.upload_once(poster, "document", send))
+    assert sent[-1] is None
+
+
+def test_prune_removed_files(tmp_path):
+    registry = FileIdRegistry(tmp_path / "file_ids.sqlite3")
+    for name in ("kept.png", "removed.png"):
+        (tmp_path / name).write_bytes(b"poster")
+        registry.set(tmp_path / name, "document", f"id_{name}")
+    (tmp_path / "removed.png").unlink()
+
+    assert registry.prune() == 1
+    assert registry.get(tmp_path / "kept.png", "document") == "id_kept.png"
+    assert registry.prune() == 0
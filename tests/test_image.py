@@ -0,0 +1,127 @@
+import struct
+import zlib
+
+import cv2
+import numpy as np
+import pytest
+
+from app.utils.image import PNG_SIGNATURE, decode_png_reduced
+
+
+def sample_image(height: int, width: int, channels: int, dtype=np.uint8) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    top = np.iinfo(dtype).max
+    y, x = np.mgrid[0:height, 0:width]
+    base = (x * 7 + y * 3)[..., None] + np.arange(channels) * 50
+    img = (base * (top // 255) + rng.integers(0, top // 8, (height, width, channels))) % (top + 1)
+    return img.astype(dtype).squeeze()
+
+
+def box_reference(img: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Mean of every factor x factor box, boxes at the right and bottom edges may be smaller.
+    """
+    h, w = img.shape[:2]
+    rows = np.add.reduceat(img.astype(np.float64), np.arange(0, h, factor), axis=0)
+    sums = np.add.reduceat(rows, np.arange(0, w, factor), axis=1)
+    heights = np.diff(np.append(np.arange(0, h, factor), h))
+    widths = np.diff(np.append(np.arange(0, w, factor), w))
+    return sums / (heights[:, None, None] * widths[None, :, None])
+
+
+def over_white(img: np.ndarray) -> np.ndarray:
+    """
+    BGR of an image read by cv2 with IMREAD_UNCHANGED, 8-bit, transparency composited over white.
+    """
+    if img.dtype == np.uint16:
+        img = (img >> 8).astype(np.uint8)
+    if img.ndim == 2:
+        return np.repeat(img[..., None], 3, axis=2).astype(np.float64)
+    img = img.astype(np.float64)
+    if img.shape[2] == 4:
+        alpha = img[..., 3:] / 255
+        return img[..., :3] * alpha + 255 * (1 - alpha)
+    return img
+
+
+@pytest.mark.parametrize("channels, dtype", [
+    (1, np.uint8), (3, np.uint8), (4, np.uint8), (3, np.uint16),
+])
+@pytest.mark.parametrize("size, max_dim", [((64, 96), 32), ((61, 83), 20), ((40, 30), 100)])
+def test_matches_cv2(tmp_path, channels, dtype, size, max_dim):
+    img = sample_image(*size, channels, dtype)
+    path = str(tmp_path / "poster.png")
+    cv2.imwrite(path, img)
+
+    reduced = decode_png_reduced(path, max_dim)
+
+    factor = max(1, max(size) // max_dim)
+    expected = box_reference(over_white(cv2.imread(path, cv2.IMREAD_UNCHANGED)), factor)
+    assert reduced.shape == expected.shape
+    assert reduced.dtype == np.uint8
+    assert np.abs(reduced - expected).max() <= 1
+
+
+def write_filtered_png(path, img: np.ndarray):
+    """
+    8-bit RGB PNG with rows filtered by every filter type in turn, cv2 picks filters itself.
+    """
+    h, w, _ = img.shape
+    bpp = 3
+    raw = b""
+    prev = np.zeros(w * bpp, dtype=np.int32)
+    for y in range(h):
+        row = img[y].reshape(-1).astype(np.int32)
+        left = np.concatenate([np.zeros(bpp, dtype=np.int32), row[:-bpp]])
+        up_left = np.concatenate([np.zeros(bpp, dtype=np.int32), prev[:-bpp]])
+        filter_type = y % 5
+        if filter_type == 0:
+            predictor = np.zeros_like(row)
+        elif filter_type == 1:
+            predictor = left
+        elif filter_type == 2:
+            predictor = prev
+        elif filter_type == 3:
+            predictor = (left + prev) >> 1
+        else:
+            p = left + prev - up_left
+            pa, pb, pc = np.abs(p - left), np.abs(p - prev), np.abs(p - up_left)
+            predictor = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, prev, up_left))
+        raw += bytes([filter_type]) + ((row - predictor) & 0xFF).astype(np.uint8).tobytes()
+        prev = row
+
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+    compressed = zlib.compress(raw)
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0)))
+        # split IDAT, rows cross chunk boundaries
+        for i in range(0, len(compressed), 100):
+            f.write(chunk(b"IDAT", compressed[i:i + 100]))
+        f.write(chunk(b"IEND", b""))
+
+
+def test_every_filter_type(tmp_path):
+    rgb = sample_image(50, 37, 3)
+    path = str(tmp_path / "filtered.png")
+    write_filtered_png(path, rgb)
+
+    decoded = cv2.imread(path, cv2.IMREAD_COLOR)
+    assert np.array_equal(decoded, rgb[..., ::-1])
+    assert np.array_equal(decode_png_reduced(path, 100), decoded)
+    assert np.abs(decode_png_reduced(path, 10) - box_reference(decoded, 5)).max() <= 1
+
+
+def test_rejects_bad_files(tmp_path):
+    path = tmp_path / "poster.png"
+    path.write_bytes(b"not a png")
+    with pytest.raises(ValueError):
+        decode_png_reduced(str(path), 10)
+
+    cv2.imwrite(str(path), sample_image(20, 20, 3))
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2])
+    with pytest.raises(ValueError):
+        decode_png_reduced(str(path), 10)
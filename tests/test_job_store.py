@@ -0,0 +1,110 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from app.services.job_store import COLUMNS, DONE, FAILED, JobStore, QUEUED, RUNNING
+
+
+def add_job(store: JobStore, user_id=1, **fields) -> dict:
+    fields = {"shp": "region.shp", "colors": "black", "prefix": "p", **fields}
+    return store.add(
+        user_id=user_id, command="mapoc poster create", geojson="area.geojson",
+        output_filename="out.png", caption="Moscow, black", delete_geojson=False, **fields,
+    )
+
+
+def test_restore_unfinished(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+
+    async def run_first():
+        store = JobStore(path)
+        queued = add_job(store, colors="white", features='{"shp_bytes": 1}', attempts=1)
+        running = add_job(store, user_id=2)
+        store.set_state(running, RUNNING)
+        for state in (DONE, FAILED):
+            store.set_state(add_job(store), state)
+        # written by close
+        await store.close()
+        return queued, running
+
+    queued, running = asyncio.run(run_first())
+
+    restored = JobStore(path).get_unfinished()
+    assert [job["id"] for job in restored] == [queued["id"], running["id"]]
+    assert [job["state"] for job in restored] == [QUEUED, RUNNING]
+    assert restored[0] == {c: queued[c] for c in COLUMNS}
+    assert restored[1]["started"] is not None
+
+
+def test_on_finished_once(tmp_path):
+    finished = []
+    store = JobStore(tmp_path / "jobs.sqlite3", on_finished=finished.append)
+    job = add_job(store)
+    store.set_state(job, RUNNING)
+    assert finished == []
+    store.set_state(job, DONE)
+    store.set_state(job, FAILED)
+    assert finished == [job]
+
+
+def test_created_since_includes_unwritten(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+
+    async def run():
+        store = JobStore(path)
+        written = add_job(store, user_id=1)
+        await store.flush()
+        unwritten = add_job(store, user_id=2)
+        since = store.get_created_since(written["created"])
+        assert since == [(1, written["created"]), (2, unwritten["created"])]
+        assert store.get_created_since(unwritten["created"] + 1) == []
+        await store.close()
+
+    asyncio.run(run())
+
+
+def test_failed_flush_is_retried(tmp_path, monkeypatch):
+    path = tmp_path / "jobs.sqlite3"
+
+    async def run():
+        store = JobStore(path)
+        job = add_job(store)
+        changed = add_job(store, user_id=2)
+        write = store._write
+
+        def fail(rows):
+            # a job changing while the write is in progress
+            store.set_state(changed, RUNNING)
+            raise sqlite3.OperationalError("disk I/O error")
+
+        monkeypatch.setattr(store, "_write", fail)
+        with pytest.raises(sqlite3.OperationalError):
+            await store.flush()
+        assert set(store._dirty) == {job["id"], changed["id"]}
+
+        monkeypatch.setattr(store, "_write", write)
+        await store.close()
+
+    asyncio.run(run())
+    restored = JobStore(path).get_unfinished()
+    assert [(job["user_id"], job["state"]) for job in restored] == [(1, QUEUED), (2, RUNNING)]
+
+
+def test_prune_finished(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+
+    async def run():
+        store = JobStore(path)
+        old, recent, unfinished = add_job(store), add_job(store), add_job(store)
+        store.set_state(old, DONE)
+        store.set_state(recent, FAILED)
+        old["finished"] -= 60
+        await store.flush()
+        assert store._prune(recent["finished"]) == 1
+        await store.close()
+        return recent, unfinished
+
+    recent, unfinished = asyncio.run(run())
+    ids = [row[0] for row in sqlite3.connect(str(path)).execute("SELECT id FROM jobs ORDER BY created")]
+    assert ids == [recent["id"], unfinished["id"]]
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from app.services.job_store import DONE, FAILED, QUEUED, RUNNING
+from app.utils import queue_manager
+from app.utils.queue_manager import QueueManager
+from app.utils.render import RenderResult
+from app.utils.workspace import Workspace
+
+
+class FakeBot:
+    def __init__(self):
+        self.texts = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.texts.append((chat_id, text))
+
+        class Message:
+            message_id = len(self.texts)
+        return Message()
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        self.texts.append((chat_id, text))
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    workspace = Workspace(tmp_path / "workspace", 2 ** 30, 0, 0)
+    monkeypatch.setattr(queue_manager, "get_workspace", lambda: workspace)
+    monkeypatch.setattr(queue_manager, "JOBS_DB_PATH", tmp_path / "jobs.sqlite3")
+    monkeypatch.setattr(queue_manager, "RENDER_STATS_DB_PATH", tmp_path / "stats.sqlite3")
+    monkeypatch.setattr(queue_manager, "RENDER_CACHE_PATH", tmp_path / "cache")
+    monkeypatch.setattr(queue_manager, "RENDER_BACKEND", "local")
+    monkeypatch.setattr(queue_manager, "MASTER_RENDERS", False)
+    monkeypatch.setattr(queue_manager, "RENDER_MAX_ATTEMPTS", 2)
+
+    sent = []
+
+    async def send_file(chat_id, fp, preview_fp, cap):
+        sent.append((chat_id, str(fp)))
+        return "file_id", "preview_file_id"
+
+    monkeypatch.setattr(queue_manager, "send_file", send_file)
+
+    async def make_preview(output_filename):
+        return None
+
+    monkeypatch.setattr(QueueManager, "make_preview", staticmethod(make_preview))
+    return workspace, sent
+
+
+def render_returning(results: list, calls: list):
+    """
+    Fake render writing a partial poster for every color and returning the next result.
+    """
+    async def run_render(batch, memory_limit, on_start, on_progress):
+        calls.append([task["colors"] for task in batch])
+        for task in batch:
+            with open(queue_manager.mapoc_output(batch[0], task), "wb") as f:
+                f.write(b"\x89PNG partial")
+        return results.pop(0)
+    return run_render
+
+
+def add_job(qm: QueueManager, workspace: Workspace, color: str, user_id=1, area_rect=None) -> dict:
+    qm.add_task(
+        user_id=user_id, command="mapoc", geojson=str(workspace.put_geojson({"type": "Polygon"})),
+        output_filename=str(workspace.output_path(f"p_{color}.png")), delete_geojson=False,
+        caption=f"Moscow, {color}", cache_key=f"key_{color}", batch_key="batch", shp="region.shp",
+        colors=color, prefix="p", city="Moscow", area_rect=area_rect,
+        features=json.dumps({"shp_bytes": 1, "bbox_area": 1.0}),
+    )
+    return qm.in_flight[f"key_{color}"][-1]
+
+
+async def wait_finished(qm: QueueManager, jobs: list):
+    for _ in range(200):
+        if all(job["state"] in (DONE, FAILED) for job in jobs):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Jobs not finished: {[job['state'] for job in jobs]}")
+
+
+@pytest.mark.parametrize("result", [
+    RenderResult(1, output="mapoc error"),
+    RenderResult(-9, timeout="wall"),
+    RenderResult(-9, timeout="cpu"),
+])
+def test_failed_render_isnt_delivered(manager, monkeypatch, result):
+    workspace, sent = manager
+    calls = []
+    monkeypatch.setattr(QueueManager, "run_render", staticmethod(render_returning([result], calls)))
+
+    async def run():
+        qm = QueueManager(FakeBot())
+        jobs = [add_job(qm, workspace, "black"), add_job(qm, workspace, "white", user_id=2)]
+        await wait_finished(qm, jobs)
+        cached = qm.render_cache.get("key_black")
+        await qm.close()
+        return qm, jobs, cached
+
+    qm, jobs, cached = asyncio.run(run())
+    # one batch, not retried
+    assert calls == [["black", "white"]]
+    assert [job["state"] for job in jobs] == [FAILED, FAILED]
+    assert sent == []
+    assert cached is None
+    assert not os.listdir(workspace.renders_path)
+    text = "took too long" if result.timeout else "failed"
+    assert all(text in t for _, t in qm.bot.texts[-2:])
+
+
+def test_killed_render_is_retried_then_failed(manager, monkeypatch):
+    workspace, sent = manager
+    calls = []
+    killed = RenderResult(-9)
+    monkeypatch.setattr(QueueManager, "run_render", staticmethod(render_returning([killed, killed], calls)))
+
+    async def run():
+        qm = QueueManager(FakeBot())
+        job = add_job(qm, workspace, "black")
+        await wait_finished(qm, [job])
+        await qm.close()
+        return job
+
+    job = asyncio.run(run())
+    assert len(calls) == 2
+    assert job["state"] == FAILED
+    assert job["attempts"] == 1
+    assert sent == []
+
+
+def test_successful_render_is_delivered(manager, monkeypatch):
+    workspace, sent = manager
+    calls = []
+    monkeypatch.setattr(QueueManager, "run_render", staticmethod(render_returning([RenderResult(0)], calls)))
+
+    async def run():
+        qm = QueueManager(FakeBot())
+        job = add_job(qm, workspace, "black")
+        await wait_finished(qm, [job])
+        await qm.close()
+        return job
+
+    job = asyncio.run(run())
+    assert job["state"] == DONE
+    assert sent == [(1, job["output_filename"])]
+
+
+def test_uncroppable_job_is_queued_again(manager, monkeypatch):
+    workspace, sent = manager
+    calls = []
+    monkeypatch.setattr(QueueManager, "run_render", staticmethod(render_returning([RenderResult(0)], calls)))
+    monkeypatch.setattr(QueueManager, "can_crop", staticmethod(lambda job: True))
+
+    async def run_blocking(func, *args):
+        return func(*args)
+
+    # the master is gone by the time the job is cropped
+    monkeypatch.setattr(queue_manager, "run_blocking", run_blocking)
+    monkeypatch.setattr(queue_manager.masters, "crop", lambda *args: False)
+
+    async def run():
+        qm = QueueManager(FakeBot())
+        states = []
+        set_state = qm.store.set_state
+
+        def record_state(job, state):
+            states.append(state)
+            set_state(job, state)
+
+        monkeypatch.setattr(qm.store, "set_state", record_state)
+        job = add_job(qm, workspace, "black", area_rect="[0.1, 0.1, 0.5, 0.5]")
+        await wait_finished(qm, [job])
+        await qm.close()
+        return job, states
+
+    job, states = asyncio.run(run())
+    assert calls == [["black"]]
+    assert states == [RUNNING, QUEUED, RUNNING, DONE]
+    assert sent == [(1, job["output_filename"])]
+
+
+def test_etas_use_costs_predicted_once(manager, monkeypatch):
+    workspace, sent = manager
+    predicted = []
+
+    def predict_seconds(self, job, n_colors=1):
+        predicted.append(job["colors"])
+        return 10.0
+
+    monkeypatch.setattr(QueueManager, "predict_seconds", predict_seconds)
+    results = [RenderResult(0)] * 3
+    monkeypatch.setattr(QueueManager, "run_render", staticmethod(render_returning(results, [])))
+
+    async def run():
+        qm = QueueManager(FakeBot())
+        qm.max_parallel_tasks = 1
+        # added without awaiting, the scheduler doesn't take them meanwhile
+        jobs = [add_job(qm, workspace, color, user_id=i) for i, color in enumerate(("black", "white", "red"))]
+        for _ in range(3):
+            etas = qm.get_etas(["key_white", "key_red", "key_missing"])
+            qm.get_positions(1)
+        queued_predictions = list(predicted)
+        await wait_finished(qm, jobs)
+        await qm.close()
+        return etas, queued_predictions
+
+    etas, queued_predictions = asyncio.run(run())
+    assert etas == {"key_white": 20.0, "key_red": 30.0, "key_missing": 0.0}
+    assert sorted(queued_predictions) == ["black", "red", "white"]
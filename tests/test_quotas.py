@@ -0,0 +1,76 @@
+import pytest
+
+from app.services import quotas
+from app.services.quotas import DAY, Quotas, parse_members, parse_tiers
+
+TIERS = "free:1:2:3,pro:4:0:0"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(quotas.time, "time", lambda: now[0])
+    return now
+
+
+def make_quotas() -> Quotas:
+    tiers = parse_tiers(TIERS)
+    return Quotas(tiers, parse_members("7:pro", tiers))
+
+
+def job(user_id: int, created: float) -> dict:
+    return {"user_id": user_id, "created": created}
+
+
+def test_tiers():
+    q = make_quotas()
+    assert q.tier(1).name == "free"
+    assert q.tier(7).name == "pro"
+    assert q.weight(7) == 4.0
+    with pytest.raises(ValueError):
+        parse_members("1:gold", parse_tiers(TIERS))
+    with pytest.raises(ValueError):
+        parse_tiers("")
+
+
+def test_unfinished_limit(clock):
+    q = make_quotas()
+    assert q.check(1, 2) is None
+    assert q.check(1, 3) is not None
+
+    first = job(1, clock[0])
+    q.enqueued(first)
+    q.enqueued(job(1, clock[0]))
+    assert q.check(1, 1) is not None
+    q.finished(first)
+    assert q.check(1, 1) is None
+    # no limits
+    assert q.check(7, 100) is None
+
+
+def test_daily_window_slides(clock):
+    q = make_quotas()
+    q.added(job(1, clock[0]))
+    clock[0] += DAY / 2
+    q.added(job(1, clock[0]))
+    q.added(job(1, clock[0]))
+    assert q.used_today(1) == 3
+    assert q.check(1, 1) is not None
+
+    # the first job leaves the window
+    clock[0] += DAY / 2 + 1
+    assert q.used_today(1) == 2
+    assert q.check(1, 1) is None
+    assert q.check(1, 2) is not None
+
+    clock[0] += DAY
+    assert q.used_today(1) == 0
+    assert 1 not in q.created
+
+
+def test_restore(clock):
+    q = make_quotas()
+    q.restore([(1, clock[0] - DAY - 1), (1, clock[0] - 10), (2, clock[0] - 5)])
+    assert q.used_today(1) == 1
+    assert q.used_today(2) == 1
+    assert q.used_today(3) == 0
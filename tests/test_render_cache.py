@@ -0,0 +1,52 @@
+import sqlite3
+
+from app.utils import render_cache
+from app.utils.render_cache import RenderCache
+
+
+def last_used(cache: RenderCache) -> dict:
+    db = sqlite3.connect(str(cache.path / "index.sqlite3"))
+    return dict(db.execute("SELECT key, last_used FROM renders").fetchall())
+
+
+def test_hits_are_written_in_batches(tmp_path, monkeypatch):
+    cache = RenderCache(tmp_path / "cache", 2 ** 20)
+    cache.put_file_ids("a", "file_id", "preview_file_id")
+    written = last_used(cache)["a"]
+
+    entry = cache.get("a")
+    assert entry["last_used"] >= written
+    assert last_used(cache)["a"] == written
+
+    monkeypatch.setattr(render_cache, "USED_FLUSH_INTERVAL", -1)
+    entry = cache.get("a")
+    assert last_used(cache)["a"] == entry["last_used"]
+
+
+def test_pending_hits_order_evictions(tmp_path):
+    cache = RenderCache(tmp_path / "cache", 15)
+    for key in ("old", "new"):
+        (tmp_path / f"{key}.png").write_bytes(b"poster")
+        (tmp_path / f"{key}_preview.png").write_bytes(b"p")
+        cache.put(key, str(tmp_path / f"{key}.png"), str(tmp_path / f"{key}_preview.png"))
+    # the hit isn't written yet
+    cache.get("old")
+
+    (tmp_path / "third.png").write_bytes(b"poster")
+    (tmp_path / "third_preview.png").write_bytes(b"p")
+    cache.put("third", str(tmp_path / "third.png"), str(tmp_path / "third_preview.png"))
+    assert cache.get("old")["output"] is not None
+    assert cache.get("new") is None
+
+    cache.close()
+
+
+def test_prepare_render(tmp_path):
+    (tmp_path / "region.shp").write_bytes(b"shapes")
+    geojson = tmp_path / "area.geojson"
+    geojson.write_text('{"type": "Polygon", "coordinates": [[[37.0, 55.0], [38.0, 55.0], [38.0, 56.0], [37.0, 55.0]]]}')
+
+    features, batch_key, cache_keys = render_cache.prepare_render(tmp_path / "region.shp", geojson, ["black", "white"])
+    assert features["shp_bytes"] == 6
+    assert (batch_key, cache_keys) == render_cache.render_keys(tmp_path / "region.shp", geojson, ["black", "white"])
+    assert len(set(cache_keys)) == 2
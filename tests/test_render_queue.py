@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+from app.utils.render_queue import RenderQueue
+
+WEIGHTS = {1: 2.0, 2: 1.0, 3: 0.5, 4: 1.0}
+
+
+def make_queue(policy: str, fair=True) -> RenderQueue:
+    return RenderQueue(policy, cost=lambda job: job["cost"], fair=fair, weight=lambda user_id: WEIGHTS[user_id])
+
+
+def drain(q: RenderQueue) -> list:
+    taken = []
+    while not q.empty():
+        taken.append(q.get_nowait()["id"])
+    return taken
+
+
+def test_ties_are_ordered_like_get():
+    q = RenderQueue("fifo", cost=lambda job: 1.0, fair=True, weight=lambda user_id: 2.0 if user_id == 1 else 1.0)
+    for i, user_id in enumerate([1, 2, 2, 1, 1]):
+        q.put_nowait({"id": i, "user_id": user_id, "created": i})
+
+    ordered = [job["id"] for job in q.ordered()]
+    assert ordered == drain(q) == [0, 1, 3, 2, 4]
+
+
+@pytest.mark.parametrize("policy", ["fifo", "sjf", "aging"])
+@pytest.mark.parametrize("fair", [True, False])
+def test_ordered_matches_get(policy, fair):
+    rng = random.Random(policy)
+    for _ in range(50):
+        q = make_queue(policy, fair)
+        n = 0
+        for _ in range(60):
+            action = rng.random()
+            if action < 0.6:
+                q.put_nowait({
+                    "id": n, "user_id": rng.choice(list(WEIGHTS)), "created": rng.randrange(5),
+                    "cost": rng.choice([1.0, 1.0, 2.0, 3.0]), "batch_key": f"b{rng.randrange(3)}",
+                })
+                n += 1
+            elif action < 0.8 and not q.empty():
+                q.get_nowait()
+            elif not q.empty():
+                q.pop_matching(lambda job: True, limit=1, batch_key=f"b{rng.randrange(3)}")
+
+        ordered = [job["id"] for job in q.ordered()]
+        assert ordered == drain(q)
+
+
+def test_positions_follow_order():
+    q = make_queue("sjf")
+    for i, (user_id, cost) in enumerate([(1, 3.0), (2, 1.0), (1, 1.0), (3, 2.0), (2, 2.0)]):
+        q.put_nowait({"id": i, "user_id": user_id, "created": i, "cost": cost})
+
+    ordered = [job["user_id"] for job in q.ordered()]
+    for user_id in (1, 2, 3):
+        assert q.positions(user_id) == [i for i, u in enumerate(ordered, 1) if u == user_id]
+    assert q.positions(4) == []
+
+
+def test_order_is_recomputed_after_changes():
+    q = make_queue("fifo")
+    q.put_nowait({"id": 0, "user_id": 1, "created": 0, "cost": 1.0})
+    assert [job["id"] for job in q.ordered()] == [0]
+
+    q.put_nowait({"id": 1, "user_id": 2, "created": 1, "cost": 1.0})
+    assert [job["id"] for job in q.ordered()] == [0, 1]
+
+    q.get_nowait()
+    assert [job["id"] for job in q.ordered()] == [1]
+
+    q.ordered().clear()
+    assert [job["id"] for job in q.ordered()] == [1]
+
+
+def test_weights_share_render_time():
+    q = make_queue("fifo")
+    for i in range(30):
+        q.put_nowait({"id": i, "user_id": 1 if i < 15 else 3, "created": i, "cost": 1.0})
+
+    first = [job["user_id"] for job in q.ordered()[:10]]
+    # weight 2.0 against 0.5
+    assert first.count(1) == 8
+    assert first.count(3) == 2
+
+
+def test_sjf_and_aging_within_user():
+    sjf = make_queue("sjf")
+    aging = RenderQueue("aging", cost=lambda job: job["cost"], aging_rate=10.0)
+    for q in (sjf, aging):
+        q.put_nowait({"id": 0, "user_id": 1, "created": 0, "cost": 5.0})
+        q.put_nowait({"id": 1, "user_id": 1, "created": 1, "cost": 1.0})
+
+    assert drain(sjf) == [1, 0]
+    # one second of waiting outweighs 4 seconds of render
+    assert drain(aging) == [0, 1]
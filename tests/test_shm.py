@@ -0,0 +1,89 @@
+import concurrent.futures
+import multiprocessing
+from collections import Counter
+from multiprocessing import resource_tracker
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.utils import coords, shm
+from app.utils.shm import SharedBuffer
+
+
+@pytest.fixture
+def registrations(monkeypatch):
+    """
+    Segment name -> registrations with the resource tracker, recorded instead of made.
+    """
+    counts = Counter()
+
+    def register(name, rtype):
+        counts[name] += 1
+
+    def unregister(name, rtype):
+        counts[name] -= 1
+
+    monkeypatch.setattr(resource_tracker, "register", register)
+    monkeypatch.setattr(resource_tracker, "unregister", unregister)
+    return counts
+
+
+def segments() -> set:
+    return {p.name for p in shm.SHM_DIR.glob(shm.NAME_PREFIX + "*")}
+
+
+def test_borrowed_segment_isnt_tracked(registrations):
+    with SharedBuffer.from_bytes(b"photo") as photo:
+        name = photo.shm._name
+        assert registrations[name] == 1
+        with SharedBuffer.attach(photo.ref) as borrowed:
+            assert bytes(borrowed.buf) == b"photo"
+        # the creator's registration is left alone
+        assert registrations[name] == 1
+    assert registrations[name] == 0
+
+
+def test_handed_over_segment_is_tracked_by_new_owner(registrations):
+    ref = SharedBuffer.from_bytes(b"preview").detach()
+    name = "/" + ref.name
+    assert registrations[name] == 0
+    with SharedBuffer.attach(ref, owner=True) as owned:
+        assert registrations[name] == 1
+        assert bytes(owned.buf) == b"preview"
+    assert registrations[name] == 0
+    assert ref.name not in segments()
+
+
+def read_and_reply(ref):
+    with SharedBuffer.attach(ref) as borrowed:
+        data = bytes(borrowed.buf)
+    return SharedBuffer.from_bytes(data[::-1]).detach()
+
+
+def test_forked_worker():
+    before = segments()
+    executor = concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("fork"))
+    with executor, SharedBuffer.from_bytes(b"photo") as photo:
+        reply = executor.submit(read_and_reply, photo.ref).result()
+        with SharedBuffer.attach(reply, owner=True) as owned:
+            assert bytes(owned.buf) == b"otohp"
+    assert segments() == before
+
+
+def test_area_to_geojson_leaves_no_segment(monkeypatch):
+    image = np.zeros((20, 30, 3), dtype=np.uint8)
+    city = SimpleNamespace(image=image, gray=image[..., 0], gray_small=image[..., 0], bounds=None, features=[])
+    monkeypatch.setattr(coords.city_cache, "get", lambda name: city)
+    monkeypatch.setattr(coords, "AREA_MATCHER", "pyramid")
+    monkeypatch.setattr(coords, "get_area_coords_pyramid", lambda *args, **kwargs: ((1, 1), (10, 10), 1.0))
+
+    def fail(*args, **kwargs):
+        raise ValueError("no bounds")
+
+    monkeypatch.setattr(coords, "pixel_to_geo", fail)
+    before = segments()
+    with SharedBuffer.from_bytes(coords.cv2.imencode(".png", image)[1]) as photo:
+        with pytest.raises(ValueError):
+            coords.area_to_geojson("Moscow", photo.ref)
+    assert segments() == before
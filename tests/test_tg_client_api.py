@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from app.utils import tg_client_api
+from app.utils.tg_client_api import PyrogramBot
+
+
+class FakeClient:
+    def __init__(self, connect_errors=0):
+        self.is_connected = False
+        self.connect_errors = connect_errors
+        self.starts = 0
+
+    async def start(self):
+        self.starts += 1
+        if self.connect_errors:
+            self.connect_errors -= 1
+            raise ConnectionError("handshake failed")
+        self.is_connected = True
+
+    async def stop(self):
+        self.is_connected = False
+
+
+def make_bot(client: FakeClient) -> PyrogramBot:
+    bot = PyrogramBot.__new__(PyrogramBot)
+    bot._bot = client
+    bot._lock = asyncio.Lock()
+    return bot
+
+
+def test_connect_error_is_retried():
+    bot = make_bot(FakeClient(connect_errors=1))
+    sent = []
+
+    async def send(**kwargs):
+        sent.append(kwargs)
+        return "message"
+
+    assert asyncio.run(bot._call(send, chat_id=1)) == "message"
+    assert sent == [{"chat_id": 1}]
+
+
+def test_send_error_isnt_retried():
+    client = FakeClient()
+    bot = make_bot(client)
+    sent = []
+
+    async def send(**kwargs):
+        sent.append(kwargs)
+        raise ConnectionError("connection lost")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(bot._call(send, chat_id=1))
+    # the poster may have been delivered, it isn't sent twice
+    assert len(sent) == 1
+    # reconnected for the next send
+    assert client.starts == 2 and client.is_connected
+
+
+def test_preview_is_sent_first(monkeypatch):
+    sent = []
+
+    class Pool:
+        async def send_photo(self, chat_id, file, caption=None):
+            await asyncio.sleep(0.01)
+            sent.append(file)
+            return "preview_file_id"
+
+        async def send_document(self, chat_id, file, caption=None):
+            sent.append(file)
+            return "file_id"
+
+    async def make_preview():
+        return "preview.jpg"
+
+    monkeypatch.setattr(tg_client_api, "get_pool", Pool)
+    file_ids = asyncio.run(tg_client_api.send_file(1, "poster.png", make_preview(), "Moscow"))
+    assert file_ids == ("file_id", "preview_file_id")
+    assert sent == ["preview.jpg", "poster.png"]
@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+import pytest
+
+import worker
+from app.utils.render import RenderResult
+from app.utils.resources import Reservation
+from app.utils.workspace import Workspace
+
+
+@pytest.fixture
+def render_worker(tmp_path, monkeypatch):
+    sent = []
+
+    async def send_file(chat_id, fp, preview_fp, cap):
+        sent.append((chat_id, fp))
+        return "file_id", "preview_file_id"
+
+    async def run_blocking(func, *args):
+        return func(*args)
+
+    monkeypatch.setattr(worker.tg_client_api, "send_file", send_file)
+    monkeypatch.setattr(worker, "run_blocking", run_blocking)
+    monkeypatch.setattr(worker, "make_preview", lambda fp: None)
+    workspace = Workspace(tmp_path / "workspace", 2 ** 30, 0, 0)
+    return worker.RenderWorker(None, workspace), sent
+
+
+def use_render(monkeypatch, result: RenderResult):
+    async def render(shp, geojson, colors, prefix, cwd, **limits):
+        with open(os.path.join(cwd, f"{prefix}_{colors}.png"), "wb") as f:
+            f.write(b"\x89PNG partial")
+        return result
+
+    monkeypatch.setattr(worker.render, "render", render)
+
+
+def make_job() -> dict:
+    return {"id": "job", "attempts": 1, "payload": {
+        "shp": "/data/region.shp", "geojson": '{"type": "Polygon"}', "colors": "black", "prefix": "p",
+        "output_filename": "/bot/workspace/renders/p_black.png", "user_id": 1, "caption": "Moscow, black",
+    }}
+
+
+def run_render(render_worker) -> dict:
+    return asyncio.run(render_worker.render(make_job(), Reservation(2 ** 20)))
+
+
+@pytest.mark.parametrize("result", [RenderResult(1), RenderResult(-9, timeout="wall")])
+def test_failed_render_isnt_sent(render_worker, monkeypatch, result):
+    w, sent = render_worker
+    use_render(monkeypatch, result)
+
+    assert run_render(w)["ok"] is False
+    assert sent == []
+    assert not os.listdir(w.workspace.renders_path)
+
+
+def test_killed_render_is_retried(render_worker, monkeypatch):
+    w, sent = render_worker
+    use_render(monkeypatch, RenderResult(-9))
+
+    assert run_render(w) is None
+    assert sent == []
+    assert not os.listdir(w.workspace.renders_path)
+
+
+def test_successful_render_is_sent(render_worker, monkeypatch):
+    w, sent = render_worker
+    use_render(monkeypatch, RenderResult(0))
+
+    assert run_render(w) == {"ok": True, "file_id": "file_id", "preview_file_id": "preview_file_id"}
+    assert [chat_id for chat_id, _ in sent] == [1]
+    assert not os.listdir(w.workspace.renders_path)
@@ -0,0 +1,75 @@
+import os
+
+from app.utils import workspace as workspace_module
+from app.utils.workspace import Workspace, sweep_workers
+
+
+def make_file(workspace: Workspace, name: str, size: int, mtime: float) -> str:
+    path = str(workspace.output_path(name))
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_put_is_content_addressed(tmp_path):
+    workspace = Workspace(tmp_path, 2 ** 20, 0, 0)
+    first = workspace.put_geojson({"type": "Polygon"})
+    os.utime(first, (1, 1))
+    assert workspace.put_geojson('{"type":"Polygon"}') == first
+    # touched by the second put
+    assert os.stat(first).st_mtime > 1
+    assert os.listdir(workspace.tmp_path) == []
+
+
+def test_collect_expired_and_over_budget(tmp_path):
+    workspace = Workspace(tmp_path, 300, ttl=1000, grace=10)
+    now = 10000.0
+    expired = make_file(workspace, "expired.png", 10, now - 2000)
+    referenced = make_file(workspace, "referenced.png", 100, now - 2000)
+    old = make_file(workspace, "old.png", 100, now - 500)
+    recent = make_file(workspace, "recent.png", 100, now - 100)
+    fresh = make_file(workspace, "fresh.png", 100, now - 5)
+    workspace.acquire(referenced)
+
+    removed, freed = workspace.collect(set(workspace.refs), now=now)
+    # expired first, then the oldest unreferenced file past the grace brings it under the budget
+    assert (removed, freed) == (2, 110)
+    assert sorted(os.listdir(workspace.renders_path)) == ["fresh.png", "recent.png", "referenced.png"]
+    assert not os.path.exists(expired) and not os.path.exists(old)
+    assert os.path.exists(recent) and os.path.exists(fresh)
+
+    workspace.release(referenced)
+    assert workspace.collect(set(workspace.refs), now=now) == (1, 100)
+    assert not os.path.exists(referenced)
+
+
+def test_files_in_grace_are_kept_over_budget(tmp_path):
+    workspace = Workspace(tmp_path, 50, ttl=0, grace=60)
+    make_file(workspace, "fresh.png", 100, 10000 - 30)
+    assert workspace.collect(set(), now=10000) == (0, 0)
+
+
+def test_sweep(tmp_path):
+    workspace = Workspace(tmp_path, 2 ** 20, 0, 0)
+    waiting = make_file(workspace, "waiting.png", 10, 1)
+    make_file(workspace, "left.png", 10, 1)
+    (workspace.tmp_path / "partial.geojson.1").write_bytes(b"{")
+    workspace.acquire(waiting)
+
+    workspace.sweep()
+    assert os.listdir(workspace.renders_path) == ["waiting.png"]
+    assert os.listdir(workspace.tmp_path) == []
+
+
+def test_sweep_workers(tmp_path, monkeypatch):
+    for name in ("1", "2", "not_a_pid"):
+        (tmp_path / name).mkdir()
+
+    def kill(pid, sig):
+        if pid == 2:
+            raise ProcessLookupError
+
+    monkeypatch.setattr(workspace_module.os, "kill", kill)
+    sweep_workers(tmp_path)
+    assert sorted(os.listdir(tmp_path)) == ["1", "not_a_pid"]
@@ -0,0 +1,170 @@
+#!venv/bin/python
+import asyncio
+import concurrent.futures
+import logging
+import os
+import socket
+import uuid
+from typing import Optional
+
+from app.config import (
+    FILES_PATH, BROKER_URL, BROKER_LEASE_SECONDS, BROKER_POLL_INTERVAL,
+    BROKER_MAX_ATTEMPTS, MAX_PARALLEL_RENDERS, MEMORY_RESERVE_MB, RENDER_MEMORY_ESTIMATE_MB,
+    RENDER_MEMORY_LIMIT_FACTOR, METRICS_HOST, WORKER_METRICS_PORT, RENDER_TIMEOUT, RENDER_CPU_TIMEOUT,
+    WORKSPACE_PATH, WORKSPACE_MAX_MB, WORKSPACE_TTL, WORKSPACE_GRACE, WORKSPACE_GC_INTERVAL,
+)
+from app import logs, metrics
+from app.services.broker import Broker, get_broker
+from app.utils import render, tg_client_api
+from app.utils.executor import run_blocking, bulk_pool
+from app.utils.image import make_preview, get_preview_filename
+from app.utils.resources import MemoryAdmission, Reservation
+from app.utils.workspace import Workspace, sweep_workers
+
+logger = logging.getLogger("worker")
+
+
+def remove_outputs(output_filename: str):
+    for fp in (output_filename, get_preview_filename(output_filename)):
+        if os.path.exists(fp):
+            os.remove(fp)
+
+
+class RenderWorker:
+    """
+    Takes render jobs from the broker while this host has memory for them,
+    renders them, sends posters to users and reports file_ids back to the bot.
+    """
+    def __init__(self, broker: Broker, workspace: Workspace):
+        self.id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.broker = broker
+        self.workspace = workspace
+        self.admission = MemoryAdmission(MAX_PARALLEL_RENDERS, MEMORY_RESERVE_MB * 1024 * 1024)
+        self.leased = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="broker")
+
+    async def call(self, method, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, method, *args)
+
+    async def run(self):
+        logger.info(f"Worker {self.id} started")
+        asyncio.get_event_loop().create_task(self.heartbeat())
+        while True:
+            reservation = await self.admission.acquire(RENDER_MEMORY_ESTIMATE_MB * 1024 * 1024)
+            job = await self.call(self.broker.lease, self.id, BROKER_LEASE_SECONDS)
+            if job is None:
+                self.admission.release(reservation)
+                await asyncio.sleep(BROKER_POLL_INTERVAL)
+                continue
+
+            self.leased.add(job["id"])
+            asyncio.get_event_loop().create_task(self.process(job, reservation))
+
+    async def heartbeat(self):
+        while True:
+            try:
+                await self.call(self.broker.heartbeat, self.id, list(self.leased), BROKER_LEASE_SECONDS)
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(BROKER_LEASE_SECONDS / 3)
+
+    async def process(self, job: dict, reservation: Reservation):
+        try:
+            result = await self.render(job, reservation)
+        except Exception as e:
+            logger.exception(e)
+            result = None
+
+        try:
+            if result is not None:
+                await self.call(self.broker.complete, job["id"], self.id, result)
+            elif job["attempts"] >= BROKER_MAX_ATTEMPTS:
+                await self.call(self.broker.complete, job["id"], self.id, {"ok": False, "error": "Max attempts exceeded"})
+            else:
+                await self.call(self.broker.release, job["id"], self.id)
+        finally:
+            self.leased.discard(job["id"])
+            self.admission.release(reservation)
+
+    async def render(self, job: dict, reservation: Reservation) -> Optional[dict]:
+        """
+        Return result for the bot or None if the job should be retried.
+        """
+        payload = job["payload"]
+        shp = payload["shp"] if os.path.isabs(payload["shp"]) else FILES_PATH / payload["shp"]
+        # the bot's output path is on its own host
+        output_filename = str(self.workspace.output_path(os.path.basename(payload["output_filename"])))
+        # jobs for the same area share the file
+        geojson_path = self.workspace.put_geojson(payload["geojson"])
+        self.workspace.acquire(geojson_path)
+
+        memory_limit = int(reservation.estimate * RENDER_MEMORY_LIMIT_FACTOR)
+
+        def on_start(pid):
+            reservation.pid = pid
+
+        try:
+            with metrics.timer("render"):
+                result = await render.render(
+                    shp, geojson_path, payload["colors"], payload["prefix"], memory_limit=memory_limit,
+                    on_start=on_start, timeout=RENDER_TIMEOUT or None, cpu_timeout=RENDER_CPU_TIMEOUT or None,
+                    cwd=str(self.workspace.renders_path),
+                )
+        finally:
+            self.workspace.release(geojson_path)
+
+        if not result.ok:
+            logger.error(f"Render of job {job['id']} {result.describe()}, output:\n{result.output}")
+            # a killed or failed mapoc run may leave a partial poster, it's never sent
+            remove_outputs(output_filename)
+            # killed by a signal (OOM, shutdown) is worth another try, an error exit code or a timeout isn't
+            if result.retryable:
+                return None
+            return {"ok": False, "error": f"Render {result.describe()}"}
+        if not os.path.exists(output_filename):
+            return {"ok": False, "error": "Render finished without output"}
+
+        try:
+            preview = await run_blocking(make_preview, output_filename)
+            file_id, preview_file_id = await tg_client_api.send_file(
+                payload["user_id"], output_filename, preview, payload["caption"],
+            )
+        finally:
+            remove_outputs(output_filename)
+
+        return {"ok": True, "file_id": file_id, "preview_file_id": preview_file_id}
+
+
+async def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)s] [%(levelname)s] %(name)s: %(message)s',
+    )
+    listener = logs.log_in_background(logging.getLogger())
+    # workers on one host don't share files with each other or the bot
+    workers_path = WORKSPACE_PATH / "workers"
+    sweep_workers(workers_path)
+    workspace = Workspace(
+        workers_path / str(os.getpid()), WORKSPACE_MAX_MB * 1024 * 1024, WORKSPACE_TTL, WORKSPACE_GRACE,
+    )
+    asyncio.create_task(workspace.run_gc(WORKSPACE_GC_INTERVAL))
+
+    metrics_runner = None
+    if WORKER_METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_HOST, WORKER_METRICS_PORT)
+
+    broker = get_broker(BROKER_URL, max_attempts=BROKER_MAX_ATTEMPTS)
+    await tg_client_api.start_pool()
+    # previews are the only pool work here
+    asyncio.create_task(bulk_pool.start())
+    try:
+        await RenderWorker(broker, workspace).run()
+    finally:
+        await tg_client_api.stop_pool()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        listener.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())